@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import signal
+import socketserver
+import subprocess
+import tempfile
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeEngine:
+    """
+    just enough of the docker engine API, served on a unix socket, for DockerEngineExecutor to run
+    builds without docker. A container is a directory on the host, execs run as host processes
+    in it with $HOME pointed at the container directory, and pulls only record the image.
+    """
+    def __init__(self, socket_path: str, root: str = None):
+        self.socket_path = socket_path
+        self.root = root or tempfile.mkdtemp(prefix='fake-engine-')
+        self.containers = {}
+        self.execs = {}
+        self.images = set()
+        engine = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def address_string(self):
+                return 'unix'
+
+            def _body(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                return self.rfile.read(length) if length else b''
+
+            def _send(self, status, payload=None):
+                data = b'' if payload is None else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if data:
+                    self.wfile.write(data)
+
+            def do_GET(self):
+                engine.dispatch(self, 'GET')
+
+            def do_POST(self):
+                engine.dispatch(self, 'POST')
+
+            def do_PUT(self):
+                engine.dispatch(self, 'PUT')
+
+            def do_DELETE(self):
+                engine.dispatch(self, 'DELETE')
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        self.server = Server(socket_path, Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> 'FakeEngine':
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def dispatch(self, h, method):
+        url = urlparse(h.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+        body = h._body() if method in ('POST', 'PUT') else b''
+        if parts[0] == 'images' and parts[1] == 'create':
+            self.images.add(query['fromImage'] + ':' + query.get('tag', 'latest'))
+            return h._send(200, {'status': 'pulled'})
+        if parts[0] == 'images' and parts[-1] == 'json':
+            name = '/'.join(parts[1:-1])
+            if ':' not in name:
+                name += ':latest'
+            return h._send(200, {'Id': name}) if name in self.images else h._send(404, {'message': 'no such image'})
+        if parts[0] == 'containers':
+            if parts[1] == 'create':
+                name = query['name']
+                spec = json.loads(body)
+                if name in self.containers:
+                    return h._send(409, {'message': 'conflict'})
+                root = os.path.join(self.root, name)
+                os.makedirs(root)
+                self.containers[name] = {'Id': name, 'root': root, 'Image': spec['Image'],
+                                         'Labels': spec.get('Labels') or {}, 'running': False}
+                return h._send(201, {'Id': name})
+            if parts[1] == 'json':
+                labels = json.loads(query.get('filters', '{}')).get('label', [])
+                out = [{'Id': c['Id'], 'Names': ['/' + n], 'Image': c['Image'], 'Labels': c['Labels'],
+                        'State': 'running' if c['running'] else 'created', 'Created': 0}
+                       for n, c in list(self.containers.items())
+                       if all(label.split('=')[0] in c['Labels'] for label in labels)]
+                return h._send(200, out)
+            name = parts[1]
+            c = self.containers.get(name)
+            if c is None:
+                return h._send(404, {'message': 'no such container'})
+            action = parts[2] if len(parts) > 2 else None
+            if method == 'DELETE':
+                for proc in c.get('procs', []):  # a removed container's execs die with it
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                shutil.rmtree(c['root'], ignore_errors=True)
+                del self.containers[name]
+                return h._send(204)
+            if method == 'GET' and action == 'json':
+                return h._send(200, {'Id': c['Id'], 'State': {'Running': c['running']}})
+            if action == 'start':
+                c['running'] = True
+                return h._send(204)
+            if action == 'rename':
+                self.containers[query['name']] = self.containers.pop(name)
+                return h._send(204)
+            if action == 'exec':
+                spec = json.loads(body)
+                exec_id = uuid.uuid4().hex
+                self.execs[exec_id] = {'container': name, 'spec': spec, 'Running': False, 'ExitCode': None}
+                return h._send(201, {'Id': exec_id})
+        if parts[0] == 'exec':
+            e = self.execs.get(parts[1])
+            if e is None:
+                return h._send(404, {'message': 'no such exec'})
+            if parts[2] == 'json':
+                return h._send(200, {'Running': e['Running'], 'ExitCode': e['ExitCode']})
+            if parts[2] == 'start':
+                return self._exec_start(h, e)
+        h._send(404, {'message': 'unknown ' + h.path})
+
+    def _exec_start(self, h, e):
+        c = self.containers[e['container']]
+        spec = e['spec']
+        env = dict(os.environ)
+        env['HOME'] = c['root']
+        for var in spec.get('Env') or []:
+            k, _, v = var.partition('=')
+            env[k] = v
+        cwd = spec.get('WorkingDir') or c['root']
+        if not os.path.isdir(cwd):
+            cwd = c['root']
+        h.send_response(101)
+        h.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+        h.send_header('Connection', 'Upgrade')
+        h.send_header('Upgrade', 'tcp')
+        h.end_headers()
+        h.wfile.flush()
+        e['Running'] = True
+        proc = subprocess.Popen(spec['Cmd'], cwd=cwd, env=env,
+                                stdin=subprocess.PIPE if spec.get('AttachStdin') else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        c.setdefault('procs', []).append(proc)
+        wlock = threading.Lock()
+
+        def pump(pipe, kind):
+            # the multiplexed stream format: [stream, 0, 0, 0, size (4 bytes big endian)] + payload
+            for chunk in iter(lambda: os.read(pipe.fileno(), 65536), b''):
+                with wlock:
+                    h.wfile.write(bytes([kind, 0, 0, 0]) + len(chunk).to_bytes(4, 'big') + chunk)
+                    h.wfile.flush()
+
+        def feed():
+            try:
+                while True:
+                    data = h.rfile.read1(65536)
+                    if not data:
+                        break
+                    proc.stdin.write(data)
+            except OSError:
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        threads = [threading.Thread(target=pump, args=(proc.stdout, 1)),
+                   threading.Thread(target=pump, args=(proc.stderr, 2))]
+        if spec.get('AttachStdin'):
+            threads.append(threading.Thread(target=feed, daemon=True))
+        for t in threads:
+            t.start()
+        for t in threads[:2]:
+            t.join()
+        e['ExitCode'] = proc.wait()
+        e['Running'] = False
+        h.close_connection = True
@@ -0,0 +1,228 @@
+import json
+import os
+import random
+import re
+import subprocess
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import rpyc
+import yaml
+from rpyc import ThreadedServer
+
+from zeus_ci.agent_registry import AgentRegistry
+
+
+class StubAllocatorService(rpyc.Service):
+    """
+    stands in for resource_allocator.BuildThreadRegisterService, granting every request (or up to
+    `limit` at once) and counting how many containers are out at once. Reconciling frees the
+    allocations of a host whose containers aren't held, like the real one
+    """
+    def __init__(self, limit: int = None):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.allocated = 0
+        self.peak = 0
+        self.holders = {}  # container name: (host, allocated at)
+        self.agents = AgentRegistry()
+
+    def exposed_request_container(self, username, holder=None, host=None):
+        with self.lock:
+            self.requests += 1
+            if self.limit is not None and self.allocated >= self.limit:
+                return False
+            self.allocated += 1
+            self.peak = max(self.peak, self.allocated)
+            if holder is not None:
+                self.holders[holder] = (host, time.time())
+        return True
+
+    def exposed_return_container(self, username, holder=None):
+        with self.lock:
+            if holder is not None and self.holders.pop(holder, None) is None:
+                return
+            self.allocated = max(self.allocated - 1, 0)
+
+    def exposed_reconcile(self, host, held, as_of):
+        held = set(held)
+        with self.lock:
+            stale = [holder for holder, (holder_host, allocated_at) in self.holders.items()
+                     if holder_host == host and allocated_at < as_of and holder not in held]
+            for holder in stale:
+                del self.holders[holder]
+            self.allocated = max(self.allocated - len(stale), 0)
+        return len(stale)
+
+    # the build agent registry is the real one
+    def exposed_register_agent(self, name, address, port, slots, running, images, mirrors):
+        self.agents.register(name, address, port, slots, running, images, mirrors)
+
+    def exposed_unregister_agent(self, name):
+        self.agents.unregister(name)
+
+    def exposed_place_stage(self, image, mirror, pinned=None):
+        return self.agents.place(image, mirror, pinned)
+
+    def exposed_release_stage(self, name):
+        self.agents.release(name)
+
+
+def start_allocator() -> (ThreadedServer, StubAllocatorService):
+    service = StubAllocatorService()
+    server = ThreadedServer(service, hostname='localhost', port=0,
+                            protocol_config={'allow_public_attrs': True})
+    threading.Thread(target=server.start, name='stub-allocator', daemon=True).start()
+    return server, service
+
+
+class FakeGithubAPI(ThreadingHTTPServer):
+    """
+    just the github API calls of setting a commit status, the first `failures` requests get a 502
+    """
+    def __init__(self, failures: int = 0):
+        super().__init__(('127.0.0.1', 0), _GithubAPIHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.statuses: Dict[str, List[str]] = {}  # sha: states in the order they were set
+
+    def close(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _GithubAPIHandler(BaseHTTPRequestHandler):
+    server: FakeGithubAPI
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code: int, body: dict) -> None:
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method: str) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        with self.server.lock:
+            self.server.requests += 1
+            failing = self.server.failures > 0
+            self.server.failures -= 1
+        if failing:
+            return self._reply(502, {'message': 'bad gateway'})
+        repo_url = '{}/repos/{}'.format(self.server.url, '/'.join(self.path.split('/')[2:4]))
+        match = re.fullmatch(r'/repos/([^/]+/[^/]+)(?:/(commits|statuses)/([0-9a-f]+))?', self.path)
+        if not match:
+            return self._reply(404, {'message': 'Not Found'})
+        full_name, kind, sha = match.groups()
+        if method == 'POST' and kind == 'statuses':
+            with self.server.lock:
+                self.server.statuses.setdefault(sha, []).append(body['state'])
+            return self._reply(201, {'state': body['state'], 'url': '{}/statuses/{}'.format(repo_url, sha)})
+        if method == 'GET' and kind == 'commits':
+            return self._reply(200, {'sha': sha, 'url': '{}/commits/{}'.format(repo_url, sha)})
+        if method == 'GET' and kind is None:
+            return self._reply(200, {'full_name': full_name, 'name': full_name.split('/')[1], 'url': repo_url})
+        self._reply(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+def start_github_api(failures: int = 0) -> FakeGithubAPI:
+    server = FakeGithubAPI(failures)
+    threading.Thread(target=server.serve_forever, name='fake-github-api', daemon=True).start()
+    return server
+
+
+def synthetic_config(stages: int, width: int, steps: int = 1, image: str = 'zeus-ci/bench:latest',
+                     fan_in: int = 2, seed: int = 0) -> dict:
+    """
+    a build config with one workflow of `stages` stages laid out in layers of `width`, each stage
+    requiring up to `fan_in` random stages of the layer before it
+    """
+    rng = random.Random(seed)
+    jobs, workflow = {}, []
+    layers: List[List[str]] = []
+    for number in range(stages):
+        if number % width == 0:
+            layers.append([])
+        name = 'stage{}'.format(number)
+        jobs[name] = {'docker': [{'image': image}],
+                      'steps': [{'run': {'name': 'step {}'.format(step), 'command': 'true'}}
+                                for step in range(steps)]}
+        requires = rng.sample(layers[-2], min(fan_in, len(layers[-2]))) if len(layers) > 1 else []
+        workflow.append({name: {'requires': requires}} if requires else name)
+        layers[-1].append(name)
+    return {'jobs': jobs, 'workflows': {'version': 2, 'bench': {'stages': workflow}}}
+
+
+def git_env(root: str) -> Dict[str, str]:
+    """
+    a global git config that redirects https://github.com/ to the bare repos under `root`, so the
+    runner's mirror clones and fetches stay on disk
+    """
+    os.makedirs(root, exist_ok=True)
+    gitconfig = os.path.join(root, 'gitconfig')
+    with open(gitconfig, 'w') as f:
+        f.write('[url "file://{}/"]\n\tinsteadOf = https://github.com/\n'.format(root))
+        f.write('[user]\n\tname = zeus-ci bench\n\temail = bench@zeus-ci\n')
+    return {'GIT_CONFIG_GLOBAL': gitconfig, 'GIT_CONFIG_NOSYSTEM': '1'}
+
+
+def make_repo(root: str, repo_slab: str, build_config: dict, files: int = 10) -> str:
+    """
+    creates a bare repo for `repo_slab` under `root` with `build_config` as its .zeusci/config.yml
+    returns the sha of its only commit
+    """
+    work_tree = os.path.join(root, 'src', repo_slab)
+    os.makedirs(os.path.join(work_tree, '.zeusci'))
+    with open(os.path.join(work_tree, '.zeusci', 'config.yml'), 'w') as f:
+        yaml.safe_dump(build_config, f)
+    for number in range(files):
+        with open(os.path.join(work_tree, 'file{}.txt'.format(number)), 'w') as f:
+            f.write('{}\n'.format(number) * 100)
+
+    def git(*args, cwd=work_tree):
+        return subprocess.run(['git'] + list(args), cwd=cwd, check=True, stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE).stdout.decode().strip()
+
+    git('init', '--quiet')
+    git('add', '.')
+    git('commit', '--quiet', '-m', 'synthetic build')
+    bare = os.path.join(root, '{}.git'.format(repo_slab))
+    os.makedirs(os.path.dirname(bare), exist_ok=True)
+    git('clone', '--quiet', '--bare', work_tree, bare, cwd=root)
+    return git('rev-parse', 'HEAD')
+
+
+def seed_database(database, repo_slab: str, commit: str, builds: int) -> List[int]:
+    """
+    adds a user, a repo and `builds` created builds of a branch push to `database`
+    returns the ids of the builds
+    """
+    from zeus_ci import Status
+    from zeus_ci.persistence import Build, Repo, User
+
+    username = repo_slab.split('/')[0]
+    with database.get_session() as session:
+        if not session.query(User).filter_by(username=username).first():
+            session.add(User(username=username, container_limit=1000, token='bench'))
+            session.add(Repo(name=repo_slab, scm='github', username=username, env_vars=[]))
+        new_builds = [Build(repo_name=repo_slab, ref='refs/heads/master', commit=commit,
+                            json={'after': commit}, status=Status.created)
+                      for _ in range(builds)]
+        session.add_all(new_builds)
+        session.flush()
+        return [build.id for build in new_builds]
@@ -0,0 +1,369 @@
+"""
+offline benchmarks for the runner and build coordinator. docker is replaced by FakeEngine, the
+resource allocator by a stub rpyc service, github by local bare repos (and a stand in for its API)
+and the database by a throwaway sqlite file, so everything measured is our own orchestration overhead.
+
+    python -m benchmarks.run                          # all benchmarks, results printed as json
+    python -m benchmarks.run dag --output out.json
+    python -m benchmarks.run --baseline old.json      # exit 1 if anything got > 20% slower
+
+run from the repository root.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from benchmarks.fake_engine import FakeEngine
+from benchmarks.fakes import (git_env, make_repo, seed_database, start_allocator, start_github_api,
+                              synthetic_config)
+from zeus_ci import config, Status
+
+# metrics compared against a baseline, all are durations so bigger is worse
+timing_metrics = ('wall_sec', 'p50_sec', 'p95_sec', 'cold_sec', 'dispatch_all_sec', 'drain_sec')
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * percent / 100), len(values) - 1)]
+
+
+class Harness:
+    """
+    points every runner path (docker socket, caches, logs, workspaces, allocator, git remotes) at
+    fakes under one temporary directory
+    """
+    def __init__(self):
+        self.root = tempfile.mkdtemp(prefix='zeus-ci-bench-')
+        self.engine = FakeEngine(os.path.join(self.root, 'docker.sock'), os.path.join(self.root, 'containers'))
+        self.engine.start()
+        self.allocator, self.allocations = start_allocator()
+        os.environ.update(git_env(os.path.join(self.root, 'remotes')))
+
+        config.runner = config.runner or {}
+        config.runner.update({
+            'docker_executor': 'engine',
+            'docker_host': 'unix://{}'.format(self.engine.socket_path),
+            'plan_cache_dir': os.path.join(self.root, 'plans'),
+            'git_mirror': {'dir': os.path.join(self.root, 'mirrors')},
+            'container_pool': {'enabled': False, 'state_dir': os.path.join(self.root, 'pool')},
+            'dependency_cache': {'dir': os.path.join(self.root, 'dependencies')},
+            'job_results': {'enabled': False},  # every build is of the same commit, none would run
+            'logs': {'dir': os.path.join(self.root, 'logs')},
+            'reaper': {'state_dir': os.path.join(self.root, 'owners')},
+        })
+        config.resource_allocator = {'address': 'localhost', 'port': self.allocator.port}
+
+        from zeus_ci import runner
+        self.runner = runner
+        runner.DockerContainer.workspace_dir = os.path.join(self.root, 'workspace')
+        runner.Workflow.build_log_location = os.path.join(self.root, 'logs')
+        os.makedirs(runner.DockerContainer.workspace_dir, exist_ok=True)
+
+    def close(self) -> None:
+        self.allocator.close()
+        self.engine.stop()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def bench_dag(harness: Harness, stages: int, width: int, threads: int, repeat: int) -> Dict[str, float]:
+    """
+    Workflow.run over a generated DAG of no-op stages
+    """
+    from zeus_ci.build_plan import BuildPlan
+    plan = BuildPlan.compile(synthetic_config(stages, width))
+    walls = []
+    for build_id in range(repeat):
+        workflow = harness.runner.Workflow('bench', 'dag-{}'.format(build_id), plan.workflows['bench'],
+                                           'https://github.com/bench/dag.git', threads,
+                                           env_vars=['ZEUS_USERNAME=bench'])
+        start = time.time()
+        status = workflow.run()
+        walls.append(time.time() - start)
+        if status != Status.passed:
+            raise RuntimeError('dag benchmark build {}: {}'.format(status, workflow.status_string))
+    return {'stages': stages, 'width': width, 'threads': threads, 'repeat': repeat,
+            'wall_sec': statistics.median(walls), 'min_sec': min(walls),
+            'stages_per_sec': stages / statistics.median(walls),
+            'peak_containers': harness.allocations.peak}
+
+
+def bench_runner_main(harness: Harness, builds: int, stages: int, threads: int) -> Dict[str, float]:
+    """
+    runner.main end to end: mirror fetch, plan load, checkout export and the workflows
+    """
+    repo_slab = 'bench/main'
+    commit = make_repo(os.path.join(harness.root, 'remotes'), repo_slab, synthetic_config(stages, stages))
+    latencies = []
+    for build_id in range(builds):
+        start = time.time()
+        status = harness.runner.main(repo_slab, 'main-{}'.format(build_id), env_vars=['ZEUS_BRANCH=master'],
+                                     threads=threads, ref=commit)
+        latencies.append(time.time() - start)
+        if status != Status.passed:
+            raise RuntimeError('runner.main benchmark build {} {}'.format(build_id, status))
+    # the first build pays for the mirror clone and plan compile
+    warm = latencies[1:] or latencies
+    return {'builds': builds, 'stages': stages, 'threads': threads, 'cold_sec': latencies[0],
+            'p50_sec': _percentile(warm, 50), 'p95_sec': _percentile(warm, 95),
+            'builds_per_sec': len(warm) / sum(warm)}
+
+
+def _run_coordinator(sqlalchemy_args: dict, concurrent_builds: int, poll_sec: float, notify_socket: str,
+                     dispatch_log: str, mode: str = 'processes') -> None:
+    from zeus_ci import build_coordinator
+
+    class FakeStatusReporter:
+        def report(self, build, status, description=None):
+            pass
+
+        def flush(self, timeout=None):
+            return True
+
+    def fake_main(repo_slab, build_id, **kwargs):
+        with open(dispatch_log, 'a') as f:
+            f.write('{} {}\n'.format(build_id, time.time()))
+        return Status.passed
+
+    async def fake_main_async(repo_slab, build_id, **kwargs):
+        return fake_main(repo_slab, build_id, **kwargs)
+
+    build_coordinator.status_reporter = FakeStatusReporter
+    build_coordinator.runner.main = fake_main
+    build_coordinator.runner.main_async = fake_main_async
+    multiprocessing.set_start_method('fork', force=True)
+    coordinator_class = build_coordinator.AsyncBuildCoordinator if mode == 'asyncio' \
+        else build_coordinator.BuildCoordinator
+    coordinator = coordinator_class(dict(sqlalchemy_args=sqlalchemy_args,
+                                         concurrent_builds=concurrent_builds,
+                                         build_poll_sec=poll_sec,
+                                         notify_socket=notify_socket,
+                                         auto_cancel=False))  # the builds share a branch
+    coordinator.run()
+
+
+def bench_dispatch(harness: Harness, builds: int, concurrent_builds: int, poll_sec: float,
+                   mode: str = 'processes') -> Dict[str, float]:
+    """
+    BuildCoordinator.run picking builds up from the database and handing them to runner.main
+    (stubbed out, so this is purely queueing and dispatch). Builds are notified the way the listener
+    does, `poll_sec` is the coordinator's fallback poll. `mode` is the coordinator's, processes or
+    asyncio
+    """
+    from zeus_ci.build_notifier import notify_build
+    from zeus_ci.persistence import Database
+
+    sqlalchemy_args = {'protocol': 'sqlite', 'protocol_args': os.path.join(harness.root, 'zeus-ci.db')}
+    database = Database(**sqlalchemy_args)
+    dispatch_log = os.path.join(harness.root, 'dispatched')
+    open(dispatch_log, 'w').close()
+    notify_socket = os.path.join(harness.root, 'coordinator.sock')
+
+    # forked so the coordinator (and its build processes) inherit the harness config and the stubs
+    coordinator = multiprocessing.get_context('fork').Process(target=_run_coordinator,
+                                                              args=(sqlalchemy_args, concurrent_builds, poll_sec,
+                                                                    notify_socket, dispatch_log, mode))
+    coordinator.start()
+    try:
+        time.sleep(1)  # let the coordinator reach its main loop
+        created = time.time()
+        build_ids = seed_database(database, 'bench/dispatch', '0' * 40, builds)
+        for build_id in build_ids:
+            notify_build(build_id, notify_socket)
+        dispatched = []
+        deadline = created + max(60, poll_sec * 3)
+        while time.time() < deadline:
+            time.sleep(0.05)
+            with open(dispatch_log) as f:
+                dispatched = [line.split() for line in f]
+            if len({build_id for build_id, _ in dispatched}) >= len(build_ids):
+                break
+        counts = {}
+        for build_id, _ in dispatched:
+            counts[build_id] = counts.get(build_id, 0) + 1
+        latencies = [float(at) - created for _, at in dispatched]
+    finally:
+        os.kill(coordinator.pid, signal.SIGINT)
+        coordinator.join(10)
+        if coordinator.is_alive():
+            coordinator.terminate()
+
+    if len(counts) < len(build_ids):
+        raise RuntimeError('only {} of {} builds were dispatched'.format(len(counts), len(build_ids)))
+    return {'builds': builds, 'concurrent_builds': concurrent_builds, 'poll_sec': poll_sec, 'mode': mode,
+            'dispatch_all_sec': max(latencies), 'p50_sec': _percentile(latencies, 50),
+            'p95_sec': _percentile(latencies, 95), 'duplicate_dispatches': len(dispatched) - len(counts)}
+
+
+def bench_agents(harness: Harness, agents: int, slots: int, builds: int, stages: int,
+                 threads: int) -> Dict[str, float]:
+    """
+    runner.main with its stages placed on `agents` build agents served from this process, all on
+    the fake engine, so this is placement and the rpyc round trips of running and logging remotely
+    """
+    from zeus_ci import agent
+    from zeus_ci.log_store import LogReader, LogStore
+
+    served = [agent.serve('bench-agent-{}'.format(number), 'localhost', 0, slots, check_in_sec=0.5)
+              for number in range(agents)]
+    config.runner['agents'] = {'enabled': True, 'poll_sec': 0.05}
+    try:
+        deadline = time.time() + 10
+        while len(harness.allocations.agents.agents()) < agents:
+            if time.time() > deadline:
+                raise RuntimeError('the agents never checked in')
+            time.sleep(0.1)
+
+        repo_slab = 'bench/agents'
+        commit = make_repo(os.path.join(harness.root, 'remotes'), repo_slab, synthetic_config(stages, stages))
+        latencies = []
+        for build_id in range(builds):
+            start = time.time()
+            status = harness.runner.main(repo_slab, 'agents-{}'.format(build_id), env_vars=['ZEUS_BRANCH=master'],
+                                         threads=threads, ref=commit)
+            latencies.append(time.time() - start)
+            if status != Status.passed:
+                raise RuntimeError('agents benchmark build {} {}'.format(build_id, status))
+        for workflow_name, stage_names in LogStore().stages('agents-0').items():
+            for stage_name in stage_names:
+                if not LogReader(LogStore().path('agents-0', workflow_name, stage_name)).size:
+                    raise RuntimeError('no log streamed back for {}/{}'.format(workflow_name, stage_name))
+    finally:
+        config.runner['agents'] = {'enabled': False}
+        for server, stopping in served:
+            stopping.set()
+            server.close()
+
+    stages_run = [server.service.stages_run for server, _ in served]
+    if sum(stages_run) != builds * stages:
+        raise RuntimeError('{} of {} stages ran on agents'.format(sum(stages_run), builds * stages))
+    warm = latencies[1:] or latencies
+    return {'agents': agents, 'slots': slots, 'builds': builds, 'stages': stages, 'threads': threads,
+            'cold_sec': latencies[0], 'p50_sec': _percentile(warm, 50), 'p95_sec': _percentile(warm, 95),
+            'min_agent_stages': min(stages_run), 'max_agent_stages': max(stages_run)}
+
+
+def bench_status(harness: Harness, commits: int, failures: int) -> Dict[str, float]:
+    """
+    StatusReporter against FakeGithubAPI: every commit is reported pending, running's pending again
+    and then passed straight away, as a coordinator would, with the first `failures` requests failing
+    """
+    from types import SimpleNamespace
+    from zeus_ci.scm_reporter import GithubStatus, StatusReporter
+
+    api = start_github_api(failures)
+    try:
+        reporter = StatusReporter(api_url=api.url, backoff_sec=0.05)
+        report_sec = []
+        start = time.time()
+        for number in range(commits):
+            build = SimpleNamespace(repo=SimpleNamespace(name='bench/status', user=SimpleNamespace(token='bench')),
+                                    commit='{:040x}'.format(number))
+            for status in (GithubStatus.pending, GithubStatus.pending, GithubStatus.success):
+                reported = time.time()
+                reporter.report(build, status)
+                report_sec.append(time.time() - reported)
+        if not reporter.flush(timeout=60):
+            raise RuntimeError('statuses were still queued after 60s')
+        drain_sec = time.time() - start
+    finally:
+        api.close()
+
+    final = {sha: states[-1] for sha, states in api.statuses.items()}
+    if len(final) != commits or set(final.values()) != {'success'}:
+        raise RuntimeError('final commit statuses {}'.format(final))
+    return {'commits': commits, 'failures': failures, 'drain_sec': drain_sec,
+            'max_report_sec': max(report_sec), 'requests': api.requests, 'statuses_sent': reporter.sent,
+            'merged': reporter.merged}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for name, metrics in results['benchmarks'].items():
+        for metric in timing_metrics:
+            old, new = baseline.get('benchmarks', {}).get(name, {}).get(metric), metrics.get(metric)
+            if old and new and new > old * (1 + tolerance):
+                regressions.append('{}.{}: {:.3f}s -> {:.3f}s'.format(name, metric, old, new))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Zeus-CI offline benchmarks')
+    parser.add_argument('benchmarks', nargs='*', help='any of dag, runner, dispatch, agents, status (default all)')
+    parser.add_argument('--output', help='write results json here rather than stdout')
+    parser.add_argument('--baseline', help='results json to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown against the baseline')
+    parser.add_argument('--dag-stages', type=int, default=200)
+    parser.add_argument('--dag-width', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--runner-builds', type=int, default=10)
+    parser.add_argument('--runner-stages', type=int, default=4)
+    parser.add_argument('--dispatch-builds', type=int, default=50)
+    parser.add_argument('--concurrent-builds', type=int, default=4)
+    parser.add_argument('--poll-sec', type=float, default=10)
+    parser.add_argument('--coordinator-mode', choices=('processes', 'asyncio'), default='processes')
+    parser.add_argument('--agents', type=int, default=3)
+    parser.add_argument('--agent-slots', type=int, default=2)
+    parser.add_argument('--status-commits', type=int, default=5)
+    parser.add_argument('--status-failures', type=int, default=3)
+    args = parser.parse_args()
+    selected = args.benchmarks or ['dag', 'runner', 'dispatch', 'agents', 'status']
+    unknown = set(selected) - {'dag', 'runner', 'dispatch', 'agents', 'status'}
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except FileNotFoundError:
+        commit = None
+    results = {'started': time.time(), 'commit': commit, 'python': platform.python_version(),
+               'platform': platform.platform(), 'cpus': os.cpu_count(), 'benchmarks': {}}
+
+    harness = Harness()
+    try:
+        if 'dag' in selected:
+            results['benchmarks']['dag'] = bench_dag(harness, args.dag_stages, args.dag_width, args.threads,
+                                                     args.repeat)
+        if 'runner' in selected:
+            results['benchmarks']['runner'] = bench_runner_main(harness, args.runner_builds, args.runner_stages,
+                                                                args.threads)
+        if 'dispatch' in selected:
+            results['benchmarks']['dispatch'] = bench_dispatch(harness, args.dispatch_builds,
+                                                               args.concurrent_builds, args.poll_sec,
+                                                               args.coordinator_mode)
+        if 'agents' in selected:
+            results['benchmarks']['agents'] = bench_agents(harness, args.agents, args.agent_slots,
+                                                           args.runner_builds, args.runner_stages * 3, args.threads)
+        if 'status' in selected:
+            results['benchmarks']['status'] = bench_status(harness, args.status_commits, args.status_failures)
+    finally:
+        harness.close()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression: {}'.format(regression), file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
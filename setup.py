@@ -38,6 +38,7 @@ setup(
         zeus-ci-buildcoordinator=zeus_ci.build_coordinator:main
         zeus-ci-listener=zeus_ci.listeners:main
         zeus-ci-resource-allocator=zeus_ci.resource_allocator:main
+        zeus-ci-agent=zeus_ci.agent:main
         zeus-cli=zeus_ci.cli:main
     """,
 )
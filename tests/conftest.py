@@ -0,0 +1,48 @@
+import itertools
+import os
+
+import pytest
+
+from benchmarks.run import Harness
+from zeus_ci.build_plan import BuildPlan
+
+_build_ids = itertools.count(1)
+
+
+@pytest.fixture(scope='session')
+def harness():
+    """
+    the benchmark fakes: FakeEngine for docker, the stub allocator and every runner path under one
+    temporary directory
+    """
+    harness = Harness()
+    yield harness
+    harness.close()
+
+
+@pytest.fixture
+def allocations(harness):
+    harness.allocations.limit = None
+    yield harness.allocations
+    harness.allocations.limit = None
+
+
+def job(command: str, **spec) -> dict:
+    return dict({'docker': [{'image': 'zeus-ci/test:latest'}], 'steps': [{'run': {'command': command}}]}, **spec)
+
+
+def workflow(harness, jobs: dict, stages: list, threads: int = 1, env_vars: list = None, **kwargs):
+    """
+    a Workflow named `wf` over `jobs`, run by ZEUS_USERNAME=tests on branch master unless `env_vars` says otherwise
+    """
+    plan = BuildPlan.compile({'jobs': jobs, 'workflows': {'wf': {'stages': stages}}})
+    env_vars = ['ZEUS_USERNAME=tests', 'ZEUS_BRANCH=master', 'ZEUS_TAG=""'] if env_vars is None else env_vars
+    return harness.runner.Workflow('wf', next(_build_ids), plan.workflows['wf'], 'https://github.com/tests/repo.git',
+                                   threads, env_vars=env_vars, **kwargs)
+
+
+def read_lines(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return f.read().split()
@@ -0,0 +1,115 @@
+import threading
+import time
+
+import pytest
+
+from benchmarks.fakes import seed_database
+from zeus_ci import Status
+from zeus_ci.build_coordinator import AsyncBuildCoordinator
+from zeus_ci.persistence import Build
+
+
+@pytest.fixture
+def coordinators(harness, tmp_path):
+    """
+    makes coordinators sharing one database, their builds run in this process
+    """
+    args = {'protocol': 'sqlite', 'protocol_args': str(tmp_path / 'zeus-ci.db')}
+    made = []
+
+    def coordinator(**in_config):
+        coordinator_config = {'sqlalchemy_args': dict(args), 'cancel_poll_sec': 0.05,
+                              'queue_stats_dir': str(tmp_path / 'queue')}
+        coordinator_config.update(in_config)
+        coordinator = AsyncBuildCoordinator(coordinator_config)
+        made.append(coordinator)
+        return coordinator
+    yield coordinator
+    for coordinator in made:
+        coordinator.database_executor.shutdown()
+        coordinator.stage_executor.shutdown()
+
+
+@pytest.fixture
+def build_id(coordinators):
+    return seed_database(coordinators().database, 'tests/repo', 'a' * 40, 1)[0]
+
+
+def get(coordinator, build_id: int) -> Build:
+    with coordinator.database.get_session() as session:
+        build = session.query(Build).filter_by(id=build_id).one()
+        session.expunge(build)
+        return build
+
+
+def test_only_one_coordinator_claims_a_build(coordinators, build_id):
+    first, second = coordinators(), coordinators()
+    with first.database.get_session() as session:
+        assert first._claim(session, build_id)
+    with second.database.get_session() as session:
+        assert not second._claim(session, build_id)
+    build = get(first, build_id)
+    assert (build.status, build.owner) == (Status.starting, first.owner)
+    assert build.lease_expires > time.time()
+
+
+def test_expired_leases_are_reclaimed(coordinators, build_id):
+    crashed, other = coordinators(lease_sec=-1), coordinators()
+    healthy_id = seed_database(other.database, 'tests/repo', 'a' * 40, 1)[0]
+    with crashed.database.get_session() as session:
+        assert crashed._claim(session, build_id)
+    with other.database.get_session() as session:
+        assert other._claim(session, healthy_id)
+        other._reclaim_expired(session)
+    reclaimed = get(other, build_id)
+    assert (reclaimed.status, reclaimed.owner, reclaimed.lease_expires) == (Status.created, None, None)
+    assert get(other, healthy_id).status == Status.starting
+    # the crashed coordinator has lost it
+    with crashed.database.get_session() as session:
+        assert crashed._renew_lease(session, build_id) is False
+        assert not crashed._set_status(session, session.query(Build).get(build_id), Status.passed)
+
+
+def test_renewing_fails_once_the_build_is_cancelled(coordinators, build_id):
+    coordinator = coordinators()
+    with coordinator.database.get_session() as session:
+        assert coordinator._claim(session, build_id)
+        assert coordinator._renew_lease(session, build_id) is True
+        session.query(Build).filter_by(id=build_id).update({Build.status: Status.cancelled})
+        session.commit()
+        assert coordinator._renew_lease(session, build_id) is False
+
+
+def test_the_lease_is_renewed_while_a_timed_out_build_unwinds(coordinators, build_id):
+    coordinator = coordinators(lease_sec=1)
+    with coordinator.database.get_session() as session:
+        assert coordinator._claim(session, build_id)
+    cancel, done = threading.Event(), threading.Event()
+    watcher = threading.Thread(target=coordinator._watch_build, args=(build_id, cancel, done, time.time()))
+    watcher.start()
+    try:
+        assert cancel.wait(5)
+        time.sleep(1.5)  # longer than the lease
+        with coordinator.database.get_session() as session:
+            coordinator._reclaim_expired(session)
+        assert get(coordinator, build_id).owner == coordinator.owner
+    finally:
+        done.set()
+        watcher.join()
+
+
+def test_the_watcher_cancels_a_build_whose_lease_was_lost(coordinators, build_id):
+    coordinator = coordinators()
+    with coordinator.database.get_session() as session:
+        assert coordinator._claim(session, build_id)
+        session.query(Build).filter_by(id=build_id).update({Build.owner: 'someone-else'})
+        session.commit()
+    cancel, done = threading.Event(), threading.Event()
+    watcher = threading.Thread(target=coordinator._watch_build, args=(build_id, cancel, done))
+    watcher.start()
+    try:
+        assert cancel.wait(5)
+    finally:
+        done.set()
+        watcher.join()
+    assert get(coordinator, build_id).owner == 'someone-else'
@@ -0,0 +1,91 @@
+import pytest
+
+from tests.conftest import job
+from zeus_ci.build_plan import BuildPlan, PathFilter, WorkflowConfigError
+
+
+def compile_stages(stages: list, jobs: dict = None) -> BuildPlan:
+    jobs = jobs or {name: job('true') for name in ('a', 'b', 'c')}
+    return BuildPlan.compile({'jobs': jobs, 'workflows': {'wf': {'stages': stages}}})
+
+
+@pytest.mark.parametrize('spec, path, matches', [
+    (['src'], 'src/main.py', True),
+    (['src'], 'srcs/main.py', False),
+    (['*.py'], 'main.py', True),
+    (['*.py'], 'src/main.py', False),
+    (['**/*.py'], 'src/deep/main.py', True),
+    (['**/*.py'], 'main.py', True),
+    (['docs/?.md'], 'docs/a.md', True),
+    (['docs/?.md'], 'docs/ab.md', False),
+    (['/src/**'], 'src/a/b', True),
+    (['src', '!src/vendor'], 'src/vendor/lib.py', False),
+    (['!docs'], 'src/main.py', True),
+    (['!docs'], 'docs/index.md', False),
+    ({'include': 'api/**', 'exclude': ['**/*.md']}, 'api/v1/handler.go', True),
+    ({'include': 'api/**', 'exclude': ['**/*.md']}, 'api/README.md', False),
+])
+def test_path_filter(spec, path, matches):
+    assert PathFilter.compile(spec).matches(path) is matches
+
+
+def test_paths_skip_stages_and_their_dependents():
+    plan = compile_stages([{'a': {'run_when': {'paths': ['frontend/**']}}}, {'b': {'requires': ['a']}},
+                           {'c': {'run_when': {'paths': ['backend', '!backend/docs']}}}])
+    workflow = plan.workflows['wf']
+    assert set(workflow.resolve('master', None, ['backend/api.py'])) == {'a', 'b'}
+    assert set(workflow.resolve('master', None, ['backend/docs/x.md', 'frontend/app.js'])) == {'c'}
+    assert workflow.resolve('master', None, ['frontend/app.js', 'backend/api.py']) == {}
+    # nothing is ruled out when the changed files aren't known
+    assert workflow.resolve('master', None, None) == {}
+    assert 'requires a' in workflow.resolve('master', None, [])['b']
+
+
+def test_paths_combine_with_branch():
+    plan = compile_stages([{'a': {'run_when': {'branch': '^master$', 'paths': ['src']}}}])
+    assert plan.workflows['wf'].resolve('master', None, ['src/a']) == {}
+    assert 'branch' in plan.workflows['wf'].resolve('feature', None, ['src/a'])['a']
+    assert 'paths' in plan.workflows['wf'].resolve('master', None, ['docs/a'])['a']
+
+
+def test_resolved_plan_lists_skipped_stages():
+    execution = compile_stages([{'a': {'run_when': {'paths': ['src']}}}, 'b']).resolve('master', None, ['docs/a'])
+    assert not execution.runs('wf', 'a')
+    assert execution.runs('wf', 'b')
+    assert 'a' in execution.describe()
+
+
+@pytest.mark.parametrize('raw, message', [
+    ({'jobs': {}}, 'both a `jobs` and a `workflows`'),
+    ({'jobs': {'a': {'steps': []}}, 'workflows': {}}, 'no docker image'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {}}}, 'needs a `stages` list'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': 'a'}}}, 'needs a `stages` list'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {}, 'b': {}}]}}}, 'invalid stage'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': 'b'}]}}}, 'invalid stage'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': ['x']}}}, 'unknown job "x"'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {'requires': 'b'}}]}}}, 'list of stage'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {'requires': ['x']}}]}}},
+     'requires unknown stage "x"'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {'run_when': ['x']}}]}}},
+     'must be a mapping'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {'run_when': {'branch': '('}}}]}}},
+     'invalid run_when.branch'),
+    ({'jobs': {'a': job('true')}, 'workflows': {'wf': {'stages': [{'a': {'run_when': {'paths': 1}}}]}}},
+     'invalid run_when.paths'),
+    ({'jobs': {'a': job('true', parallelism=0)}, 'workflows': {'wf': {'stages': ['a']}}}, 'parallelism'),
+])
+def test_invalid_configs_raise_workflow_config_error(raw, message):
+    with pytest.raises(WorkflowConfigError, match=message):
+        BuildPlan.compile(raw)
+
+
+def test_requires_cycles_are_rejected():
+    with pytest.raises(WorkflowConfigError, match='cycle between: a, b'):
+        compile_stages([{'a': {'requires': ['b']}}, {'b': {'requires': ['a']}}, 'c'])
+
+
+def test_requiring_a_parallel_job_waits_for_its_shards():
+    plan = compile_stages(['a', {'b': {'requires': ['a']}}], {'a': job('true', parallelism=3), 'b': job('true')})
+    stages = {stage.name: stage for stage in plan.workflows['wf'].stages}
+    assert stages['b'].requires == ['a.0', 'a.1', 'a.2']
+    assert [(stages[name].node_index, stages[name].node_total) for name in ('a.0', 'a.2')] == [(0, 3), (2, 3)]
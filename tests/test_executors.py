@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from benchmarks.fake_engine import FakeEngine
+from zeus_ci.executors import DockerEngineError, DockerEngineExecutor
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = FakeEngine(str(tmp_path / 'docker.sock'), str(tmp_path / 'containers')).start()
+    yield engine
+    engine.stop()
+
+
+@pytest.fixture
+def executor(engine):
+    executor = DockerEngineExecutor(engine.socket_path)
+    assert executor.run_container('c1', 'zeus-ci/test:latest')
+    return executor
+
+
+def test_exec_demultiplexes_stdout_and_stderr(executor):
+    out = executor.exec('c1', 'printf out; printf err >&2; printf more; exit 3')
+    assert (out.stdout, out.stderr, out.returncode) == ('outmore', 'err', 3)
+
+
+def test_exec_streams_every_frame_to_the_sink(executor):
+    received = {1: [], 2: []}
+    out = executor.exec('c1', 'head -c 300000 /dev/zero; echo done >&2',
+                        sink=lambda stream, data: received[stream].append(data))
+    assert out
+    assert len(b''.join(received[1])) == 300000
+    assert b''.join(received[2]) == b'done\n'
+
+
+def test_exec_passes_env_and_workdir(executor, engine):
+    os.makedirs(os.path.join(engine.containers['c1']['root'], 'src'))
+    out = executor.exec('c1', 'echo $GREETING; basename $(pwd)', env=['GREETING=hi'],
+                        workdir=os.path.join(engine.containers['c1']['root'], 'src'))
+    assert out.stdout.split() == ['hi', 'src']
+
+
+def test_exec_exit_code_gives_up_at_the_deadline(executor, engine):
+    exec_id = executor._call('POST', '/containers/c1/exec', body={'Cmd': ['true']})['Id']
+    engine.execs[exec_id]['Running'] = True  # an exec docker never finishes
+    executor.exit_code_timeout_sec = 0.2
+    with pytest.raises(DockerEngineError, match='no exit code'):
+        executor._exec_exit_code(exec_id, 'c1')
+
+
+def test_exec_exit_code_stops_once_the_container_has(executor, engine):
+    exec_id = executor._call('POST', '/containers/c1/exec', body={'Cmd': ['true']})['Id']
+    engine.execs[exec_id]['Running'] = True
+    engine.containers['c1']['running'] = False
+    with pytest.raises(DockerEngineError, match='stopped before exec'):
+        executor._exec_exit_code(exec_id, 'c1')
+
+
+def test_exec_in_a_removed_container_fails(executor):
+    assert executor.remove('c1')
+    out = executor.exec('c1', 'true')
+    assert not out
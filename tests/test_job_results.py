@@ -0,0 +1,83 @@
+import pytest
+
+from tests.conftest import job, workflow
+from zeus_ci import config, Status
+from zeus_ci.build_plan import BuildPlan
+from zeus_ci.job_results import result_key
+
+commit = 'a' * 40
+master = ['ZEUS_USERNAME=tests', 'ZEUS_BRANCH=master', 'ZEUS_TAG=""']
+tagged = ['ZEUS_USERNAME=tests', 'ZEUS_BRANCH=master', 'ZEUS_TAG=v1.0']
+other_branch = ['ZEUS_USERNAME=tests', 'ZEUS_BRANCH=feature', 'ZEUS_TAG=""']
+
+
+def key(spec: dict, env_vars: list, run_when: dict = None) -> str:
+    stage = BuildPlan.compile({'jobs': {'a': spec}, 'workflows': {'wf': {'stages': [
+        {'a': {'run_when': run_when}} if run_when else 'a']}}}).workflows['wf'].stages[0]
+    return result_key(commit, stage.job, env_vars, stage.run_condition, stage.node_index, stage.node_total)
+
+
+def test_result_key_covers_the_ref_by_default():
+    assert key(job('make'), master) == key(job('make'), list(reversed(master)))
+    assert key(job('make'), master) != key(job('make'), tagged)
+    assert key(job('make'), master) != key(job('make'), other_branch)
+
+
+def test_result_key_ignores_the_ref_when_reuse_across_refs():
+    spec = job('make', reuse_across_refs=True)
+    assert key(spec, master) == key(spec, tagged) == key(spec, other_branch)
+
+
+def test_result_key_keeps_refs_a_reusable_job_depends_on():
+    assert key(job('make', reuse_across_refs=True), master, {'branch': '.*'}) != \
+        key(job('make', reuse_across_refs=True), other_branch, {'branch': '.*'})
+    spec = job('make $ZEUS_TAG', reuse_across_refs=True)
+    assert key(spec, master) != key(spec, tagged)
+    assert key(spec, master) == key(spec, other_branch)
+
+
+def test_result_key_covers_commit_spec_env_and_shard():
+    plan = BuildPlan.compile({'jobs': {'a': job('make', parallelism=2)}, 'workflows': {'wf': {'stages': ['a']}}})
+    first, second = plan.workflows['wf'].stages
+    assert result_key(commit, first.job, master, {}, 0, 2) != result_key(commit, second.job, master, {}, 1, 2)
+    assert result_key(commit, first.job, master, {}, 0, 2) != result_key('b' * 40, first.job, master, {}, 0, 2)
+    assert key(job('make'), master) != key(job('make test'), master)
+    assert key(job('make'), master) != key(job('make'), master + ['SECRET=1'])
+
+
+@pytest.fixture
+def results(harness, monkeypatch, tmp_path):
+    monkeypatch.setitem(config.runner, 'job_results', {'enabled': True, 'dir': str(tmp_path / 'results')})
+
+
+def run(harness, spec: dict, env_vars: list, build_commit: str = commit):
+    wf = workflow(harness, {'a': spec}, ['a'], env_vars=env_vars, commit=build_commit)
+    assert wf.run() == Status.passed
+    return wf.stages['a'].reused_from
+
+
+def test_a_passed_job_is_reused_for_the_same_commit(harness, allocations, results):
+    assert run(harness, job('true'), master) is None
+    reused = run(harness, job('true'), master)
+    assert reused['stage'] == 'a'
+    assert run(harness, job('true'), master, 'b' * 40) is None
+
+
+def test_a_tag_build_reruns_jobs_unless_they_opt_in(harness, allocations, results):
+    assert run(harness, job('true'), master) is None
+    assert run(harness, job('true'), tagged) is None
+    spec = job('true', reuse_across_refs=True)
+    assert run(harness, spec, master) is None
+    assert run(harness, spec, tagged) is not None
+    assert run(harness, spec, other_branch) is not None
+
+
+def test_failed_and_workspace_jobs_are_not_reused(harness, allocations, results):
+    for _ in range(2):
+        wf = workflow(harness, {'a': job('exit 1')}, ['a'], env_vars=master, commit=commit)
+        assert wf.run() == Status.failed
+        assert wf.stages['a'].reused_from is None
+    spec = job('mkdir -p out && touch out/f')
+    spec['steps'].append({'persist_to_workspace': {'root': 'out', 'paths': ['f']}})
+    assert run(harness, spec, master) is None
+    assert run(harness, spec, master) is None
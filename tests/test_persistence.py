@@ -0,0 +1,60 @@
+import pytest
+
+from zeus_ci import Status
+from zeus_ci.persistence import Build, Database, Repo, payload_commit_limit
+
+
+@pytest.fixture
+def session(tmp_path):
+    session = Database(protocol='sqlite', protocol_args=str(tmp_path / 'zeus-ci.db')).get_session()
+    session.add(Repo(name='tests/repo', scm='github'))
+    session.commit()
+    yield session
+    session.close()
+
+
+def push(session, before: str, after: str, files: list, status: Status = Status.created,
+         ref: str = 'refs/heads/master') -> Build:
+    build = Build(repo_name='tests/repo', ref=ref, commit=after, status=status,
+                  json={'before': before, 'after': after, 'commits': [{'modified': files}]})
+    session.add(build)
+    session.commit()
+    return build
+
+
+def test_changed_files_come_from_the_payload():
+    build = Build(json={'commits': [{'added': ['b'], 'modified': ['a']}, {'removed': ['c'], 'modified': ['a']}]})
+    assert build.changed_files() == ['a', 'b', 'c']
+    assert Build(json={'commits': []}).changed_files() is None
+    assert Build(json={'commits': [{'modified': ['a']}] * payload_commit_limit}).changed_files() is None
+
+
+def test_push_base_of_new_refs_is_none():
+    assert Build(json={'before': '0' * 40}).push_base() is None
+    assert Build(json={'before': 'a' * 40}).push_base() == 'a' * 40
+
+
+def test_nothing_is_filtered_for_a_ref_never_built(session):
+    first = push(session, '0' * 40, 'a' * 40, ['x'])
+    assert first.changes_since_tested(session) == (None, None)
+
+
+def test_payload_files_are_used_when_the_push_follows_the_tested_commit(session):
+    push(session, '0' * 40, 'a' * 40, ['x'], Status.passed)
+    build = push(session, 'a' * 40, 'b' * 40, ['backend/y'])
+    assert build.changes_since_tested(session) == (['backend/y'], 'a' * 40)
+
+
+def test_pushes_whose_builds_didnt_finish_are_diffed_from_the_last_tested_commit(session):
+    push(session, '0' * 40, 'a' * 40, ['x'], Status.failed)
+    push(session, 'a' * 40, 'b' * 40, ['frontend/x'], Status.cancelled)
+    push(session, 'b' * 40, 'c' * 40, ['frontend/z'], Status.error)
+    build = push(session, 'c' * 40, 'd' * 40, ['backend/y'])
+    assert build.changes_since_tested(session) == (None, 'a' * 40)
+
+
+def test_only_earlier_builds_of_the_same_ref_count(session):
+    push(session, '0' * 40, 'a' * 40, ['x'], Status.passed, ref='refs/heads/other')
+    build = push(session, '0' * 40, 'b' * 40, ['y'])
+    push(session, 'b' * 40, 'c' * 40, ['z'], Status.passed)
+    assert build.changes_since_tested(session) == (None, None)
@@ -0,0 +1,78 @@
+import threading
+
+from tests.conftest import job, read_lines, workflow
+from zeus_ci import Status
+
+
+def states(wf) -> dict:
+    return {name: stage.state for name, stage in wf.stages.items()}
+
+
+def test_stages_run_after_what_they_require(harness, allocations, tmp_path):
+    order = tmp_path / 'order'
+
+    def record(name):
+        return job('echo {} >> {}'.format(name, order))
+
+    wf = workflow(harness, {'a': record('a'), 'b': record('b'), 'c': record('c'), 'd': record('d')},
+                  ['a', {'b': {'requires': ['a']}}, {'c': {'requires': ['a']}}, {'d': {'requires': ['b', 'c']}}],
+                  threads=2)
+    assert wf.run() == Status.passed
+    ran = read_lines(str(order))
+    assert sorted(ran) == ['a', 'b', 'c', 'd']
+    assert ran[0] == 'a' and ran[-1] == 'd'
+    assert set(states(wf).values()) == {Status.passed}
+    assert allocations.allocated == 0
+
+
+def test_dependents_of_a_failed_stage_are_skipped(harness, allocations, tmp_path):
+    order = tmp_path / 'order'
+    wf = workflow(harness, {'a': job('exit 1'), 'b': job('echo b >> {}'.format(order)), 'c': job('true')},
+                  ['a', {'b': {'requires': ['a']}}, 'c'])
+    assert wf.run() == Status.failed
+    assert states(wf) == {'a': Status.failed, 'b': Status.skipped, 'c': Status.passed}
+    assert read_lines(str(order)) == []
+
+
+def test_cancel_while_waiting_for_an_allocation(harness, allocations):
+    allocations.limit = 0  # nothing is ever allocated
+    requests = allocations.requests
+    wf = workflow(harness, {'a': job('true'), 'b': job('true')}, ['a', {'b': {'requires': ['a']}}])
+    threading.Timer(1.5, wf.cancel, args=('test', )).start()
+    assert wf.run() == Status.cancelled
+    assert states(wf) == {'a': Status.cancelled, 'b': Status.cancelled}
+    assert allocations.requests > requests
+    assert allocations.allocated == 0
+
+
+def test_cancel_reaches_running_ready_and_waiting_stages(harness, allocations, tmp_path):
+    order = tmp_path / 'order'
+
+    def record(name, command='true'):
+        return job('{}; echo {} >> {}'.format(command, name, order))
+
+    # one thread: `slow` (first, it's on the longest path) runs while `b` is ready and the rest wait
+    wf = workflow(harness, {'slow': record('slow', 'sleep 30'), 'after': record('after'), 'last': record('last'),
+                            'b': record('b'), 'c': record('c')},
+                  ['slow', {'after': {'requires': ['slow']}}, {'last': {'requires': ['after']}},
+                   'b', {'c': {'requires': ['b']}}])
+    threading.Timer(1, wf.cancel, args=('test', )).start()
+    assert wf.run() == Status.cancelled
+    assert set(states(wf).values()) == {Status.cancelled}
+    assert read_lines(str(order)) == []
+    assert allocations.allocated == 0
+
+
+def test_fail_fast_cancels_the_rest(harness, allocations):
+    plan_jobs = {'fails': job('exit 1'), 'slow': job('sleep 30')}
+    wf = workflow(harness, plan_jobs, ['fails', 'slow'], threads=2)
+    wf.fail_fast = True
+    assert wf.run() == Status.failed
+    assert wf.stages['slow'].state == Status.cancelled
+
+
+def test_stages_ruled_out_by_run_when_are_skipped_with_their_dependents(harness, allocations):
+    wf = workflow(harness, {'a': job('true'), 'b': job('true'), 'c': job('true')},
+                  [{'a': {'run_when': {'branch': '^release/'}}}, {'b': {'requires': ['a']}}, 'c'])
+    assert wf.run() == Status.passed
+    assert states(wf) == {'a': Status.skipped, 'b': Status.skipped, 'c': Status.passed}
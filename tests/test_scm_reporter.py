@@ -0,0 +1,66 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.fakes import start_github_api
+from zeus_ci.scm_reporter import GithubStatus, StatusReporter
+
+
+@pytest.fixture
+def api():
+    api = start_github_api()
+    yield api
+    api.close()
+
+
+def build(sha: str):
+    return SimpleNamespace(repo=SimpleNamespace(name='tests/repo', user=SimpleNamespace(token='tests')), commit=sha)
+
+
+def test_only_the_latest_unsent_status_of_a_commit_is_sent(api):
+    reporter = StatusReporter(api_url=api.url, backoff_sec=0.01)
+    for number in range(5):
+        for status in (GithubStatus.pending, GithubStatus.pending, GithubStatus.success):
+            reporter.report(build('{:040x}'.format(number)), status)
+    assert reporter.flush(timeout=30)
+    assert {sha: states[-1] for sha, states in api.statuses.items()} == \
+        {'{:040x}'.format(number): 'success' for number in range(5)}
+    assert reporter.sent + reporter.merged == 15
+    assert api.requests == reporter.sent
+    assert reporter.failed == 0
+
+
+def test_failed_sends_are_retried(api):
+    api.failures = 3
+    reporter = StatusReporter(api_url=api.url, backoff_sec=0.01)
+    reporter.report(build('a' * 40), GithubStatus.success)
+    assert reporter.flush(timeout=30)
+    assert api.statuses == {'a' * 40: ['success']}
+    assert (api.requests, reporter.sent, reporter.failed) == (4, 1, 0)
+
+
+def test_a_newer_status_replaces_one_waiting_to_be_retried(api):
+    api.failures = 1
+    reporter = StatusReporter(api_url=api.url, backoff_sec=5)
+    reporter.report(build('a' * 40), GithubStatus.pending)
+    while api.requests < 1:
+        time.sleep(0.01)
+    reporter.report(build('a' * 40), GithubStatus.failure)
+    assert reporter.flush(timeout=3)
+    assert api.statuses == {'a' * 40: ['failure']}
+
+
+def test_sends_are_given_up_after_max_attempts(api):
+    api.failures = 10
+    reporter = StatusReporter(api_url=api.url, max_attempts=2, backoff_sec=0.01)
+    reporter.report(build('a' * 40), GithubStatus.success)
+    assert reporter.flush(timeout=30)
+    assert (api.requests, reporter.sent, reporter.failed) == (2, 0, 1)
+
+
+def test_permanent_errors_are_not_retried(api):
+    reporter = StatusReporter(api_url=api.url, backoff_sec=0.01)
+    reporter.report(build('not-a-sha'), GithubStatus.success)  # the fake API 404s
+    assert reporter.flush(timeout=30)
+    assert (api.requests, reporter.sent, reporter.failed) == (1, 0, 1)
@@ -7,7 +7,7 @@ from zeus_ci.config import Config
 
 config = Config()
 
-Status = Enum('status', 'created starting running passed failed skipped error')
+Status = Enum('status', 'created starting running passed failed skipped error cancelled')
 
 status_from_name_mapping = {s.name: s for s in Status}
 status_from_value_mapping = {s.value: s for s in Status}
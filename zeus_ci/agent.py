@@ -0,0 +1,246 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from typing import Optional, Tuple
+
+import rpyc
+from rpyc import ThreadedServer
+from rpyc.utils.authenticators import SSLAuthenticator
+
+from zeus_ci import logger, config, Status
+from zeus_ci.agent_registry import protocol_config
+from zeus_ci.executors import TailBuffer
+from zeus_ci.git_mirror import GitMirror
+from zeus_ci.reaper import OrphanReaper
+from zeus_ci.runner import DockerContainer, Stage, StageLog, _export_checkout
+from zeus_ci.workspace import WorkspaceStore
+
+
+class RemoteStageLog(StageLog):
+    """
+    the log of a stage run for a coordinator, written straight into the coordinator's StageLog (a
+    netref) which it opens and closes itself. Only the tail is kept here
+    """
+    def __init__(self, log, tail_bytes: int = 64 * 1024):
+        self.path = log.path
+        self.tail = TailBuffer(tail_bytes)
+        self._log = log
+
+    def open(self) -> 'RemoteStageLog':
+        return self
+
+    def __call__(self, stream: int, data: bytes) -> None:
+        self._log(stream, data)
+        self.tail.write(stream, data)
+
+    def write_line(self, line: str) -> None:
+        self._log.write_line(line)
+
+    def begin_step(self, name: str) -> None:
+        self._log.begin_step(name)
+
+    def close(self) -> None:
+        pass
+
+
+class AgentService(rpyc.Service):
+    """
+    runs stages on this host's docker for coordinators elsewhere, `slots` at a time. Stages of a
+    build running here at the same time share one checkout exported from this host's mirror
+    """
+    def __init__(self, slots: int):
+        self.slots = slots
+        self._slots = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+        self.running = {}  # stage id: Stage
+        self._cancelled = set()  # ids of stages cancelled before they got a slot
+        self.images = {}  # image: when a stage last used it
+        self.stages_run = 0
+        # (clone url, ref, full history): [checkout dir, stages using it, lock held while exporting it]
+        self._checkouts = {}
+        self._checkout_lock = threading.Lock()  # guards _checkouts, never held while fetching
+        self.mirror = GitMirror()
+        self.workspace = WorkspaceStore(DockerContainer.workspace_dir)
+
+    def _checkout(self, clone_url: str, ref: str, full_history: bool = False) -> str:
+        """
+        the first stage of a build here exports its checkout, those arriving meanwhile wait for it.
+        Other builds' checkouts don't, the mirror's own lock is all fetching the same repo takes
+        """
+        with self._checkout_lock:
+            checkout = self._checkouts.get((clone_url, ref, full_history))
+            if checkout is None:
+                checkout = self._checkouts[(clone_url, ref, full_history)] = [None, 0, threading.Lock()]
+                checkout[2].acquire()
+                exporting = True
+            else:
+                exporting = False
+            checkout[1] += 1
+        if exporting:
+            try:
+                if self.mirror.enabled and self.mirror.update(clone_url):
+                    checkout[0] = _export_checkout(self.mirror, clone_url, ref, full_history=full_history)
+            finally:
+                checkout[2].release()
+        else:
+            with checkout[2]:
+                pass
+        return checkout[0]
+
+    def _release_checkout(self, clone_url: str, ref: str, full_history: bool = False) -> None:
+        with self._checkout_lock:
+            checkout = self._checkouts[(clone_url, ref, full_history)]
+            checkout[1] -= 1
+            if not checkout[1]:
+                del self._checkouts[(clone_url, ref, full_history)]
+                if checkout[0]:
+                    shutil.rmtree(checkout[0], ignore_errors=True)
+
+    def exposed_run_stage(self, request: str, log) -> Tuple[str, float]:
+        """
+        runs the stage described by `request` (json, see Stage.remote_request), streaming its output
+        into `log`
+        returns the name of the stage's final Status and how long it took
+        """
+        request = json.loads(request)
+        stage_id = '{}/{}'.format(request['exec_uuid'], request['name'])
+        with self._slots:
+            stage = Stage(request['name'], request['exec_uuid'], request['clone_url'], request['spec'],
+                          env_vars=request['env_vars'], ref=request['ref'], job_name=request['job_name'],
+                          node_index=request['node_index'], node_total=request['node_total'])
+            stage.log = RemoteStageLog(log)
+            stage.build_id = request['build_id']
+            with self._lock:
+                if stage_id in self._cancelled:
+                    self._cancelled.discard(stage_id)
+                    return Status.cancelled.name, 0
+                self.running[stage_id] = stage
+                self.stages_run += 1
+                self.images[request['spec']['docker'][0]['image']] = time.time()
+            logger.info('running %s for build %s', stage_id, request['build_id'])
+            full_history = bool(request['spec'].get('full_history'))
+            stage.checkout_dir = self._checkout(request['clone_url'], request['ref'], full_history)
+            try:
+                stage.state = Status.running
+                stage.run()
+            finally:
+                self._release_checkout(request['clone_url'], request['ref'], full_history)
+                with self._lock:
+                    del self.running[stage_id]
+            logger.info('%s %s in %.1fs', stage_id, stage.state.name, stage.duration)
+            return stage.state.name, stage.duration
+
+    def exposed_cancel_stage(self, stage_id: str) -> None:
+        with self._lock:
+            stage = self.running.get(stage_id)
+            if stage is None:
+                self._cancelled.add(stage_id)
+                return
+        stage.cancel()
+
+    def exposed_discard_workspace(self, exec_uuid: str) -> None:
+        self.workspace.discard(exec_uuid)
+        self.workspace.evict()
+
+    def advertisement(self) -> Tuple[int, int, Tuple[str, ...], Tuple[str, ...]]:
+        """
+        (slots, running stages, images used recently, repos mirrored), what the registry places by
+        """
+        with self._lock:
+            running = len(self.running)
+            images = tuple(sorted(self.images, key=self.images.get, reverse=True)[:20])
+        mirrors = tuple(name for name in os.listdir(self.mirror.root) if name.endswith('.git')) \
+            if os.path.isdir(self.mirror.root) else ()
+        return self.slots, running, images, mirrors
+
+
+def _check_in(service: AgentService, name: str, address: str, port: int, interval: float,
+              stopping: threading.Event) -> None:
+    """
+    registers with the resource allocator and keeps checking in, reconnecting when it goes away
+    """
+    allocator = None
+    while not stopping.is_set():
+        try:
+            if allocator is None:
+                allocator = rpyc.connect(config.resource_allocator.get('address', 'localhost'),
+                                         config.resource_allocator.get('port', 18861))
+            allocator.root.register_agent(name, address, port, *service.advertisement())
+        except Exception as e:
+            logger.error('checking in with the resource allocator failed: %s', e)
+            allocator = None
+        stopping.wait(interval)
+    if allocator is not None:
+        try:
+            allocator.root.unregister_agent(name)
+        except Exception:
+            pass
+        allocator.close()
+
+
+def _authenticator(ssl_config: dict = None) -> Optional[SSLAuthenticator]:
+    """
+    coordinators have to present a certificate signed by `ca_certs` when it's set
+    """
+    if not ssl_config:
+        return None
+    return SSLAuthenticator(ssl_config['keyfile'], ssl_config['certfile'], ca_certs=ssl_config.get('ca_certs'))
+
+
+def serve(name: str, address: str, port: int, slots: int, check_in_sec: float = 5, bind: str = None,
+          ssl_config: dict = None) -> Tuple[ThreadedServer, threading.Event]:
+    """
+    starts an agent's server and its check ins, in background threads. It listens on `bind`,
+    `address` by default.
+
+    whoever can connect can run anything in a container here (and call any public attribute of
+    the service), so keep it to the coordinators' network, or require their certificates with
+    `ssl_config`
+    returns the server and an event that stops checking in (and unregisters) once set
+    """
+    service = AgentService(slots)
+    server = ThreadedServer(service, hostname=bind or address, port=port, protocol_config=protocol_config,
+                            authenticator=_authenticator(ssl_config))
+    stopping = threading.Event()
+    threading.Thread(target=server.start, name='agent-{}'.format(name), daemon=True).start()
+    threading.Thread(target=_check_in, args=(service, name, address, server.port, check_in_sec, stopping),
+                     name='agent-check-in', daemon=True).start()
+    # no database here, what a previous run of the agent left behind is all there is to reap
+    reaper = OrphanReaper(workspace_dir=DockerContainer.workspace_dir)
+    if reaper.enabled:
+        threading.Thread(target=reaper.run, args=(stopping, ), name='orphan-reaper', daemon=True).start()
+    return server, stopping
+
+
+def main():
+    agent_config = config.agent or {}
+    parser = argparse.ArgumentParser(description='Zeus-CI build agent, runs stages for build coordinators')
+    parser.add_argument('--name', default=agent_config.get('name', socket.gethostname()))
+    parser.add_argument('--address', default=agent_config.get('address', socket.getfqdn()),
+                        help='address coordinators reach this agent on')
+    parser.add_argument('--bind', default=agent_config.get('bind'),
+                        help='address to listen on, --address by default (0.0.0.0 for every interface)')
+    parser.add_argument('--port', type=int, default=agent_config.get('port', 18862))
+    parser.add_argument('--slots', type=int, default=agent_config.get('slots', os.cpu_count()),
+                        help='stages to run at once')
+    args = parser.parse_args()
+
+    server, stopping = serve(args.name, args.address, args.port, args.slots, agent_config.get('check_in_sec', 5),
+                             bind=args.bind, ssl_config=agent_config.get('ssl'))
+    logger.info('agent %s serving %s slots on %s:%s', args.name, args.slots, args.address, server.port)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        logger.info('stopping agent %s', args.name)
+    finally:
+        stopping.set()
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
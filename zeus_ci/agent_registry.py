@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import rpyc
+
+from zeus_ci import logger, config
+from zeus_ci.git_mirror import GitMirror
+
+# stages run for as long as they run, rpyc's default 30s request timeout would fail most of them
+protocol_config = {'allow_public_attrs': True, 'sync_request_timeout': None}
+
+
+class AgentUnavailable(Exception):
+    pass
+
+
+def connect(address: str, port: int) -> rpyc.Connection:
+    """
+    connects to an agent, over ssl with runner.agents.ssl's key and certificate when it's set
+    """
+    ssl_config = config.runner.get('agents', {}).get('ssl')
+    if ssl_config:
+        return rpyc.ssl_connect(address, port, keyfile=ssl_config.get('keyfile'), certfile=ssl_config.get('certfile'),
+                                ca_certs=ssl_config.get('ca_certs'), config=protocol_config)
+    return rpyc.connect(address, port, config=protocol_config)
+
+
+def mirror_name(clone_url: str) -> str:
+    """
+    what agents call the mirror of `clone_url` when advertising the repos they have mirrored
+    """
+    return os.path.basename(GitMirror().path(clone_url))
+
+
+class AgentRegistry:
+    """
+    the build agents that check in with the resource allocator, and how many of their slots are
+    taken. A stage is placed on the agent with a free slot that already has its image, then the one
+    with its repo's mirror, then the one with the most free slots.
+
+    agents report the stages they're running each time they check in, which replaces our count
+    (plus whatever was placed on them since, that may not have reached them yet), so slots of
+    coordinators that died holding them come back
+    """
+    def __init__(self, timeout: float = None):
+        self.timeout = timeout or (config.resource_allocator or {}).get('agent_timeout_sec', 30)
+        self._lock = threading.Lock()
+        self._agents: Dict[str, dict] = {}
+
+    def register(self, name: str, address: str, port: int, slots: int, running: int, images, mirrors) -> None:
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is None or (agent['address'], agent['port']) != (address, port):
+                logger.info('agent %s registered at %s:%s with %s slots', name, address, port, slots)
+                agent = self._agents[name] = {'address': address, 'port': port, 'placed': 0}
+            agent.update(slots=slots, images=set(images), mirrors=set(mirrors), last_seen=time.time(),
+                         reserved=running + agent['placed'], placed=0)
+
+    def unregister(self, name: str) -> None:
+        with self._lock:
+            if self._agents.pop(name, None) is not None:
+                logger.info('agent %s unregistered', name)
+
+    def _alive(self) -> Dict[str, dict]:
+        cutoff = time.time() - self.timeout
+        for name, agent in list(self._agents.items()):
+            if agent['last_seen'] < cutoff:
+                logger.info('agent %s stopped checking in, dropping it', name)
+                del self._agents[name]
+        return self._agents
+
+    def place(self, image: str, mirror: str, pinned: str = None) -> Optional[Tuple]:
+        """
+        reserves a slot for a stage, on the `pinned` agent if given
+        returns (name, address, port) of the agent, None if every agent (or the pinned one) is
+        busy, or () if there are no agents (or the pinned one is gone)
+        """
+        with self._lock:
+            agents = self._alive()
+            if pinned is not None:
+                agents = {pinned: agents[pinned]} if pinned in agents else {}
+            if not agents:
+                return ()
+            free = [(name, agent) for name, agent in agents.items() if agent['reserved'] < agent['slots']]
+            if not free:
+                return None
+            name, agent = max(free, key=lambda item: (image in item[1]['images'], mirror in item[1]['mirrors'],
+                                                      item[1]['slots'] - item[1]['reserved'], item[0]))
+            agent['reserved'] += 1
+            agent['placed'] += 1
+            return name, agent['address'], agent['port']
+
+    def release(self, name: str) -> None:
+        with self._lock:
+            agent = self._agents.get(name)
+            if agent is not None:
+                agent['reserved'] = max(agent['reserved'] - 1, 0)
+                agent['placed'] = max(agent['placed'] - 1, 0)
+
+    def agents(self) -> Tuple:
+        """
+        ((name, address, port, slots, reserved, images, mirrors, seconds since it checked in), ...)
+        """
+        with self._lock:
+            now = time.time()
+            return tuple((name, agent['address'], agent['port'], agent['slots'], agent['reserved'],
+                          len(agent['images']), len(agent['mirrors']), round(now - agent['last_seen'], 1))
+                         for name, agent in sorted(self._alive().items()))
+
+
+class AgentPlacer:
+    """
+    the runner's side of the registry: asks the resource allocator where each stage should run
+    """
+    def __init__(self, enabled: bool = None, poll_sec: float = None):
+        agents_config = config.runner.get('agents', {})
+        self.enabled = agents_config.get('enabled', False) if enabled is None else enabled
+        self.poll_sec = poll_sec or agents_config.get('poll_sec', 1)
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _call(self, method: str, *args):
+        with self._lock:
+            if self._connection is None:
+                self._connection = rpyc.connect(config.resource_allocator.get('address', 'localhost'),
+                                                config.resource_allocator.get('port', 18861))
+            return getattr(self._connection.root, method)(*args)
+
+    def place(self, image: str, clone_url: str, pinned: str = None,
+              cancelled: Callable[[], bool] = None) -> Optional[Tuple[str, str, int]]:
+        """
+        waits for a slot on an agent for a stage
+        returns (name, address, port) of the agent, or None to run the stage here, because no
+        agents are registered or the stage was cancelled while it waited
+        """
+        while True:
+            placement = self._call('place_stage', image, mirror_name(clone_url), pinned)
+            if placement:
+                return tuple(placement)
+            if placement is not None:
+                if pinned is not None:
+                    raise AgentUnavailable('agent {} is gone, and the workspace with it'.format(pinned))
+                return None
+            if cancelled is not None and cancelled():
+                return None
+            time.sleep(self.poll_sec)
+
+    def release(self, name: str) -> None:
+        try:
+            self._call('release_stage', name)
+        except Exception as e:
+            logger.error('releasing a slot of agent %s failed: %s', name, e)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
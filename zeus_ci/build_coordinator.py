@@ -1,11 +1,22 @@
 import argparse
+import asyncio
 import multiprocessing
+import os
 import signal
+import socket
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from zeus_ci import runner, logger, Status, Config
+from zeus_ci.build_notifier import BuildNotifier, notify_build
+from zeus_ci.container_pool import ContainerPool
 from zeus_ci.persistence import Database, Build
-from zeus_ci.scm_reporter import Github, TokenAuth, GithubStatus
+from zeus_ci.reaper import OrphanReaper
+from zeus_ci.scheduler import BuildScheduler, priority_class, stats_dir
+from zeus_ci.scm_reporter import GithubStatus, status_reporter
+from zeus_ci.tracing import tracer
 
 
 class BuildCoordinator:
@@ -23,7 +34,16 @@ class BuildCoordinator:
         self.config = dict(
             db_filename='/tmp/zeus-ci.db',
             runner_threads=4,
-            concurrent_builds=4
+            concurrent_builds=4,
+            build_poll_sec=60,  # builds are dispatched as the listener notifies us, polling is a fallback
+            notify_socket=None,
+            auto_cancel=True,  # cancel builds of a branch once a newer push to it is queued
+            cancel_poll_sec=5,  # how often a running build renews its lease and checks for cancellation
+            lease_sec=60,  # a build whose owner hasn't renewed its lease for this long is run again
+            build_timeout_sec=None,  # builds running for longer are stopped and failed
+            fair_share_weights=None,  # {repo name or username: weight}, 1 for those not listed
+            queue_stats_dir=None,
+            mode='processes'  # or asyncio, see AsyncBuildCoordinator
         )
 
         if in_config:
@@ -31,6 +51,19 @@ class BuildCoordinator:
 
         logger.debug('using config %s', self.config)
 
+        # any number of coordinators can share the database, builds are claimed by one of them at a
+        # time with a conditional update
+        self.owner = '{}-{}'.format(socket.gethostname(), uuid.uuid4().hex[:8])
+        self.container_pool = ContainerPool()
+        self.reaper = OrphanReaper(self.database, runner.DockerContainer.workspace_dir)
+        self._stopping = threading.Event()
+        self.scheduler = BuildScheduler(self.config['fair_share_weights'], self.config['runner_threads'])
+        self.queue_stats_path = os.path.join(self.config['queue_stats_dir'] or stats_dir(),
+                                             '{}.json'.format(self.owner))
+
+        self._start_build_processes()
+
+    def _start_build_processes(self) -> None:
         self.build_queue = multiprocessing.Queue()
         logger.info('spinning up build process pool')
         self.build_pool = multiprocessing.Pool(self.config['concurrent_builds'],
@@ -40,58 +73,11 @@ class BuildCoordinator:
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         with self.database.get_session() as session:
             try:
-                for build_id in iter(queue.get, None):
-                    build = session.query(Build).filter_by(id=build_id).one()
-
-                    # TODO: this must be called as soon as possible due to a race condition with populating the queue
-                    build.status = Status.starting
-                    session.commit()
-                    github = Github(TokenAuth(build.repo.user.token))
-                    logger.debug(f'building github object for user: {build.repo.user}')
-                    github.update_status(build, GithubStatus.pending)
-
+                for build_id, queued_at in iter(queue.get, None):
                     try:
-                        ref = None
-                        env_vars = build.repo.shell_ready_envvars()
-
-                        if build.ref.startswith('refs/tags/'):
-                            ref = build.ref.replace('refs/', '', 1)
-                            env_vars.append('ZEUS_TAG={}'.format(build.ref.replace('refs/tags/', '')))
-                            env_vars.append('ZEUS_BRANCH={}'.format(build.json['base_ref'].replace('refs/heads/', '')))
-                        elif build.ref.startswith('refs/heads/'):
-                            ref = build.json['after']
-                            env_vars.append('ZEUS_TAG=""')
-                            env_vars.append('ZEUS_BRANCH={}'.format(build.ref.replace('refs/heads/', '')))
-
-                        if not ref:
-                            logger.error('error from worker thread: %s, refn not detected', build.id)
-                        else:
-                            build.status = Status.running
-                            session.commit()
-
-                            logger.debug('executing runner.main process')
-                            status = runner.main(
-                                build.repo.name,
-                                build.id,
-                                threads=self.config['runner_threads'],
-                                ref=ref,
-                                env_vars=env_vars)
-                            logger.debug("runner main process completed")
-
-                            if status == Status.passed:
-                                logger.debug("build passed")
-                                github.update_status(build, GithubStatus.success)
-                                build.status = Status.passed
-                            else:
-                                logger.debug("build failed")
-                                github.update_status(build, GithubStatus.failure)
-                                build.status = Status.failed
-
-                            session.commit()
-                    except Exception as e:
-                        github.update_status(build, GithubStatus.error)
-                        build.status = Status.error
-                        raise e
+                        self._run_build(session, build_id, queued_at)
+                    finally:
+                        notify_build(build_id, self.config['notify_socket'], event='finished')
 
             except Exception as e:
                 logger.error('error from worker thread: %s', exc_info=True)
@@ -100,32 +86,458 @@ class BuildCoordinator:
             except KeyboardInterrupt:
                 pass
 
+            finally:
+                if not status_reporter().flush(timeout=30):
+                    logger.error('exiting with commit statuses unsent')
+
+    def _run_build(self, session, build_id: int, queued_at: float) -> None:
+        with tracer.trace('build-{}'.format(build_id)), tracer.span('build', build_id=build_id) as span:
+            tracer.record('queued', queued_at, time.time())
+            runner_args = self._start_build(session, build_id, span)
+            if runner_args is None:
+                return
+            try:
+                logger.debug('executing runner.main process')
+                deadline = self._deadline()
+                cancel, done = threading.Event(), threading.Event()
+                threading.Thread(target=self._watch_build, args=(build_id, cancel, done, deadline),
+                                 name='lease-renewal', daemon=True).start()
+                try:
+                    status = runner.main(cancel=cancel, **runner_args)
+                finally:
+                    done.set()
+                logger.debug("runner main process completed")
+                status = self._timed_out(build_id, status, deadline)
+                span.outcome = self._finish_build(session, build_id, status)
+            except Exception as e:
+                self._fail_build(session, build_id)
+                raise e
+
+    def _start_build(self, session, build_id: int, span) -> dict:
+        """
+        claims a queued build and marks it running
+        returns the arguments to run it with, or None if it isn't ours to run (anymore)
+        """
+        if not self._claim(session, build_id):
+            logger.info('not starting build %s, it is no longer queued or was claimed by '
+                        'another coordinator', build_id)
+            span.outcome = 'unclaimed'
+            return None
+        build = session.query(Build).filter_by(id=build_id).one()
+        span.set(repo=build.repo_name, ref=build.ref)
+        status_reporter().report(build, GithubStatus.pending)
+
+        try:
+            ref, ref_env_vars = build.checkout_target()
+            env_vars = build.repo.shell_ready_envvars() + ref_env_vars
+
+            if not ref:
+                logger.error('error from worker thread: %s, refn not detected', build.id)
+                self._set_status(session, build, Status.error)
+            elif not self._set_status(session, build, Status.running):
+                logger.info('build %s was cancelled before it started', build.id)
+                if build.status == Status.cancelled:
+                    status_reporter().report(build, GithubStatus.error, 'Build cancelled, superseded by a newer push')
+            else:
+                changed_files, base = build.changes_since_tested(session)
+                return dict(repo_slab=build.repo.name, build_id=build.id, threads=self.config['runner_threads'],
+                            ref=ref, env_vars=env_vars, changed_files=changed_files, base=base)
+            span.outcome = build.status.name
+        except Exception as e:
+            self._fail_build(session, build_id)
+            raise e
+
+    def _finish_build(self, session, build_id: int, status: Status) -> str:
+        """
+        records the outcome of a build runner.main has run, returns the status it ended up with
+        """
+        build = session.query(Build).filter_by(id=build_id).one()
+        github = status_reporter()
+        if status == Status.passed:
+            logger.debug("build passed")
+            github.report(build, GithubStatus.success)
+            self._set_status(session, build, Status.passed)
+        elif status == Status.cancelled:
+            logger.info('build %s cancelled', build.id)
+            github.report(build, GithubStatus.error, 'Build cancelled, superseded by a newer push')
+            self._set_status(session, build, Status.cancelled)
+        else:
+            logger.debug("build failed")
+            github.report(build, GithubStatus.failure)
+            self._set_status(session, build, Status.failed)
+        return build.status.name
+
+    def _deadline(self) -> float:
+        if self.config['build_timeout_sec']:
+            return time.time() + self.config['build_timeout_sec']
+
+    def _timed_out(self, build_id: int, status: Status, deadline: float) -> Status:
+        """
+        a build cancelled because it ran past its deadline has failed
+        """
+        if status == Status.cancelled and deadline is not None and time.time() >= deadline:
+            logger.info('build %s timed out after %ss', build_id, self.config['build_timeout_sec'])
+            return Status.failed
+        return status
+
+    def _fail_build(self, session, build_id: int) -> None:
+        session.rollback()
+        build = session.query(Build).filter_by(id=build_id).one()
+        status_reporter().report(build, GithubStatus.error)
+        self._set_status(session, build, Status.error)
+
+    def _claim(self, session, build_id: int) -> bool:
+        """
+        takes a created build for this coordinator, only one coordinator's update can match
+        """
+        claimed = session.query(Build) \
+            .filter(Build.id == build_id, Build.status == Status.created) \
+            .update({Build.status: Status.starting, Build.owner: self.owner,
+                     Build.lease_expires: time.time() + self.config['lease_sec']}, synchronize_session=False)
+        session.commit()
+        return claimed == 1
+
+    def _set_status(self, session, build: Build, status: Status) -> bool:
+        """
+        updates the status of a build this coordinator owns, finished builds give up their lease
+        returns False if the build has been cancelled, or reclaimed after the lease ran out
+        """
+        values = {Build.status: status}
+        if status not in (Status.starting, Status.running):
+            values[Build.lease_expires] = None
+        updated = session.query(Build) \
+            .filter(Build.id == build.id, Build.owner == self.owner,
+                    Build.status.in_([Status.starting, Status.running])) \
+            .update(values, synchronize_session=False)
+        session.commit()
+        session.refresh(build)
+        if not updated:
+            logger.info('build %s is %s and no longer ours to mark %s', build.id, build.status.name, status.name)
+        return updated == 1
+
+    def _watch_build(self, build_id: int, cancel: threading.Event, done: threading.Event,
+                     deadline: float = None) -> None:
+        """
+        renews the build's lease until it's `done`, and sets `cancel` if the build is cancelled, runs
+        past its `deadline` or the lease has been lost (eg. the database was unreachable for longer
+        than the lease, so another coordinator may already be running it). The lease is renewed
+        while a cancelled build unwinds too, so it isn't requeued meanwhile
+        """
+        renewing = True
+        with self.database.get_session() as session:
+            while not done.wait(self.config['cancel_poll_sec']):
+                if deadline is not None and time.time() >= deadline:
+                    cancel.set()
+                if renewing and self._renew_lease(session, build_id) is False:
+                    cancel.set()
+                    renewing = False  # it's no longer ours to renew
+
+    def _renew_lease(self, session, build_id: int) -> bool:
+        """
+        returns False if the build was cancelled or its lease lost, None if renewing it failed
+        """
+        try:
+            renewed = session.query(Build) \
+                .filter(Build.id == build_id, Build.owner == self.owner,
+                        Build.status.in_([Status.starting, Status.running])) \
+                .update({Build.lease_expires: time.time() + self.config['lease_sec']},
+                        synchronize_session=False)
+            session.commit()
+        except Exception:
+            logger.error('renewing the lease of build %s failed', build_id, exc_info=True)
+            session.rollback()
+            return None
+        if not renewed:
+            logger.info('build %s was cancelled or its lease lost, stopping it', build_id)
+            return False
+        return True
+
+    def _reclaim_expired(self, session) -> None:
+        """
+        puts builds whose owner stopped renewing their lease (it crashed, or lost the database)
+        back in the queue
+        """
+        expired = session.query(Build) \
+            .filter(Build.status.in_([Status.starting, Status.running]), Build.lease_expires < time.time()) \
+            .all()
+        for build in expired:
+            reclaimed = session.query(Build) \
+                .filter(Build.id == build.id, Build.owner == build.owner, Build.lease_expires == build.lease_expires) \
+                .update({Build.status: Status.created, Build.owner: None, Build.lease_expires: None},
+                        synchronize_session=False)
+            if reclaimed:
+                logger.info('requeueing build %s, the lease of %s expired', build.id, build.owner)
+        session.commit()
+
     def _runnable_builds(self, session):
         return session.query(Build).filter_by(status=Status.created).all()
 
+    def _schedule_runnable(self, session) -> None:
+        """
+        queues created builds in the scheduler and forgets those that aren't runnable any more
+        (cancelled, or claimed by another coordinator), along with dispatched builds that finished
+        without their build process telling us
+        """
+        runnable_builds = self._runnable_builds(session)
+        runnable_ids = {build.id for build in runnable_builds}
+        for build_id in self.scheduler.queued - runnable_ids:
+            self.scheduler.remove(build_id)
+        if self.scheduler.running:
+            active = {build_id for build_id, in session.query(Build.id).filter(
+                Build.id.in_(self.scheduler.running),
+                Build.status.in_([Status.created, Status.starting, Status.running]))}
+            for build_id in self.scheduler.running - active:
+                self.scheduler.remove(build_id)
+
+        new_builds = sorted((build for build in runnable_builds if build.id not in self.scheduler),
+                            key=lambda build: build.id)
+        if new_builds:
+            logger.debug('runnable_builds: %s', new_builds)
+        for build in new_builds:
+            self.scheduler.add(build.id, build.repo_name, build.repo.username,
+                               priority_class(build.ref, build.json), build.repo.user.container_limit)
+
+    def _poll_builds(self, session) -> None:
+        self._reclaim_expired(session)
+        if self.config['auto_cancel']:
+            self._cancel_superseded(session)
+        self._schedule_runnable(session)
+        session.commit()  # end the transaction so the next pass sees new builds
+
+    def _dispatch(self) -> None:
+        """
+        hands the builds the scheduler picks to the build processes, only as many as there are
+        processes to run them so the rest stay in the scheduler's order
+        """
+        while len(self.scheduler.running) < self.config['concurrent_builds']:
+            scheduled = self.scheduler.next()
+            if scheduled is None:
+                return
+            self.build_queue.put(scheduled)
+
+    def _cancel_superseded(self, session) -> None:
+        """
+        cancels builds of a branch that have been superseded by a newer push to it. Queued builds
+        are dropped when a build process picks them up (their commit status is set here), running
+        ones are stopped by their `_watch_build`. Tags are never superseded
+        """
+        active = session.query(Build) \
+            .filter(Build.status.in_([Status.created, Status.starting, Status.running])) \
+            .filter(Build.ref.like('refs/heads/%')) \
+            .order_by(Build.id.desc()).all()
+        newest = {}
+        for build in active:
+            key = (build.repo_name, build.ref)
+            if key not in newest:
+                newest[key] = build.id
+                continue
+            logger.info('cancelling build %s of %s %s, superseded by build %s', build.id, build.repo_name,
+                        build.ref, newest[key])
+            if build.status != Status.running:
+                # not running yet, so no build will replace the pending status the listener sent
+                status_reporter().report(build, GithubStatus.error,
+                                         'Build cancelled, superseded by build {}'.format(newest[key]))
+            build.status = Status.cancelled
+        session.commit()
+
+    def _maintain_container_pool(self):
+        """
+        pre-pulls the images needed by queued builds and keeps the pool of idle containers topped up
+        """
+        build_images = {}  # build id: images, so each build's config is only fetched once
+        with self.database.get_session() as session:
+            while not self._stopping.is_set():
+                try:
+                    queued = self._runnable_builds(session)
+                    build_images = {build.id: build_images.get(build.id) or
+                                    runner.build_config_images(build.repo.name, build.commit)
+                                    for build in queued}
+                    images = set().union(*build_images.values())
+
+                    self.container_pool.prefetch(images)
+                    self.container_pool.evict(keep_images=images)
+                    self.container_pool.replenish(images)
+                    logger.debug('container pool stats: %s', self.container_pool.stats())
+                except Exception:
+                    logger.error('container pool maintenance failed', exc_info=True)
+                session.commit()  # end the transaction so the next pass sees new builds
+                self._stopping.wait(self.container_pool.maintenance_interval)
+
     def run(self):
+        if self.container_pool.enabled:
+            threading.Thread(target=self._maintain_container_pool, name='container-pool', daemon=True).start()
+        if self.reaper.enabled:
+            threading.Thread(target=self.reaper.run, args=(self._stopping, ), name='orphan-reaper',
+                             daemon=True).start()
+        notifier = BuildNotifier(self.config['notify_socket']).open()
         try:
             with self.database.get_session() as session:
                 logger.info('Entering main loop')
                 while True:
-                    if not self.build_queue.empty():
-                        continue
-                    time.sleep(self.config['build_poll_sec'])
-
-                    runnable_builds = self._runnable_builds(session)
-                    if runnable_builds:
-                        logger.debug('runnable_builds: %s', runnable_builds)
-                    for build in reversed(runnable_builds):
-                        self.build_queue.put(build.id)
+                    self._poll_builds(session)
+                    self._dispatch()
+                    self.scheduler.write_stats(self.queue_stats_path)
+
+                    notified = notifier.wait(self.config['build_poll_sec'])
+                    if notified:
+                        logger.debug('notified of builds %s', notified)
+                    for event, build_id in notified:
+                        if event == 'finished':
+                            self.scheduler.remove(build_id)
         except KeyboardInterrupt:
             logger.info('recieved exit command, closing build processes.')
 
         finally:
+            notifier.close()
+            try:
+                os.remove(self.queue_stats_path)
+            except FileNotFoundError:
+                pass
+            self._stopping.set()
             for _ in range(self.config['concurrent_builds']):
                 self.build_queue.put(None)
             self.build_pool.close()
             self.build_pool.join()
-            pass
+            # statuses reported here, eg. of builds cancelled as superseded
+            if not status_reporter().flush(timeout=30):
+                logger.error('exiting with commit statuses unsent')
+
+
+class AsyncBuildCoordinator(BuildCoordinator):
+    """
+    runs its builds in this one process on an asyncio event loop rather than one process per
+    concurrent build, which saves a process (its interpreter, imports and database connection) per
+    build. Workflows waiting on their DAGs, lease renewals and notifications are coroutines.
+
+    stages are not: from waiting for a resource allocator slot to the last docker exec (read
+    through blocking sockets and pipes) a stage holds a thread of the stage executor, sized
+    concurrent_builds * runner_threads like the threads of the build processes it replaces. So
+    stage threads and their memory don't shrink, and concurrent_builds should be sized as for
+    processes mode. Git and database work take threads of their own executors
+    """
+    def _start_build_processes(self) -> None:
+        # the session is created and only ever used in the database thread
+        self.database_executor = ThreadPoolExecutor(1, thread_name_prefix='database')
+        self.stage_executor = ThreadPoolExecutor(self.config['concurrent_builds'] * self.config['runner_threads'],
+                                                 thread_name_prefix='stage')
+        self._session = None
+        self._builds = set()  # asyncio tasks of the running builds
+        self._finished = []  # ids of builds finished since the last pass
+        self._wake = None
+
+    def _database(self, method, *args) -> asyncio.Future:
+        return runner._in_executor(self.database_executor, method, self._session, *args)
+
+    def _dispatch(self) -> None:
+        while len(self.scheduler.running) < self.config['concurrent_builds']:
+            scheduled = self.scheduler.next()
+            if scheduled is None:
+                return
+            build = asyncio.ensure_future(self._run_build_async(*scheduled))
+            self._builds.add(build)
+            build.add_done_callback(self._builds.discard)
+
+    async def _run_build_async(self, build_id: int, queued_at: float) -> None:
+        try:
+            with tracer.trace('build-{}'.format(build_id)), tracer.span('build', build_id=build_id) as span:
+                tracer.record('queued', queued_at, time.time())
+                runner_args = await self._database(self._start_build, build_id, span)
+                if runner_args is None:
+                    return
+                try:
+                    deadline = self._deadline()
+                    cancel = asyncio.Event()
+                    watcher = asyncio.ensure_future(self._watch_build_async(build_id, cancel, deadline))
+                    try:
+                        status = await runner.main_async(cancel=cancel, executor=self.stage_executor, **runner_args)
+                    finally:
+                        watcher.cancel()
+                    status = self._timed_out(build_id, status, deadline)
+                    span.outcome = await self._database(self._finish_build, build_id, status)
+                except Exception:
+                    await self._database(self._fail_build, build_id)
+                    raise
+        except Exception:
+            logger.error('error running build %s', build_id, exc_info=True)
+        finally:
+            self._finished.append(build_id)
+            self._wake.set()
+
+    async def _watch_build_async(self, build_id: int, cancel: asyncio.Event, deadline: float = None) -> None:
+        """
+        _watch_build, until the task is cancelled once the build is done
+        """
+        renewing = True
+        while True:
+            await asyncio.sleep(self.config['cancel_poll_sec'])
+            if deadline is not None and time.time() >= deadline:
+                cancel.set()
+            if renewing and await self._database(self._renew_lease, build_id) is False:
+                cancel.set()
+                renewing = False
+
+    def _notified(self, notifier: BuildNotifier) -> None:
+        notified = notifier.wait(0)
+        if notified:
+            logger.debug('notified of builds %s', notified)
+            self._wake.set()
+
+    def run(self):
+        if self.container_pool.enabled:
+            threading.Thread(target=self._maintain_container_pool, name='container-pool', daemon=True).start()
+        if self.reaper.enabled:
+            threading.Thread(target=self.reaper.run, args=(self._stopping, ), name='orphan-reaper',
+                             daemon=True).start()
+        try:
+            asyncio.run(self._run())
+        finally:
+            self._stopping.set()
+            self.database_executor.shutdown()
+            self.stage_executor.shutdown()
+            if not status_reporter().flush(timeout=30):
+                logger.error('exiting with commit statuses unsent')
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(self.config['concurrent_builds'], thread_name_prefix='build'))
+        self._wake = asyncio.Event()
+        stopping = asyncio.Event()
+
+        def stop():
+            logger.info('recieved exit command, waiting for %d running builds', len(self._builds))
+            stopping.set()
+            self._wake.set()
+
+        loop.add_signal_handler(signal.SIGINT, stop)
+        notifier = BuildNotifier(self.config['notify_socket']).open()
+        loop.add_reader(notifier.fileno(), self._notified, notifier)
+        self._session = await runner._in_executor(self.database_executor, self.database.get_session)
+        # each build gets its own trace, this one has what threads that don't carry a build's context record
+        with tracer.trace('coordinator-{}'.format(self.owner)):
+            try:
+                logger.info('Entering main loop')
+                while not stopping.is_set():
+                    self._wake.clear()
+                    for build_id in self._finished:
+                        self.scheduler.remove(build_id)
+                    self._finished.clear()
+                    await self._database(self._poll_builds)
+                    self._dispatch()
+                    self.scheduler.write_stats(self.queue_stats_path)
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), self.config['build_poll_sec'])
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                loop.remove_reader(notifier.fileno())
+                loop.remove_signal_handler(signal.SIGINT)
+                notifier.close()
+                try:
+                    os.remove(self.queue_stats_path)
+                except FileNotFoundError:
+                    pass
+                await asyncio.gather(*self._builds, return_exceptions=True)
+                await runner._in_executor(self.database_executor, self._session.close)
 
 
 def main():
@@ -134,8 +546,10 @@ def main():
     parser.add_argument('--sqlalchemy-protocol-args', type=str)
     parser.add_argument('--runner-threads', type=int)
     parser.add_argument('--concurrent-builds', type=int)
-    parser.add_argument('--build-poll-sec', type=int, help='interval between database polling for new builds',
-                        default=10)
+    parser.add_argument('--build-poll-sec', type=int,
+                        help='interval between fallback polls of the database for builds the listener didnt notify')
+    parser.add_argument('--mode', choices=('processes', 'asyncio'),
+                        help='run builds in a process each, or all of them on one event loop')
     args = parser.parse_args()
 
     loaded_config = Config()
@@ -145,9 +559,11 @@ def main():
     )
 
     config = dict(
-        sqlalchemy_args=sqlalchemy_args,
-        build_poll_sec=args.build_poll_sec
+        {key: value for key, value in (loaded_config.build_coordinator or {}).items() if value is not None},
+        sqlalchemy_args=sqlalchemy_args
     )
+    if args.build_poll_sec:
+        config['build_poll_sec'] = args.build_poll_sec
 
     logger.info(f'Using config: {config}')
 
@@ -158,7 +574,11 @@ def main():
         logger.debug('setting concurrent builds to %s', args.concurrent_builds)
         config['concurrent_builds'] = args.concurrent_builds
 
-    builder = BuildCoordinator(config)
+    if args.mode:
+        config['mode'] = args.mode
+
+    coordinator_class = AsyncBuildCoordinator if config.get('mode') == 'asyncio' else BuildCoordinator
+    builder = coordinator_class(config)
     builder.run()
 
 
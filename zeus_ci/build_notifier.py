@@ -0,0 +1,86 @@
+import errno
+import os
+import socket
+from typing import List, Tuple
+
+from zeus_ci import logger, config
+
+
+def socket_path() -> str:
+    return (config.build_coordinator or {}).get('notify_socket', '/tmp/zeus-ci-coordinator.sock')
+
+
+class BuildNotifier:
+    """
+    the coordinator's end of a unix datagram socket that the listener (or zeus-cli) sends the id of
+    each build it creates to, so builds are dispatched as soon as they exist rather than on the
+    next poll of the builds table. Build processes send 'finished <id>' when they're done with a
+    build, so the next one is scheduled into the free slot straight away.
+    """
+    def __init__(self, path: str = None):
+        self.path = path or socket_path()
+        self._socket = None
+
+    def open(self) -> 'BuildNotifier':
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as probe:
+                try:
+                    probe.connect(self.path)
+                except ConnectionRefusedError:
+                    os.remove(self.path)  # left behind by a coordinator that didn't shut down cleanly
+                else:
+                    raise OSError(errno.EADDRINUSE, 'another coordinator is notified on {}, give each coordinator '
+                                                    'on a host its own notify_socket'.format(self.path))
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        return self
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    def wait(self, timeout: float) -> List[Tuple[str, int]]:
+        """
+        blocks until a build is notified or `timeout` passes
+        returns the (event, build id) of every notification since the last call, empty on timeout
+        """
+        self._socket.settimeout(timeout)
+        notifications = []
+        try:
+            while True:
+                data = self._socket.recv(64)
+                event, _, build_id = data.decode(errors='replace').rpartition(' ')
+                try:
+                    notifications.append((event or 'created', int(build_id)))
+                except ValueError:
+                    logger.error('ignoring malformed build notification %r', data)
+                self._socket.settimeout(0)  # collect whatever else is already waiting
+        except (socket.timeout, BlockingIOError):
+            pass
+        return notifications
+
+    def close(self) -> None:
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+def notify_build(build_id: int, path: str = None, event: str = 'created') -> bool:
+    """
+    tells the coordinator about a new (or retried) build, or that a build process has finished one
+    returns False if it couldn't be reached (or was too busy), the build is then picked up by its
+    slow poll
+    """
+    message = str(build_id) if event == 'created' else '{} {}'.format(event, build_id)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            # never wait on a coordinator whose queue is full, eg. a burst of pushes while it's busy
+            sock.sendto(message.encode(), socket.MSG_DONTWAIT, path or socket_path())
+        except OSError as e:  # including BlockingIOError
+            logger.debug('could not notify the coordinator of build %s: %s', build_id, e)
+            return False
+    return True
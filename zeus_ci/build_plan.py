@@ -0,0 +1,473 @@
+import hashlib
+import os
+import pickle
+import re
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+from zeus_ci import logger, config
+from zeus_ci.executors import _exec
+
+# the libyaml backed loader is an order of magnitude faster, fall back when pyyaml was built without it
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+config_path = '.zeusci/config.yml'
+
+
+class WorkflowConfigError(Exception):
+    pass
+
+
+class PathFilter:
+    """
+    a compiled `run_when: paths:`, either a list of globs where those starting with ! exclude, or a
+    mapping of `include` and `exclude` globs. `*` and `?` stay within a directory, `**` spans them.
+    A change matches when any changed file is included (everything is, with no include globs) and
+    not excluded.
+    """
+    def __init__(self, include: List[str], exclude: List[str]):
+        self.include = include
+        self.exclude = exclude
+        self._include = [re.compile(self.glob_regex(glob)) for glob in include]
+        self._exclude = [re.compile(self.glob_regex(glob)) for glob in exclude]
+
+    @classmethod
+    def compile(cls, spec) -> 'PathFilter':
+        if isinstance(spec, str):
+            spec = [spec]
+        if isinstance(spec, dict):
+            include, exclude = spec.get('include') or [], spec.get('exclude') or []
+        elif isinstance(spec, list):
+            include = [glob for glob in spec if not str(glob).startswith('!')]
+            exclude = [str(glob)[1:] for glob in spec if str(glob).startswith('!')]
+        else:
+            raise TypeError('expected a list of globs or a mapping of include and exclude globs')
+        if isinstance(include, str):
+            include = [include]
+        if isinstance(exclude, str):
+            exclude = [exclude]
+        if not all(isinstance(glob, str) for glob in include + exclude):
+            raise TypeError('globs must be strings')
+        return cls(include, exclude)
+
+    @staticmethod
+    def glob_regex(glob: str) -> str:
+        pattern, i = '', 0
+        glob = glob.lstrip('/')
+        while i < len(glob):
+            if glob.startswith('**/', i):
+                pattern += '(?:.*/)?'
+                i += 3
+            elif glob.startswith('**', i):
+                pattern += '.*'
+                i += 2
+            elif glob[i] == '*':
+                pattern += '[^/]*'
+                i += 1
+            elif glob[i] == '?':
+                pattern += '[^/]'
+                i += 1
+            else:
+                pattern += re.escape(glob[i])
+                i += 1
+        # a glob naming a directory matches everything under it
+        return r'\A{}(?:/.*)?\Z'.format(pattern)
+
+    def matches(self, path: str) -> bool:
+        return (not self._include or any(regex.match(path) for regex in self._include)) \
+            and not any(regex.match(path) for regex in self._exclude)
+
+    def __repr__(self):
+        return '{}(include={}, exclude={})'.format(self.__class__.__name__, self.include, self.exclude)
+
+
+class StagePlan:
+    """
+    one container's worth of a job. Jobs with `parallelism: N` become N StagePlans named
+    <job>.<node index>, which share the job name and know their node index and total.
+    """
+    def __init__(self, name: str, job: dict, requires: List[str], run_condition: Dict[str, re.Pattern],
+                 job_name: str = None, node_index: int = None, node_total: int = None):
+        self.name = name
+        self.job = job
+        self.requires = requires
+        self.run_condition = run_condition
+        self.job_name = job_name or name
+        self.node_index = node_index
+        self.node_total = node_total
+
+    @property
+    def image(self) -> str:
+        return self.job['docker'][0]['image']
+
+    def skip_reason(self, branch: Optional[str], tag: Optional[str],
+                    changed_files: List[str] = None) -> Optional[str]:
+        """
+        why this stage's run_when rules it out for `branch`, `tag` and the files changed by the push,
+        None if it should run. A paths condition can't rule anything out when the changed files
+        aren't known
+        """
+        for key, value in (('branch', branch), ('tag', tag)):
+            pattern = self.run_condition.get(key)
+            if pattern and not pattern.search(value or ''):
+                return '{} {!r} doesnt match run_when.{} {!r}'.format(key, value, key, pattern.pattern)
+        paths = self.run_condition.get('paths')
+        if paths and changed_files is not None and not any(map(paths.matches, changed_files)):
+            return 'none of the {} changed files match run_when.paths'.format(len(changed_files))
+        return None
+
+    def __repr__(self):
+        return '{}(name={}, requires={})'.format(self.__class__.__name__, self.name, self.requires)
+
+
+class WorkflowPlan:
+    """
+    with `fail_fast` the first stage to fail cancels the rest of the workflow
+    """
+    def __init__(self, name: str, stages: List[StagePlan], fail_fast: bool = False):
+        self.name = name
+        self.stages = stages
+        self.fail_fast = fail_fast
+
+    def resolve(self, branch: Optional[str], tag: Optional[str], changed_files: List[str] = None) -> Dict[str, str]:
+        """
+        returns {stage name: reason} of the stages that won't run for `branch`, `tag` and
+        `changed_files`, those ruled out by their run_when and everything that requires them
+        """
+        dependents = {stage.name: [] for stage in self.stages}
+        for stage in self.stages:
+            for required in stage.requires:
+                dependents[required].append(stage.name)
+
+        skipped = {}
+        pending = []
+        for stage in self.stages:
+            reason = stage.skip_reason(branch, tag, changed_files)
+            if reason:
+                skipped[stage.name] = reason
+                pending.append(stage.name)
+        while pending:
+            name = pending.pop()
+            for dependent in dependents[name]:
+                if dependent not in skipped:
+                    skipped[dependent] = 'requires {}, which is skipped'.format(name)
+                    pending.append(dependent)
+        return skipped
+
+    def __repr__(self):
+        return '{}(name={}, stages={})'.format(self.__class__.__name__, self.name, self.stages)
+
+
+class BuildPlan:
+    """
+    a validated, pre-compiled form of a repo's .zeusci/config.yml. Anchors and merge keys are
+    resolved by the yaml loader, stage references and requires are checked, and run_when
+    conditions are compiled once here rather than per stage.
+    """
+    def __init__(self, blob_sha: str, workflows: Dict[str, WorkflowPlan]):
+        self.blob_sha = blob_sha
+        self.workflows = workflows
+
+    @property
+    def images(self) -> set:
+        return {stage.image for workflow in self.workflows.values() for stage in workflow.stages}
+
+    @property
+    def full_history(self) -> bool:
+        """
+        whether a job asked for the whole git history (`full_history: true`) rather than a shallow checkout
+        """
+        return any(stage.job.get('full_history') for workflow in self.workflows.values() for stage in workflow.stages)
+
+    def resolve(self, branch: Optional[str], tag: Optional[str], changed_files: List[str] = None) -> 'ExecutionPlan':
+        return ExecutionPlan(self, branch, tag, changed_files)
+
+    @classmethod
+    def compile(cls, raw: dict, blob_sha: str = None) -> 'BuildPlan':
+        if not isinstance(raw, dict) or not isinstance(raw.get('jobs'), dict) \
+                or not isinstance(raw.get('workflows'), dict):
+            raise WorkflowConfigError('build config needs both a `jobs` and a `workflows` mapping')
+
+        jobs = raw['jobs']
+        for job_name, job in jobs.items():
+            if not isinstance(job, dict) or not isinstance(job.get('docker'), list) or not job['docker'] \
+                    or not isinstance(job['docker'][0], dict) or not job['docker'][0].get('image'):
+                raise WorkflowConfigError('job "{}" has no docker image'.format(job_name))
+            if not isinstance(job.get('steps'), list):
+                raise WorkflowConfigError('job "{}" has no steps'.format(job_name))
+            parallelism = job.get('parallelism', 1)
+            if not isinstance(parallelism, int) or isinstance(parallelism, bool) or parallelism < 1:
+                raise WorkflowConfigError('job "{}" parallelism must be a positive integer'.format(job_name))
+
+        workflows = {}
+        for workflow_name, spec in raw['workflows'].items():
+            if workflow_name == 'version':
+                continue
+            if not isinstance(spec, dict) or not isinstance(spec.get('stages'), list):
+                raise WorkflowConfigError('workflow "{}" needs a `stages` list'.format(workflow_name))
+            stages = []
+            shards = {}  # job name: the stage names it fans out to
+            for stage in spec['stages']:
+                if isinstance(stage, dict) and len(stage) == 1:
+                    stage_name, stage_spec = next(iter(stage.items()))
+                    stage_spec = stage_spec or {}
+                else:
+                    stage_name, stage_spec = stage, {}
+                if not isinstance(stage_name, str) or not isinstance(stage_spec, dict):
+                    raise WorkflowConfigError('workflow "{}" has an invalid stage {!r}, expected a job name or '
+                                              '{{<job name>: {{requires: [...], run_when: {{...}}}}}}'.format(
+                                                  workflow_name, stage))
+
+                if stage_name not in jobs:
+                    raise WorkflowConfigError('workflow "{}" references unknown job "{}"'.format(
+                        workflow_name, stage_name))
+                requires = stage_spec.get('requires') or []
+                if not isinstance(requires, list) or not all(isinstance(required, str) for required in requires):
+                    raise WorkflowConfigError('requires of stage "{}" in workflow "{}" must be a list of stage '
+                                              'names, got {!r}'.format(stage_name, workflow_name, requires))
+                requires = list(requires)
+                if not isinstance(stage_spec.get('run_when') or {}, dict):
+                    raise WorkflowConfigError('run_when of stage "{}" in workflow "{}" must be a mapping'.format(
+                        stage_name, workflow_name))
+                run_condition = cls._compile_run_condition(stage_name, stage_spec.get('run_when'))
+                if 'parallelism' not in jobs[stage_name]:
+                    stages.append(StagePlan(stage_name, jobs[stage_name], requires, run_condition))
+                    continue
+                node_total = jobs[stage_name]['parallelism']
+                shards[stage_name] = ['{}.{}'.format(stage_name, node) for node in range(node_total)]
+                stages.extend(StagePlan(shard_name, jobs[stage_name], requires, run_condition, job_name=stage_name,
+                                        node_index=node, node_total=node_total)
+                              for node, shard_name in enumerate(shards[stage_name]))
+
+            # requiring a parallel job waits for all of its shards
+            for stage in stages:
+                stage.requires = [shard for required in stage.requires for shard in shards.get(required, [required])]
+
+            fail_fast = spec.get('fail_fast', False)
+            if not isinstance(fail_fast, bool):
+                raise WorkflowConfigError('workflow "{}" fail_fast must be true or false'.format(workflow_name))
+            workflow = WorkflowPlan(workflow_name, stages, fail_fast)
+            cls._check_requires(workflow)
+            workflows[workflow_name] = workflow
+
+        return cls(blob_sha, workflows)
+
+    @staticmethod
+    def _compile_run_condition(stage_name: str, run_condition: Optional[dict]) -> Dict[str, re.Pattern]:
+        compiled = {}
+        for key, pattern in (run_condition or {}).items():
+            try:
+                compiled[key] = PathFilter.compile(pattern) if key == 'paths' else re.compile(pattern)
+            except (re.error, TypeError) as e:
+                raise WorkflowConfigError('invalid run_when.{} for stage "{}": {}'.format(key, stage_name, e))
+        return compiled
+
+    @staticmethod
+    def _check_requires(workflow: WorkflowPlan) -> None:
+        """
+        unknown names and cycles are reported when the plan is built rather than hanging the
+        workflow at run time
+        """
+        dependents = {stage.name: [] for stage in workflow.stages}
+        for stage in workflow.stages:
+            for required in stage.requires:
+                if required not in dependents:
+                    raise WorkflowConfigError('stage "{}" in workflow "{}" requires unknown stage "{}"'.format(
+                        stage.name, workflow.name, required))
+                dependents[required].append(stage.name)
+
+        # Kahn's algorithm, anything left with unmet requirements once no more stages can be
+        # released is part of (or downstream of) a cycle
+        unmet = {stage.name: len(stage.requires) for stage in workflow.stages}
+        released = [name for name, count in unmet.items() if not count]
+        for name in released:
+            for dependent in dependents[name]:
+                unmet[dependent] -= 1
+                if not unmet[dependent]:
+                    released.append(dependent)
+        if len(released) != len(unmet):
+            raise WorkflowConfigError('workflow "{}" has a requires cycle between: {}'.format(
+                workflow.name, ', '.join(sorted(name for name, count in unmet.items() if count))))
+
+
+class ExecutionPlan:
+    """
+    what a BuildPlan will do for one build, resolved before any container is started or slot
+    requested: stages whose run_when doesn't match the build's branch, tag or changed files, and
+    everything downstream of them, are skipped up front.
+    """
+    def __init__(self, plan: BuildPlan, branch: Optional[str], tag: Optional[str], changed_files: List[str] = None):
+        self.plan = plan
+        self.branch = branch
+        self.tag = tag
+        self.changed_files = changed_files
+        self.skipped = {name: workflow.resolve(branch, tag, changed_files) for name, workflow in plan.workflows.items()}
+
+    def runs(self, workflow_name: str, stage_name: str) -> bool:
+        return stage_name not in self.skipped[workflow_name]
+
+    @property
+    def images(self) -> set:
+        """
+        the images of the stages that will run
+        """
+        return {stage.image for workflow in self.plan.workflows.values() for stage in workflow.stages
+                if self.runs(workflow.name, stage.name)}
+
+    def describe(self) -> str:
+        lines = ['branch: {}  tag: {}  changed files: {}'.format(
+            self.branch, self.tag, 'unknown' if self.changed_files is None else len(self.changed_files))]
+        for name, workflow in self.plan.workflows.items():
+            skipped = self.skipped[name]
+            lines.append('workflow {}: {} of {} stages run'.format(name, len(workflow.stages) - len(skipped),
+                                                                  len(workflow.stages)))
+            for stage in workflow.stages:
+                requires = ' (requires {})'.format(', '.join(stage.requires)) if stage.requires else ''
+                if stage.name in skipped:
+                    lines.append('  skip {}: {}'.format(stage.name, skipped[stage.name]))
+                else:
+                    lines.append('  run  {} [{}]{}'.format(stage.name, stage.image, requires))
+        return '\n'.join(lines)
+
+
+def ref_names(env_vars: List[str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    the branch and tag a build is for, from its ZEUS_BRANCH and ZEUS_TAG env vars
+    """
+    branch = tag = None
+    for env_var in env_vars or []:
+        if env_var.startswith('ZEUS_TAG='):
+            tag = env_var.split('ZEUS_TAG=', 1)[-1]
+        elif env_var.startswith('ZEUS_BRANCH='):
+            branch = env_var.split('ZEUS_BRANCH=', 1)[-1]
+    return branch, tag
+
+
+class PlanCache:
+    """
+    compiled BuildPlans keyed by repo and the git blob hash of the config, in memory for the life of
+    the process and pickled on disk so other build processes on the host can share them
+    """
+    version = 3
+    max_in_memory = 256
+
+    _memory = OrderedDict()
+    _memory_lock = threading.Lock()
+
+    def __init__(self, cache_dir: str = None):
+        self.cache_dir = cache_dir or config.runner.get('plan_cache_dir', '/var/cache/zeus-ci/plans')
+
+    def _path(self, repo_slab: str, blob_sha: str) -> str:
+        return os.path.join(self.cache_dir, 'v{}'.format(self.version), repo_slab.replace('/', '_'),
+                            '{}.pickle'.format(blob_sha))
+
+    def get(self, repo_slab: str, blob_sha: str) -> Optional[BuildPlan]:
+        key = (repo_slab, blob_sha)
+        with self._memory_lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        try:
+            with open(self._path(repo_slab, blob_sha), 'rb') as f:
+                plan = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.debug('ignoring unreadable cached plan for %s@%s: %s', repo_slab, blob_sha, e)
+            return None
+        self._remember(key, plan)
+        return plan
+
+    def put(self, repo_slab: str, plan: BuildPlan) -> None:
+        self._remember((repo_slab, plan.blob_sha), plan)
+        path = self._path(repo_slab, plan.blob_sha)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(plan, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error('couldnt write plan cache %s: %s', path, e)
+
+    def _remember(self, key: tuple, plan: BuildPlan) -> None:
+        with self._memory_lock:
+            self._memory[key] = plan
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_in_memory:
+                self._memory.popitem(last=False)
+
+
+def git_blob_sha(data: bytes) -> str:
+    """
+    the hash git gives `data` as a blob, so configs fetched over http share cache entries with
+    ones read from a local repo
+    """
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+
+def load_build_plan(repo_slab: str, ref: str, git_dir: str = None) -> Optional[BuildPlan]:
+    """
+    returns the compiled plan for the build config of `repo_slab` at `ref`, None if it couldnt be
+    found or is invalid.
+
+    when `git_dir` (eg. the host mirror) is given only the blob hash is looked up there, so an
+    unchanged config skips fetching and parsing entirely.
+    """
+    cache = PlanCache()
+    data = blob_sha = None
+    if git_dir:
+        out = _exec(['git', '--git-dir', git_dir, 'rev-parse', '{}:{}'.format(ref or 'HEAD', config_path)])
+        if out:
+            blob_sha = out.stdout.strip()
+            plan = cache.get(repo_slab, blob_sha)
+            if plan is not None:
+                logger.debug('using cached build plan %s for %s', blob_sha, repo_slab)
+                return plan
+            data = _exec(['git', '--git-dir', git_dir, 'cat-file', 'blob', blob_sha]).stdout.encode()
+
+    if data is None:
+        data = _download_repo_build_config(repo_slab, ref)
+        if data is None:
+            return None
+        blob_sha = git_blob_sha(data)
+        plan = cache.get(repo_slab, blob_sha)
+        if plan is not None:
+            return plan
+
+    try:
+        plan = BuildPlan.compile(yaml.load(data, YamlLoader), blob_sha)
+    except (yaml.YAMLError, WorkflowConfigError) as e:
+        logger.error('invalid build config for %s@%s: %s', repo_slab, ref, e)
+        return None
+    cache.put(repo_slab, plan)
+    return plan
+
+
+def _download_repo_build_config(repo_slab, ref) -> Optional[bytes]:
+    """
+    last commit to master:
+    https://raw.githubusercontent.com/chestm007/Zeus-CI/master/.zeusci/config.yml
+
+    specific commit:
+    https://raw.githubusercontent.com/chestm007/Zeus-CI/142eb4bdbbc54371cbcc4a0000bd8eeea997d1f2/.zeusci/config.yml
+
+    specific tag:
+    https://raw.githubusercontent.com/chestm007/Zeus-CI/test-tag/.zeusci/config.yml
+    """
+    url_format = 'https://raw.githubusercontent.com/{repo_slab}/{ref}/{path}'
+    try:
+        response = urllib.request.urlopen(url_format.format(repo_slab=repo_slab, ref=(ref or 'HEAD').split('/')[-1],
+                                                            path=config_path))
+    except urllib.error.URLError:
+        logger.error('couldnt fetch build config')
+        return None
+
+    if response.status == 200:
+        return response.read()
@@ -1,9 +1,17 @@
 import json
+import os
 
 import click
+import rpyc
 
+from zeus_ci.build_notifier import notify_build
+from zeus_ci.build_plan import load_build_plan, ref_names
+from zeus_ci.container_pool import ContainerPool
+from zeus_ci.git_mirror import GitMirror
+from zeus_ci.log_store import LogStore, LogReader
 from zeus_ci.persistence import Database, Build, User, Repo
-from zeus_ci import Status
+from zeus_ci.scheduler import coordinator_stats, priority_classes
+from zeus_ci import Status, config
 
 
 @click.group()
@@ -99,6 +107,132 @@ def retry(ctx, build_id):
 
     build.status = Status.created
     session.commit()
+    notify_build(build.id)
+
+
+@builds.command()
+@click.argument('build_id')
+@click.pass_context
+def plan(ctx, build_id):
+    """
+    dry run: shows which stages the build would run and which it would skip, without starting anything
+    """
+    session = ctx.obj['session']
+    build = session.query(Build).filter_by(id=build_id).one()
+    ref, ref_env_vars = build.checkout_target()
+    if not ref:
+        click.echo('{} is not a branch or tag, it would not be built'.format(build.ref))
+        return
+
+    # an existing host mirror is only read, anything it doesnt have is fetched from github
+    mirror = GitMirror()
+    clone_url = 'https://github.com/{}.git'.format(build.repo_name)
+    mirrored = os.path.isdir(mirror.path(clone_url))
+    build_plan = load_build_plan(build.repo_name, ref, mirror.path(clone_url) if mirrored else None)
+    if not build_plan:
+        click.echo('no valid build config found')
+        return
+    changed_files, base = build.changes_since_tested(session)
+    if changed_files is None and base and mirrored:
+        changed_files = mirror.changed_files(clone_url, base, build.commit)
+    click.echo(build_plan.resolve(*ref_names(ref_env_vars), changed_files).describe())
+
+
+@builds.command()
+@click.argument('build_id')
+@click.argument('workflow', required=False)
+@click.argument('stage', required=False)
+@click.option('--step', help='only show this step, by name or number')
+@click.option('--tail', 'tail_bytes', type=int, help='only show the last TAIL bytes')
+@click.option('--range', 'byte_range', help='only show bytes START:END')
+@click.option('--follow', is_flag=True, help='keep printing output until the stage finishes')
+def log(build_id, workflow, stage, step, tail_bytes, byte_range, follow):
+    store = LogStore()
+    if not workflow or not stage:
+        for workflow_name, stages in store.stages(build_id).items():
+            if workflow and workflow != workflow_name:
+                continue
+            for stage_name in stages:
+                reader = LogReader(store.path(build_id, workflow_name, stage_name))
+                click.echo('{}/{}: {} bytes{}'.format(workflow_name, stage_name, reader.size,
+                                                      '' if reader.ended else ' (running)'))
+                for number, step_record in enumerate(reader.steps):
+                    click.echo('  {}: {}'.format(number, step_record['step'].splitlines()[0]))
+        return
+
+    reader = LogReader(store.path(build_id, workflow, stage))
+    if not reader.exists():
+        click.echo('log not found')
+        return
+
+    start, end = 0, None
+    if step is not None:
+        start, end = reader.step_range(int(step) if step.isdigit() else step)
+    if byte_range:
+        # relative to the step when one is given
+        range_start, _, range_end = byte_range.partition(':')
+        base = start
+        start = base + int(range_start or 0)
+        end = base + int(range_end) if range_end else end
+    if tail_bytes:
+        start = max(start, (reader.size if end is None else end) - tail_bytes)
+
+    if follow and end is None:
+        for data in reader.follow(start):
+            click.echo(data.decode(errors='replace'), nl=False)
+    else:
+        click.echo(reader.read(start, end).decode(errors='replace'), nl=False)
+
+
+@main.group()
+def logs():
+    pass
+
+
+@logs.command()
+def prune():
+    LogStore().enforce_budget()
+
+
+@main.group()
+def pool():
+    pass
+
+
+@pool.command()
+def stats():
+    for image, image_stats in sorted(ContainerPool().stats().items()):
+        click.echo('{}: hits={} misses={}'.format(image, image_stats['hits'], image_stats['misses']))
+
+
+@main.group()
+def agents():
+    pass
+
+
+@agents.command('list')
+def list_agents():
+    allocator = rpyc.connect(config.resource_allocator.get('address', 'localhost'),
+                             config.resource_allocator.get('port', 18861))
+    for name, address, port, slots, reserved, images, mirrors, last_seen in allocator.root.agents():
+        click.echo('{} ({}:{}): {}/{} slots in use, {} images, {} mirrors, checked in {}s ago'.format(
+            name, address, port, reserved, slots, images, mirrors, last_seen))
+
+
+@main.group()
+def queue():
+    pass
+
+
+@queue.command('stats')
+def queue_stats():
+    for coordinator, queue_stats_ in coordinator_stats().items():
+        click.echo('{}: {} running'.format(coordinator, queue_stats_['running']))
+        for priority in priority_classes:
+            class_stats = queue_stats_[priority]
+            click.echo('  {}: depth={} oldest_wait={}s dispatched={} mean_wait={}s p95_wait={}s'.format(
+                priority, class_stats['depth'], class_stats['oldest_wait_sec'], class_stats['dispatched'],
+                class_stats['mean_wait_sec'], class_stats['p95_wait_sec']))
 
 
 if __name__ == '__main__':
@@ -13,6 +13,10 @@ class Config:
         self.listener: dict = None
         self.loglevel: str = None
         self.build_coordinator: dict = None
+        self.runner: dict = None
+        self.tracing: dict = None
+        self.agent: dict = None
+        self.status_reporter: dict = None
 
         self._load_config()
 
@@ -32,4 +36,8 @@ class Config:
             self.build_coordinator = config.get('build_coordinator', {})
             self.logging = config.get('logging', {})
             self.resource_allocator = config.get('resource_allocator', {})
+            self.runner = config.get('runner', {})
+            self.tracing = config.get('tracing', {})
+            self.agent = config.get('agent', {})
+            self.status_reporter = config.get('status_reporter', {})
             self.loaded = True
@@ -0,0 +1,200 @@
+import fcntl
+import json
+import os
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+from zeus_ci import logger, config
+from zeus_ci.executors import DockerExecutor, get_executor
+
+
+class ContainerPool:
+    """
+    keeps a few started, idle containers per popular image on the build host so
+    DockerContainer.start can rename one into place instead of paying for a cold `docker run`.
+
+    idle containers are named `zeus-pool-<hex>` and labelled with the image they were started
+    from, claiming one renames it to the stage's container name. Builds run in separate processes,
+    so claims and the hit/miss counters are serialised with an flock on the pool directory.
+
+    the stats also count each image's idle containers, so a stage whose image has none (or on a
+    host nothing maintains a pool on) doesn't list containers or take the lock, its miss is
+    appended to requests.log and counted at the next maintenance.
+    """
+    pool_label = 'zeus-ci.pool'
+    pooled_at_label = 'zeus-ci.pooled-at'
+    name_prefix = 'zeus-pool-'
+
+    def __init__(self, state_dir: str = None):
+        pool_config = config.runner.get('container_pool', {})
+        self.enabled = pool_config.get('enabled', True)
+        self.size = pool_config.get('size', 1)  # idle containers kept per image
+        self.max_images = pool_config.get('max_images', 5)
+        self.idle_ttl = pool_config.get('idle_ttl_sec', 30 * 60)
+        self.popular_window = pool_config.get('popular_window_sec', 24 * 60 * 60)
+        self.maintenance_interval = pool_config.get('maintenance_sec', 30)
+        self.state_dir = state_dir or pool_config.get('state_dir', '/tmp/zeus-ci/pool')
+
+    @contextmanager
+    def _locked_stats(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(os.path.join(self.state_dir, 'pool.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                stats = self._read_stats()
+                self._count_requests(stats)
+                yield stats
+                tmp_path = os.path.join(self.state_dir, '.stats.json')
+                with open(tmp_path, 'w') as f:
+                    json.dump(stats, f)
+                os.replace(tmp_path, os.path.join(self.state_dir, 'stats.json'))
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_stats(self) -> Dict[str, dict]:
+        try:
+            with open(os.path.join(self.state_dir, 'stats.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    @staticmethod
+    def _image_stats(stats: Dict[str, dict], image: str) -> dict:
+        return stats.setdefault(image, {'hits': 0, 'misses': 0, 'idle': 0})
+
+    def _count_requests(self, stats: Dict[str, dict]) -> None:
+        """
+        adds the misses appended to requests.log since to `stats`, called with the lock held
+        """
+        path = os.path.join(self.state_dir, 'requests.log')
+        counting = '{}.counting'.format(path)
+        try:
+            os.replace(path, counting)
+        except FileNotFoundError:
+            return
+        with open(counting) as f:
+            for line in f:
+                try:
+                    image, requested = json.loads(line)
+                except ValueError:
+                    continue
+                image_stats = self._image_stats(stats, image)
+                image_stats['misses'] += 1
+                image_stats['last_request'] = max(image_stats.get('last_request', 0), requested)
+        os.remove(counting)
+
+    def _request_missed(self, image: str) -> None:
+        # appends this short are atomic, so no lock is needed
+        try:
+            with open(os.path.join(self.state_dir, 'requests.log'), 'a') as f:
+                f.write('{}\n'.format(json.dumps([image, time.time()])))
+        except FileNotFoundError:
+            pass  # no pool has been maintained here
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        {image: {'hits': int, 'misses': int, 'idle': int, 'last_request': float}}
+        """
+        return self._read_stats()
+
+    def _idle(self, executor: DockerExecutor, image: str = None) -> List[dict]:
+        idle = [c for c in executor.list_containers(self.pool_label) if c['name'].startswith(self.name_prefix)]
+        if image is not None:
+            idle = [c for c in idle if c['labels'].get(self.pool_label) == image]
+        return sorted(idle, key=lambda c: float(c['labels'].get(self.pooled_at_label, 0)))
+
+    def claim(self, image: str, name: str, executor: DockerExecutor) -> bool:
+        """
+        renames an idle container of `image` to `name`
+        returns True on a pool hit, False if the caller needs to start its own container
+        """
+        if not self.enabled:
+            return False
+        if not self._read_stats().get(image, {}).get('idle'):
+            self._request_missed(image)
+            return False
+
+        with self._locked_stats() as stats:
+            image_stats = self._image_stats(stats, image)
+            image_stats['last_request'] = time.time()
+            idle = self._idle(executor, image)
+            for position, container in enumerate(idle):
+                if executor.rename(container['name'], name):
+                    logger.debug('claimed pooled container %s for %s', container['name'], name)
+                    image_stats['hits'] += 1
+                    image_stats['idle'] = len(idle) - position - 1
+                    return True
+            image_stats['misses'] += 1
+            image_stats['idle'] = 0
+            return False
+
+    def popular_images(self) -> List[str]:
+        recent = time.time() - self.popular_window
+        stats = [(s['hits'] + s['misses'], image) for image, s in self._read_stats().items()
+                 if s.get('last_request', 0) >= recent]
+        return [image for _, image in sorted(stats, reverse=True)[:self.max_images]]
+
+    def prefetch(self, images: Iterable[str], executor: DockerExecutor = None) -> None:
+        """
+        pulls any of `images` not already present on the host
+        """
+        executor = executor or get_executor()
+        for image in set(images):
+            if not executor.image_exists(image):
+                logger.info('pre-pulling image %s', image)
+                out = executor.pull(image)
+                if not out:
+                    logger.error('pre-pulling %s failed: %s', image, out.stderr)
+
+    def replenish(self, extra_images: Iterable[str] = (), executor: DockerExecutor = None) -> None:
+        """
+        tops up idle containers for the popular images, plus `extra_images` (eg. those needed by
+        queued builds), to `size` each
+        """
+        if not self.enabled:
+            return
+        executor = executor or get_executor()
+        with self._locked_stats():  # counts the misses logged since, for popular_images
+            pass
+        images = list(dict.fromkeys(list(extra_images) + self.popular_images()))[:self.max_images]
+        for image in images:
+            for _ in range(self.size - len(self._idle(executor, image))):
+                name = '{}{}'.format(self.name_prefix, uuid.uuid4().hex)
+                labels = {self.pool_label: image, self.pooled_at_label: str(time.time())}
+                out = executor.run_container(name, image, labels=labels)
+                if not out:
+                    logger.error('warming container for %s failed: %s', image, out.stderr)
+                    break
+                logger.debug('warmed container %s for %s', name, image)
+        self._count_idle(executor)
+
+    def _count_idle(self, executor: DockerExecutor) -> None:
+        """
+        records how many idle containers each image has, what claim checks before taking the lock
+        """
+        with self._locked_stats() as stats:
+            idle = {}
+            for container in self._idle(executor):
+                image = container['labels'].get(self.pool_label)
+                idle[image] = idle.get(image, 0) + 1
+            for image in set(stats) | set(idle):
+                self._image_stats(stats, image)['idle'] = idle.get(image, 0)
+
+    def evict(self, keep_images: Iterable[str] = (), executor: DockerExecutor = None) -> None:
+        """
+        removes idle containers older than `idle_ttl`, or of images that are no longer wanted
+        """
+        executor = executor or get_executor()
+        wanted = set(keep_images) | set(self.popular_images())
+        oldest = time.time() - self.idle_ttl
+        with self._locked_stats() as stats:  # dont remove a container from under a claim
+            for container in self._idle(executor):
+                image = container['labels'].get(self.pool_label)
+                pooled_at = float(container['labels'].get(self.pooled_at_label, 0))
+                if image not in wanted or pooled_at < oldest:
+                    logger.debug('evicting idle container %s of %s', container['name'], image)
+                    executor.remove(container['name'])
+                    if image in stats:
+                        stats[image]['idle'] = max(stats[image].get('idle', 0) - 1, 0)
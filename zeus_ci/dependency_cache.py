@@ -0,0 +1,156 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, List, Optional
+
+from zeus_ci import logger, config
+
+
+class DependencyCache:
+    """
+    host local store behind the save_cache / restore_cache steps. Entries are tars of the saved
+    paths, keyed by the rendered cache key and scoped per repo. Like CircleCI, an entry is
+    immutable once saved: saving an existing key is a no-op.
+
+    <root>/<scope>/<sha256(key)>.tar
+    <root>/index.json  {scope: {key: {'file': str, 'size': int, 'created': float}}}
+
+    the index is only rewritten under an exclusive flock (saves and eviction), restores take a
+    shared one to look a key up and open its tar. The tar's mtime is its last use for eviction.
+    """
+    def __init__(self, root: str = None, max_bytes: int = None):
+        cache_config = config.runner.get('dependency_cache', {})
+        self.enabled = cache_config.get('enabled', True)
+        self.root = root or cache_config.get('dir', '/var/cache/zeus-ci/dependencies')
+        self.max_bytes = max_bytes or cache_config.get('max_bytes', 20 * 1024 ** 3)
+
+    @staticmethod
+    def scope(clone_url: str) -> str:
+        return re.sub(r'[^A-Za-z0-9._-]+', '_', clone_url.split('://')[-1]).strip('_')
+
+    @contextmanager
+    def _lock(self, shared: bool = True):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'cache.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict[str, Dict[str, dict]]:
+        try:
+            with open(os.path.join(self.root, 'index.json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_index(self, index: Dict[str, Dict[str, dict]]) -> None:
+        tmp_path = os.path.join(self.root, '.index.json')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, os.path.join(self.root, 'index.json'))
+
+    def _entry_path(self, scope: str, entry: dict) -> str:
+        return os.path.join(self.root, scope, entry['file'])
+
+    def exists(self, scope: str, key: str) -> bool:
+        with self._lock():
+            return key in self._read_index().get(scope, {})
+
+    def open(self, scope: str, keys: List[str]) -> (Optional[str], Optional[BinaryIO]):
+        """
+        looks `keys` up in order, each matching exactly or else as a prefix of the most recently
+        saved key. Returns the matched key and its open tar, (None, None) on a miss. The file stays
+        readable even if it is evicted while the caller streams it.
+        """
+        with self._lock():
+            entries = self._read_index().get(scope, {})
+            for key in keys:
+                if key in entries:
+                    match = key
+                else:
+                    candidates = [(e['created'], k) for k, e in entries.items() if k.startswith(key)]
+                    if not candidates:
+                        continue
+                    match = max(candidates)[1]
+                path = self._entry_path(scope, entries[match])
+                try:
+                    fileobj = open(path, 'rb')
+                except FileNotFoundError:
+                    logger.error('dependency cache entry %s is missing %s', match, path)
+                    continue
+                os.utime(path)
+                return match, fileobj
+        return None, None
+
+    def writer(self, scope: str) -> (str, BinaryIO):
+        """
+        returns a temporary path, and the file open on it, for a tar being saved. Pass the path to
+        `commit` once it is written
+        """
+        os.makedirs(os.path.join(self.root, scope), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, scope), prefix='.save-')
+        return tmp_path, os.fdopen(fd, 'wb')
+
+    def commit(self, scope: str, key: str, tmp_path: str) -> bool:
+        """
+        moves a tar written through `writer` into place under `key`
+        returns False (and drops the tar) if another build saved the key first
+        """
+        with self._lock(shared=False):
+            index = self._read_index()
+            entries = index.setdefault(scope, {})
+            if key in entries:
+                os.unlink(tmp_path)
+                return False
+            file_name = '{}.tar'.format(hashlib.sha256(key.encode()).hexdigest())
+            os.replace(tmp_path, os.path.join(self.root, scope, file_name))
+            entries[key] = {'file': file_name, 'size': os.stat(os.path.join(self.root, scope, file_name)).st_size,
+                            'created': time.time()}
+            self._evict(index)
+            self._write_index(index)
+        return True
+
+    def discard(self, tmp_path: str) -> None:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        with self._lock(shared=False):
+            index = self._read_index()
+            self._evict(index)
+            self._write_index(index)
+
+    def _evict(self, index: Dict[str, Dict[str, dict]]) -> None:
+        """
+        removes the least recently used entries until the store fits in `max_bytes`, must be
+        called holding the exclusive lock
+        """
+        entries = []
+        total = 0
+        for scope, scope_entries in index.items():
+            for key, entry in list(scope_entries.items()):
+                try:
+                    last_used = os.stat(self._entry_path(scope, entry)).st_mtime
+                except FileNotFoundError:
+                    del scope_entries[key]
+                    continue
+                total += entry['size']
+                entries.append((last_used, scope, key))
+
+        for _, scope, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry = index[scope].pop(key)
+            logger.info('evicting dependency cache %s of %s', key, scope)
+            os.unlink(self._entry_path(scope, entry))
+            total -= entry['size']
+        logger.debug('dependency cache at %s is %d bytes', self.root, total)
@@ -0,0 +1,63 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict
+
+from zeus_ci import config
+
+
+class DurationStore:
+    """
+    exponentially weighted moving averages of how long each job of a repo takes, used to run the
+    stages on a workflow's critical path first
+
+    <dir>/<repo scope>.json  {job: {'estimate': seconds, 'runs': int}}
+    """
+    def __init__(self, root: str = None, alpha: float = None):
+        durations_config = config.runner.get('stage_durations', {})
+        self.root = root or durations_config.get('dir', '/var/cache/zeus-ci/durations')
+        self.alpha = alpha or durations_config.get('alpha', 0.3)  # weight of the newest run
+
+    def _path(self, scope: str) -> str:
+        return os.path.join(self.root, '{}.json'.format(scope))
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self, scope: str) -> Dict[str, dict]:
+        try:
+            with open(self._path(scope)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def estimates(self, scope: str) -> Dict[str, float]:
+        """
+        {job: estimated seconds} of the jobs of `scope` that have run before
+        """
+        return {job: stats['estimate'] for job, stats in self._read(scope).items()}
+
+    def record(self, scope: str, durations: Dict[str, float]) -> None:
+        """
+        folds the {job: seconds} of a finished workflow into the estimates
+        """
+        if not durations:
+            return
+        with self._lock():
+            stored = self._read(scope)
+            for job, seconds in durations.items():
+                stats = stored.setdefault(job, {'estimate': seconds, 'runs': 0})
+                stats['estimate'] = self.alpha * seconds + (1 - self.alpha) * stats['estimate']
+                stats['runs'] += 1
+            tmp_path = '{}.tmp'.format(self._path(scope))
+            with open(tmp_path, 'w') as f:
+                json.dump(stored, f)
+            os.replace(tmp_path, self._path(scope))
@@ -0,0 +1,477 @@
+import http.client
+import json
+import os
+import selectors
+import socket
+import subprocess
+import threading
+import time
+import urllib.parse
+from collections import deque
+from subprocess import PIPE
+from typing import BinaryIO, Callable, Dict, List
+
+from zeus_ci import logger, config
+from zeus_ci.tracing import tracer
+
+STDOUT = 1
+STDERR = 2
+CHUNK_SIZE = 64 * 1024
+
+
+class TailBuffer:
+    """
+    keeps (at least) the last `max_bytes` written to each stream, older output is dropped a chunk
+    at a time so memory use stays fixed no matter how noisy a process is
+    """
+    def __init__(self, max_bytes: int = CHUNK_SIZE):
+        self.max_bytes = max_bytes
+        self._chunks = {STDOUT: deque(), STDERR: deque()}
+        self._sizes = {STDOUT: 0, STDERR: 0}
+
+    def write(self, stream: int, data: bytes) -> None:
+        if stream not in self._chunks:
+            stream = STDOUT
+        if len(data) > self.max_bytes:
+            data = data[-self.max_bytes:]
+        chunks = self._chunks[stream]
+        chunks.append(data)
+        self._sizes[stream] += len(data)
+        while self._sizes[stream] - len(chunks[0]) >= self.max_bytes:
+            self._sizes[stream] -= len(chunks.popleft())
+
+    def getvalue(self, stream: int) -> bytes:
+        return b''.join(self._chunks[stream])[-self.max_bytes:]
+
+
+OutputSink = Callable[[int, bytes], None]
+
+
+def _tee(tail: TailBuffer, sink: OutputSink = None) -> OutputSink:
+    if sink is None:
+        return tail.write
+
+    def write(stream: int, data: bytes) -> None:
+        sink(stream, data)
+        tail.write(stream, data)
+    return write
+
+
+class ProcessOutput:
+    """
+    Represents output from a process
+
+    Evaluates to True if process returncode == 0, False otherwise
+    """
+    def __init__(self, stdout: bytes, stderr: bytes, returncode: int):
+        self.stdout = stdout.decode(errors='replace')
+        self.stderr = stderr.decode(errors='replace')
+        self.returncode = returncode
+
+    def __nonzero__(self):
+        return self.__bool__()
+
+    def __bool__(self):
+        if self.returncode == 0:
+            return True
+        return False
+
+    @property
+    def output(self):
+        return f'==stdout==\n{self.stdout}\n\n\n==stderr==\n{self.stderr}\n'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(returncode={self.returncode})'
+
+    @classmethod
+    def from_tail(cls, tail: TailBuffer, returncode: int) -> 'ProcessOutput':
+        return cls(tail.getvalue(STDOUT), tail.getvalue(STDERR), returncode)
+
+
+def _exec(cmd: list) -> ProcessOutput:
+    proc = subprocess.Popen(cmd, stderr=PIPE, stdout=PIPE)
+    stdout, stderr = proc.communicate()
+    process_output = ProcessOutput(stdout, stderr, proc.returncode)
+    return process_output
+
+
+def _feed_stdin(stdin: BinaryIO, write: Callable[[bytes], None], close: Callable[[], None]) -> threading.Thread:
+    """
+    copies `stdin` to `write` from a background thread, calling `close` once it is exhausted
+    """
+    def feed():
+        try:
+            for chunk in iter(lambda: stdin.read(CHUNK_SIZE), b''):
+                write(chunk)
+        except OSError as e:
+            logger.error('writing to process stdin failed: %s', e)
+        finally:
+            try:
+                close()
+            except OSError:
+                pass  # the process already went away
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+    return thread
+
+
+def _stream_exec(cmd: list, sink: OutputSink = None, stdin: BinaryIO = None) -> ProcessOutput:
+    """
+    like `_exec` but hands output to `sink` in chunks as it is produced, only a bounded tail of it
+    is kept on the returned ProcessOutput
+    """
+    tail = TailBuffer()
+    write = _tee(tail, sink)
+    proc = subprocess.Popen(cmd, stderr=PIPE, stdout=PIPE, stdin=PIPE if stdin is not None else None)
+    if stdin is not None:
+        _feed_stdin(stdin, proc.stdin.write, proc.stdin.close)
+    with selectors.DefaultSelector() as selector:
+        selector.register(proc.stdout, selectors.EVENT_READ, STDOUT)
+        selector.register(proc.stderr, selectors.EVENT_READ, STDERR)
+        while selector.get_map():
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, CHUNK_SIZE)
+                if not chunk:
+                    selector.unregister(key.fileobj)
+                    continue
+                write(key.data, chunk)
+    return ProcessOutput.from_tail(tail, proc.wait())
+
+
+class DockerExecutor:
+    """
+    talks to docker on behalf of a single DockerContainer. Subclasses decide how the commands
+    actually get to the docker daemon.
+    """
+    def run_container(self, name: str, image: str, labels: Dict[str, str] = None) -> ProcessOutput:
+        raise NotImplementedError()
+
+    def pull(self, image: str) -> ProcessOutput:
+        raise NotImplementedError()
+
+    def image_exists(self, image: str) -> bool:
+        raise NotImplementedError()
+
+    def list_containers(self, label: str) -> List[dict]:
+        """
+        returns [{'name': str, 'labels': dict}, ...] for every container (running or not) with `label`
+        """
+        raise NotImplementedError()
+
+    def rename(self, name: str, new_name: str) -> ProcessOutput:
+        raise NotImplementedError()
+
+    def exec(self, name: str, command: str, env: List[str] = None, workdir: str = None,
+             sink: OutputSink = None, stdin: BinaryIO = None) -> ProcessOutput:
+        """
+        runs `command` in the container, output is passed to `sink(stream, chunk)` as it arrives and
+        only its tail is kept on the returned ProcessOutput. `stdin` is streamed to the command then
+        closed, so it can be used to pipe archives in.
+        """
+        raise NotImplementedError()
+
+    def remove(self, name: str) -> ProcessOutput:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class DockerCliExecutor(DockerExecutor):
+    """
+    the original implementation - forks a `docker` process for every operation
+    """
+    def run_container(self, name: str, image: str, labels: Dict[str, str] = None) -> ProcessOutput:
+        cmd = ['docker', 'run', '--detach', '-ti', '--name', name]
+        for key, value in (labels or {}).items():
+            cmd.extend(['--label', '{}={}'.format(key, value)])
+        cmd.append(image)
+        return _exec(cmd)
+
+    def pull(self, image: str) -> ProcessOutput:
+        with tracer.span('docker pull', image=image) as span:
+            out = _exec(['docker', 'pull', '--quiet', image])
+            span.outcome = 'ok' if out else 'failed'
+        return out
+
+    def image_exists(self, image: str) -> bool:
+        return bool(_exec(['docker', 'image', 'inspect', image]))
+
+    def list_containers(self, label: str) -> List[dict]:
+        out = _exec(['docker', 'ps', '--all', '--filter', 'label={}'.format(label),
+                     '--format', '{{.Names}}\t{{.Labels}}'])
+        containers = []
+        for line in out.stdout.splitlines():
+            name, _, labels = line.partition('\t')
+            containers.append({
+                'name': name,
+                'labels': dict(l.split('=', 1) for l in labels.split(',') if '=' in l),
+            })
+        return containers
+
+    def rename(self, name: str, new_name: str) -> ProcessOutput:
+        return _exec(['docker', 'rename', name, new_name])
+
+    def exec(self, name: str, command: str, env: List[str] = None, workdir: str = None,
+             sink: OutputSink = None, stdin: BinaryIO = None) -> ProcessOutput:
+        cmd = ['docker', 'exec']
+        if stdin is not None:
+            cmd.append('-i')
+        if workdir is not None:
+            cmd.extend(['-w', workdir])
+        for var in env or []:
+            cmd.extend(['-e', var])
+        cmd.append(name)
+        cmd.extend(['sh', '-c', command])
+        return _stream_exec(cmd, sink, stdin)
+
+    def remove(self, name: str) -> ProcessOutput:
+        return _exec(['docker', 'rm', '-f', name])
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerEngineError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f'{status}: {message}')
+        self.status = status
+        self.message = message
+
+
+class DockerEngineExecutor(DockerExecutor):
+    """
+    speaks the Docker Engine HTTP API over the daemon's unix socket, so no process is launched per
+    operation. One keep-alive connection is held open for the lifetime of the container, exec
+    streams get their own short lived socket as docker hijacks the connection for them.
+    """
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._connection = None
+        # how long an exec's exit code may take to show up once its output has ended
+        self.exit_code_timeout_sec = config.runner.get('exec_exit_code_timeout_sec', 30)
+
+    def _request(self, method: str, path: str, query: dict = None, body=None,
+                 headers: dict = None) -> http.client.HTTPResponse:
+        if query:
+            path = '{}?{}'.format(path, urllib.parse.urlencode(query))
+        headers = dict(headers or {})
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = UnixHTTPConnection(self.socket_path)
+            try:
+                self._connection.request(method, path, body=body, headers=headers)
+                return self._connection.getresponse()
+            except (ConnectionError, http.client.HTTPException):
+                # the daemon closed our keep-alive connection, reconnect once
+                self.close()
+                if attempt:
+                    raise
+
+    def _call(self, method: str, path: str, query: dict = None, body=None, headers: dict = None):
+        response = self._request(method, path, query=query, body=body, headers=headers)
+        data = response.read()
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get('message', '')
+            except ValueError:
+                message = data.decode(errors='replace')
+            raise DockerEngineError(response.status, message)
+        if data and response.getheader('Content-Type', '').startswith('application/json'):
+            return json.loads(data)
+        return data
+
+    @staticmethod
+    def _error_output(e: Exception) -> ProcessOutput:
+        return ProcessOutput(b'', str(e).encode(), 1)
+
+    def _pull(self, image: str) -> None:
+        repository, _, tag = image.rpartition(':')
+        if not repository or '/' in tag:
+            repository, tag = image, 'latest'
+        logger.debug('pulling image %s:%s', repository, tag)
+        with tracer.span('docker pull', image=image):
+            response = self._request('POST', '/images/create', query={'fromImage': repository, 'tag': tag})
+            # progress is streamed back as json lines until the pull completes, failures mid pull are
+            # reported as an `error` line rather than a http status
+            for line in response.read().splitlines():
+                try:
+                    progress = json.loads(line)
+                except ValueError:
+                    continue
+                if response.status >= 400 or progress.get('error'):
+                    raise DockerEngineError(response.status, progress.get('error') or progress.get('message', ''))
+
+    def pull(self, image: str) -> ProcessOutput:
+        try:
+            self._pull(image)
+        except (DockerEngineError, OSError) as e:
+            return self._error_output(e)
+        return ProcessOutput(image.encode(), b'', 0)
+
+    def image_exists(self, image: str) -> bool:
+        try:
+            self._call('GET', '/images/{}/json'.format(image))
+        except DockerEngineError:
+            return False
+        return True
+
+    def list_containers(self, label: str) -> List[dict]:
+        containers = self._call('GET', '/containers/json',
+                                query={'all': 'true', 'filters': json.dumps({'label': [label]})})
+        return [{'name': c['Names'][0].lstrip('/'), 'labels': c.get('Labels') or {}} for c in containers]
+
+    def rename(self, name: str, new_name: str) -> ProcessOutput:
+        try:
+            self._call('POST', '/containers/{}/rename'.format(name), query={'name': new_name})
+        except (DockerEngineError, OSError) as e:
+            return self._error_output(e)
+        return ProcessOutput(new_name.encode(), b'', 0)
+
+    def run_container(self, name: str, image: str, labels: Dict[str, str] = None) -> ProcessOutput:
+        body = {'Image': image, 'Tty': True, 'OpenStdin': True, 'Labels': dict(labels or {})}
+        try:
+            try:
+                container = self._call('POST', '/containers/create', query={'name': name}, body=body)
+            except DockerEngineError as e:
+                if e.status != 404:
+                    raise
+                self._pull(image)
+                container = self._call('POST', '/containers/create', query={'name': name}, body=body)
+            self._call('POST', '/containers/{}/start'.format(name))
+        except (DockerEngineError, OSError) as e:
+            logger.error('failed to start container %s: %s', name, e)
+            return self._error_output(e)
+        return ProcessOutput(container['Id'].encode(), b'', 0)
+
+    def exec(self, name: str, command: str, env: List[str] = None, workdir: str = None,
+             sink: OutputSink = None, stdin: BinaryIO = None) -> ProcessOutput:
+        body = {
+            'AttachStdin': stdin is not None,
+            'AttachStdout': True,
+            'AttachStderr': True,
+            'Tty': False,
+            'Env': list(env or []),
+            'Cmd': ['sh', '-c', command],
+        }
+        if workdir is not None:
+            body['WorkingDir'] = workdir
+
+        tail = TailBuffer()
+        try:
+            exec_id = self._call('POST', '/containers/{}/exec'.format(name), body=body)['Id']
+            self._exec_start(exec_id, _tee(tail, sink), stdin)
+            returncode = self._exec_exit_code(exec_id, name)
+        except (DockerEngineError, OSError) as e:
+            logger.error('exec in %s failed: %s', name, e)
+            return self._error_output(e)
+        return ProcessOutput.from_tail(tail, returncode)
+
+    def _exec_start(self, exec_id: str, write: OutputSink, stdin: BinaryIO = None) -> None:
+        body = json.dumps({'Detach': False, 'Tty': False}).encode()
+        request = (
+            'POST /exec/{}/start HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Content-Type: application/json\r\n'
+            'Content-Length: {}\r\n'
+            'Connection: Upgrade\r\n'
+            'Upgrade: tcp\r\n'
+            '\r\n'
+        ).format(exec_id, len(body)).encode() + body
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            sock.sendall(request)
+            stream = sock.makefile('rb')
+
+            status_line = stream.readline().decode()
+            status = int(status_line.split(' ', 2)[1])
+            while stream.readline() not in (b'\r\n', b'\n', b''):
+                pass
+            if status not in (101, 200):
+                raise DockerEngineError(status, stream.read().decode(errors='replace'))
+
+            if stdin is not None:
+                # half closing the hijacked socket is how docker learns stdin hit EOF
+                _feed_stdin(stdin, sock.sendall, lambda: sock.shutdown(socket.SHUT_WR))
+
+            # docker multiplexes stdout and stderr over the one stream, each frame is prefixed
+            # with an 8 byte header of [stream_type, 0, 0, 0, size(uint32 big endian)]
+            while True:
+                header = stream.read(8)
+                if len(header) < 8:
+                    break
+                remaining = int.from_bytes(header[4:], 'big')
+                while remaining:
+                    chunk = stream.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        return
+                    write(header[0], chunk)
+                    remaining -= len(chunk)
+
+    def _exec_exit_code(self, exec_id: str, name: str) -> int:
+        """
+        docker never records an exit code for an exec whose container died under it, so this gives
+        up once the container isn't running (or is gone), or after `exit_code_timeout_sec`
+        """
+        deadline = time.monotonic() + self.exit_code_timeout_sec
+        stopped = False
+        while True:
+            info = self._call('GET', '/exec/{}/json'.format(exec_id))
+            if not info.get('Running') and info.get('ExitCode') is not None:
+                return info['ExitCode']
+            if stopped:
+                raise DockerEngineError(409, 'container {} stopped before exec {} exited'.format(name, exec_id))
+            if time.monotonic() > deadline:
+                raise DockerEngineError(504, 'no exit code for exec {} after {}s'.format(
+                    exec_id, self.exit_code_timeout_sec))
+            # polled once more after it's seen stopped, the exec may have exited just before
+            stopped = not self._call('GET', '/containers/{}/json'.format(name)).get('State', {}).get('Running')
+            time.sleep(0.05)
+
+    def remove(self, name: str) -> ProcessOutput:
+        try:
+            self._call('DELETE', '/containers/{}'.format(name), query={'force': 'true'})
+        except (DockerEngineError, OSError) as e:
+            return self._error_output(e)
+        return ProcessOutput(name.encode(), b'', 0)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def docker_socket_path() -> str:
+    docker_host = config.runner.get('docker_host') or os.getenv('DOCKER_HOST') or 'unix:///var/run/docker.sock'
+    if not docker_host.startswith('unix://'):
+        raise ValueError('only unix:// docker hosts are supported by the engine executor, got {}'.format(
+            docker_host))
+    return docker_host[len('unix://'):]
+
+
+executors = {
+    'cli': DockerCliExecutor,
+    'engine': lambda: DockerEngineExecutor(docker_socket_path()),
+}
+
+
+def get_executor(name: str = None) -> DockerExecutor:
+    """
+    :param name: one of `executors`, defaults to `runner.docker_executor` from the config
+    """
+    return executors[name or config.runner.get('docker_executor', 'engine')]()
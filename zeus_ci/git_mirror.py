@@ -0,0 +1,167 @@
+import fcntl
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+from subprocess import PIPE
+from typing import List, Optional
+
+from zeus_ci import logger, config
+from zeus_ci.executors import _exec
+
+
+class GitMirror:
+    """
+    per repo bare mirrors on the build host. Each build does one incremental fetch into the mirror
+    and exports a single checkout of its ref from it, which stages then stream into their
+    containers rather than cloning from the remote.
+
+    mirrors are shared by every build process on the host, so updates take an exclusive flock on
+    the mirror and exports a shared one.
+    """
+    def __init__(self, root: str = None, max_repos: int = None, max_age_days: float = None,
+                 checkout_depth: int = None):
+        mirror_config = config.runner.get('git_mirror', {})
+        self.enabled = mirror_config.get('enabled', True)
+        self.root = root or mirror_config.get('dir', '/var/cache/zeus-ci/mirrors')
+        self.max_repos = max_repos or mirror_config.get('max_repos', 50)
+        self.max_age_days = max_age_days or mirror_config.get('max_age_days', 14)
+        # 0 for the whole history
+        self.checkout_depth = checkout_depth if checkout_depth is not None else mirror_config.get('checkout_depth', 1)
+
+    def path(self, clone_url: str) -> str:
+        name = re.sub(r'[^A-Za-z0-9._-]+', '_', clone_url.split('://')[-1]).strip('_')
+        if not name.endswith('.git'):
+            name += '.git'
+        return os.path.join(self.root, name)
+
+    @contextmanager
+    def _lock(self, mirror_path: str, shared: bool = False, blocking: bool = True):
+        with open('{}.lock'.format(mirror_path), 'a') as lock_file:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            fcntl.flock(lock_file, flags)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def update(self, clone_url: str) -> bool:
+        """
+        clones a new mirror of `clone_url`, or fetches into the existing one
+        returns True if the mirror is usable
+        """
+        os.makedirs(self.root, exist_ok=True)
+        mirror_path = self.path(clone_url)
+        with self._lock(mirror_path):
+            if os.path.isdir(mirror_path):
+                logger.debug('fetching %s into mirror %s', clone_url, mirror_path)
+                out = _exec(['git', '--git-dir', mirror_path, 'fetch', '--prune', '--quiet', 'origin'])
+            else:
+                logger.info('creating mirror of %s at %s', clone_url, mirror_path)
+                tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.clone-')
+                out = _exec(['git', 'clone', '--mirror', '--quiet', clone_url, tmp_path])
+                if out:
+                    os.rename(tmp_path, mirror_path)
+                else:
+                    shutil.rmtree(tmp_path, ignore_errors=True)
+
+            if not out:
+                logger.error('updating mirror of %s failed: %s', clone_url, out.stderr)
+                return False
+            os.utime(mirror_path)  # mtime doubles as last use for eviction
+
+        self.evict()
+        return True
+
+    def export(self, clone_url: str, ref: str, dest: str, full_history: bool = False) -> bool:
+        """
+        creates a working copy of `ref` at `dest` from the mirror, with origin pointed back at
+        `clone_url` so it looks the same as a fresh clone from inside the container. Only the last
+        `checkout_depth` commits leading to `ref` are exported, unless `full_history` (eg. for `git
+        describe`) or checkout_depth is 0, then it's a clone of the whole mirror
+        """
+        mirror_path = self.path(clone_url)
+        with self._lock(mirror_path, shared=True):
+            if full_history or not self.checkout_depth:
+                # local clones hardlink objects rather than copy them
+                commands = [['git', 'clone', '--quiet', '--no-checkout', mirror_path, dest],
+                            ['git', '-C', dest, 'checkout', '--quiet', ref],
+                            ['git', '-C', dest, 'remote', 'set-url', 'origin', clone_url]]
+            else:
+                out = _exec(['git', '--git-dir', mirror_path, 'rev-parse', '--verify', '--quiet',
+                             '{}^{{commit}}'.format(ref)])
+                if not out:
+                    logger.error('%s is not in the mirror of %s', ref, clone_url)
+                    return False
+                commit = out.stdout.strip()
+                # fetched by sha, so it needn't be the tip of a branch any more. --depth is ignored for
+                # plain local paths
+                commands = [['git', 'init', '--quiet', dest],
+                            ['git', '-C', dest, 'fetch', '--quiet', '--depth', str(self.checkout_depth),
+                             '--upload-pack', 'git -c uploadpack.allowAnySHA1InWant=true upload-pack',
+                             'file://{}'.format(mirror_path), commit],
+                            ['git', '-C', dest, 'checkout', '--quiet', '--detach', commit],
+                            ['git', '-C', dest, 'remote', 'add', 'origin', clone_url]]
+            for cmd in commands:
+                out = _exec(cmd)
+                if not out:
+                    logger.error('exporting %s of %s from mirror failed: %s', ref, clone_url, out.stderr)
+                    return False
+        return True
+
+    def commit(self, clone_url: str, ref: str) -> Optional[str]:
+        """
+        the sha of the commit `ref` points to in the mirror
+        """
+        mirror_path = self.path(clone_url)
+        with self._lock(mirror_path, shared=True):
+            out = _exec(['git', '--git-dir', mirror_path, 'rev-parse', '--verify', '--quiet',
+                         '{}^{{commit}}'.format(ref or 'HEAD')])
+        return out.stdout.strip() if out else None
+
+    def changed_files(self, clone_url: str, base: str, commit: str) -> Optional[List[str]]:
+        """
+        the files that differ between `base` and `commit` in the mirror, None if either is missing
+        (eg. `base` was force pushed away)
+        """
+        mirror_path = self.path(clone_url)
+        with self._lock(mirror_path, shared=True):
+            out = _exec(['git', '--git-dir', mirror_path, 'diff', '--name-only', '--no-renames', '-z', base, commit])
+        if not out:
+            return None
+        return sorted(path for path in out.stdout.split('\0') if path)
+
+    @staticmethod
+    def archive(checkout_dir: str) -> subprocess.Popen:
+        """
+        returns a `tar` process streaming the contents of `checkout_dir` on its stdout
+        """
+        return subprocess.Popen(['tar', '-c', '-f', '-', '-C', checkout_dir, '.'], stdout=PIPE)
+
+    def evict(self) -> None:
+        """
+        removes mirrors not used for `max_age_days`, then the least recently used ones beyond
+        `max_repos`. Mirrors locked by another build are left alone.
+        """
+        mirrors = []
+        for name in os.listdir(self.root):
+            mirror_path = os.path.join(self.root, name)
+            if name.endswith('.git') and os.path.isdir(mirror_path):
+                mirrors.append((os.stat(mirror_path).st_mtime, mirror_path))
+        mirrors.sort(reverse=True)
+
+        oldest = time.time() - self.max_age_days * 24 * 60 * 60
+        for index, (last_used, mirror_path) in enumerate(mirrors):
+            if index < self.max_repos and last_used >= oldest:
+                continue
+            try:
+                with self._lock(mirror_path, blocking=False):
+                    logger.info('evicting git mirror %s', mirror_path)
+                    shutil.rmtree(mirror_path, ignore_errors=True)
+            except BlockingIOError:
+                logger.debug('mirror %s in use, not evicting', mirror_path)
@@ -0,0 +1,102 @@
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional
+
+from zeus_ci import logger, config
+from zeus_ci.build_plan import ref_names
+
+# steps that hand files between stages, a stage using them can't be replaced by a past result
+# because the files it would persist (or the ones it was given) aren't kept
+workspace_steps = ('persist_to_workspace', 'attach_workspace')
+
+
+def uses_workspace(job: dict) -> bool:
+    return any(isinstance(step, dict) and any(key in step for key in workspace_steps)
+               for step in job.get('steps') or [])
+
+
+def result_key(commit: str, job: dict, env_vars: List[str], run_condition: Dict[str, re.Pattern],
+               node_index: int = None, node_total: int = None) -> str:
+    """
+    hashes everything that goes into running a job: the commit, the job's spec, the build's env and
+    which shard it is. A job's scripts can read ZEUS_BRANCH and ZEUS_TAG however they like, so they
+    are part of the key unless the job opts in with `reuse_across_refs: true`. Then they're only part
+    of it when its run_when or spec refers to them, and a commit that passed on one branch isn't
+    rebuilt when it's pushed to another or tagged.
+    """
+    spec = json.dumps(job, sort_keys=True, default=str)
+    if not job.get('reuse_across_refs'):
+        return _hash([commit, spec, sorted(env_vars), node_index, node_total])
+    branch, tag = ref_names(env_vars)
+    env = sorted(env_var for env_var in env_vars if not env_var.startswith(('ZEUS_BRANCH=', 'ZEUS_TAG=')))
+    if 'branch' in run_condition or 'ZEUS_BRANCH' in spec or '.Branch' in spec:
+        env.append('ZEUS_BRANCH={}'.format(branch))
+    if 'tag' in run_condition or 'ZEUS_TAG' in spec:
+        env.append('ZEUS_TAG={}'.format(tag))
+    return _hash([commit, spec, env, node_index, node_total])
+
+
+def _hash(key: list) -> str:
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
+
+
+class ResultStore:
+    """
+    jobs that passed, keyed by `result_key`, so an identical job (the same job in another workflow,
+    or one that opted in built for another ref) is reported as passed from here rather than run again
+
+    <dir>/<repo scope>/<key>.json  {build_id, workflow, stage, log, duration, finished}
+    """
+    def __init__(self, root: str = None, enabled: bool = None, max_age_days: float = None):
+        results_config = config.runner.get('job_results', {})
+        self.enabled = results_config.get('enabled', True) if enabled is None else enabled
+        self.root = root or results_config.get('dir', '/var/cache/zeus-ci/results')
+        self.max_age_days = max_age_days or results_config.get('max_age_days', 30)
+
+    def _path(self, scope: str, key: str) -> str:
+        return os.path.join(self.root, scope, '{}.json'.format(key))
+
+    def get(self, scope: str, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(scope, key)) as f:
+                result = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if result.get('finished', 0) < time.time() - self.max_age_days * 86400:
+            return None
+        return result
+
+    def put(self, scope: str, key: str, result: dict) -> None:
+        if not self.enabled:
+            return
+        path = self._path(scope, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(result, finished=time.time()), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error('could not record the result of %s: %s', result.get('stage'), e)
+
+    def evict(self) -> None:
+        """
+        removes results older than max_age_days
+        """
+        cutoff = time.time() - self.max_age_days * 86400
+        if not os.path.isdir(self.root):
+            return
+        for scope in os.listdir(self.root):
+            scope_dir = os.path.join(self.root, scope)
+            for name in os.listdir(scope_dir):
+                path = os.path.join(scope_dir, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
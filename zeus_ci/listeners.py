@@ -7,8 +7,9 @@ from flask import Flask
 from sqlalchemy.orm.exc import NoResultFound
 
 from zeus_ci import Status, Config
+from zeus_ci.build_notifier import notify_build
 from zeus_ci.persistence import Database, Build, Repo, User
-from zeus_ci.scm_reporter import Github, TokenAuth, GithubStatus
+from zeus_ci.scm_reporter import GithubStatus, status_reporter
 
 WebhookProviders = Enum('WebhookProviders', 'github')
 
@@ -73,9 +74,9 @@ def make_github_webhook(app, database):
                 repo.builds.append(build)
 
                 session.commit()
+                notify_build(build.id)
 
-                github = Github(TokenAuth(user.token))
-                github.update_status(build, GithubStatus.pending)
+                status_reporter().report(build, GithubStatus.pending)
 
 
 def main():
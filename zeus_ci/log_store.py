@@ -0,0 +1,336 @@
+import bisect
+import json
+import os
+import shutil
+import threading
+import time
+import zlib
+from typing import Dict, Iterator, List
+
+from zeus_ci import logger, config
+
+
+class LogWriter:
+    """
+    writes a stage's log as independently zlib compressed chunks, with a json lines index beside
+    them so readers can find any byte offset or step without decompressing what comes before it.
+
+    <path>/index.jsonl    {'chunks': <file>, 'version': 1}
+                          {'chunk': <file offset>, 'length': <compressed>, 'offset': <log offset>, 'size': int, 'time': float}
+                          {'step': <name>, 'offset': <log offset>, 'time': float}
+                          {'end': <log size>, 'time': float}
+    <path>/<chunks file>  concatenated compressed chunks
+
+    a chunk is cut every `chunk_size` bytes, at every step boundary (so steps start on a chunk),
+    and at most `flush_interval` seconds after output arrives so running builds can be tailed.
+    """
+    version = 1
+
+    def __init__(self, path: str, chunk_size: int = None, flush_interval: float = None, level: int = None):
+        logs_config = config.runner.get('logs', {})
+        self.path = path
+        self.chunk_size = chunk_size or logs_config.get('chunk_size', 256 * 1024)
+        self.flush_interval = flush_interval or logs_config.get('flush_sec', 1)
+        self.level = level or logs_config.get('compression_level', 6)
+        self._lock = threading.Lock()
+        self._buffer = bytearray()
+        self._timer = None
+        self._chunks = None
+        self._index = None
+        self.size = 0
+
+    def open(self) -> 'LogWriter':
+        os.makedirs(self.path, exist_ok=True)
+        # a retried build writes to the same path, carry on after what is already there
+        reader = LogReader(self.path)
+        chunks_name = reader.chunks_name if reader.exists() else 'chunks-0.z'
+        self.size = reader.size
+        reader.close()
+        self._chunks = open(os.path.join(self.path, chunks_name), 'ab')
+        self._index = open(os.path.join(self.path, 'index.jsonl'), 'a', buffering=1)
+        if not reader.exists():
+            self._record({'chunks': chunks_name, 'version': self.version})
+        return self
+
+    def _record(self, record: dict) -> None:
+        self._index.write(json.dumps(record) + '\n')
+
+    def write(self, data: bytes) -> None:
+        with self._lock:
+            self._buffer += data
+            if len(self._buffer) >= self.chunk_size:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def _flush(self, at: float = None) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer or self._chunks is None:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        compressed = zlib.compress(data, self.level)
+        file_offset = self._chunks.tell()
+        self._chunks.write(compressed)
+        self._chunks.flush()
+        # the chunk has to be on disk before the index points at it
+        self._record({'chunk': file_offset, 'length': len(compressed), 'offset': self.size, 'size': len(data),
+                      'time': at or time.time()})
+        self.size += len(data)
+
+    def begin_step(self, name: str) -> None:
+        with self._lock:
+            self._flush()
+            self._record({'step': name, 'offset': self.size, 'time': time.time()})
+
+    def close(self) -> None:
+        with self._lock:
+            if self._chunks is None:
+                return
+            self._flush()
+            self._record({'end': self.size, 'time': time.time()})
+            self._chunks.close()
+            self._index.close()
+            self._chunks = self._index = None
+
+
+class LogReader:
+    """
+    random access to a log written by LogWriter. `refresh` only parses index records appended
+    since the last call, so following a running log stays cheap.
+
+    the chunks file is held open, so a reader keeps working on the log as it was indexed when
+    compaction replaces the chunks file under it, until its next `refresh` picks up the new one.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks_name = None
+        self.offsets: List[int] = []
+        self.chunks: List[dict] = []
+        self.steps: List[dict] = []
+        self.ended = False
+        self.ended_at = None
+        self.size = 0
+        self._index_pos = 0
+        self._index_inode = None
+        self._chunks = None  # the open chunks file, named `chunks_name`
+        self.refresh()
+
+    def exists(self) -> bool:
+        return self.chunks_name is not None
+
+    def refresh(self) -> 'LogReader':
+        try:
+            self._refresh()
+        except FileNotFoundError:
+            # the chunks file was compacted away between reading the index and opening it, the
+            # index replacing it is already in place
+            self._reset(None)
+            self._refresh()
+        return self
+
+    def _refresh(self) -> None:
+        index_path = os.path.join(self.path, 'index.jsonl')
+        try:
+            index = open(index_path)
+        except FileNotFoundError:
+            return
+        with index:
+            inode = os.fstat(index.fileno()).st_ino
+            if inode != self._index_inode:
+                # compaction replaced the index, start over
+                self._reset(inode)
+            index.seek(self._index_pos)
+            for line in index:
+                if not line.endswith('\n'):
+                    break  # the writer is part way through this record
+                self._index_pos += len(line.encode())
+                self._apply(json.loads(line))
+        if self.chunks_name is not None and self._chunks is None:
+            self._chunks = open(os.path.join(self.path, self.chunks_name), 'rb')
+
+    def _reset(self, inode: int) -> None:
+        self.close()
+        self.chunks_name = None
+        self.offsets, self.chunks, self.steps = [], [], []
+        self.ended = False
+        self.ended_at = None
+        self.size = 0
+        self._index_pos = 0
+        self._index_inode = inode
+
+    def _apply(self, record: dict) -> None:
+        if 'chunks' in record:
+            self.chunks_name = record['chunks']
+        elif 'chunk' in record:
+            self.offsets.append(record['offset'])
+            self.chunks.append(record)
+            self.size = record['offset'] + record['size']
+            self.ended = False  # a retried build appending to the log
+        elif 'step' in record:
+            self.steps.append(record)
+            self.ended = False
+        elif 'end' in record:
+            self.ended = True
+            self.ended_at = record.get('time')
+
+    def close(self) -> None:
+        if self._chunks is not None:
+            self._chunks.close()
+            self._chunks = None
+
+    def step_range(self, step) -> (int, int):
+        """
+        returns the (start, end) log offsets of `step`, given by index or name
+        """
+        if isinstance(step, int):
+            number = step
+        else:
+            number = [s['step'] for s in self.steps].index(step)
+        start = self.steps[number]['offset']
+        end = self.steps[number + 1]['offset'] if number + 1 < len(self.steps) else self.size
+        return start, end
+
+    def read(self, start: int = 0, end: int = None) -> bytes:
+        """
+        returns bytes [start, end) of the log, only decompressing the chunks that overlap them
+        """
+        end = self.size if end is None else min(end, self.size)
+        start = max(start, 0)
+        if start >= end:
+            return b''
+        out = bytearray()
+        for chunk in self.chunks[max(bisect.bisect_right(self.offsets, start) - 1, 0):]:
+            if chunk['offset'] >= end:
+                break
+            data = zlib.decompress(os.pread(self._chunks.fileno(), chunk['length'], chunk['chunk']))
+            out += data[max(start - chunk['offset'], 0):end - chunk['offset']]
+        return bytes(out)
+
+    def tail(self, nbytes: int) -> bytes:
+        return self.read(self.size - nbytes)
+
+    def follow(self, start: int = 0, poll_interval: float = 1) -> Iterator[bytes]:
+        """
+        yields the log from `start` as it is written, until the writer closes it
+        """
+        while True:
+            self.refresh()
+            if self.size > start:
+                yield self.read(start)
+                start = self.size
+            if self.ended:
+                return
+            time.sleep(poll_interval)
+
+
+class LogStore:
+    """
+    build logs live at <root>/<build_id>/<workflow>/<stage>/, see LogWriter for the format
+    """
+    def __init__(self, root: str = None, max_bytes: int = None, retention_days: float = None):
+        logs_config = config.runner.get('logs', {})
+        self.root = root or logs_config.get('dir', '/etc/zeus-ci/builds')
+        self.max_bytes = max_bytes or logs_config.get('max_bytes', 5 * 1024 ** 3)
+        self.retention_days = retention_days or logs_config.get('retention_days', 90)
+        self.active_sec = logs_config.get('active_sec', 60 * 60)
+        self.chunk_size = logs_config.get('chunk_size', 256 * 1024)
+
+    def path(self, build_id, workflow: str = None, stage: str = None) -> str:
+        return os.path.join(self.root, *[str(p) for p in (build_id, workflow, stage) if p is not None])
+
+    def stages(self, build_id) -> Dict[str, List[str]]:
+        """
+        {workflow: [stage, ...]} of the logs stored for `build_id`
+        """
+        build_path = self.path(build_id)
+        if not os.path.isdir(build_path):
+            return {}
+        return {workflow: sorted(os.listdir(os.path.join(build_path, workflow)))
+                for workflow in sorted(os.listdir(build_path))}
+
+    def compact(self, path: str) -> bool:
+        """
+        rewrites a finished log whose chunks were mostly cut by the flush timer into chunks of up
+        to `chunk_size`, keeping step boundaries and the times they were written at. Readers
+        already open keep reading the old chunks file until they refresh, new ones pick up the
+        replaced index.
+        returns True if the log was rewritten
+        """
+        reader = LogReader(path)
+        try:
+            return self._compact(path, reader)
+        finally:
+            reader.close()
+
+    def _compact(self, path: str, reader: LogReader) -> bool:
+        if not reader.ended or len(reader.chunks) <= 2 * (reader.size // self.chunk_size + len(reader.steps) + 1):
+            return False
+
+        generation = int(reader.chunks_name.split('-')[-1].split('.')[0]) + 1
+        tmp_index = os.path.join(path, '.index.jsonl')
+        try:
+            os.unlink(tmp_index)
+        except FileNotFoundError:
+            pass
+        writer = LogWriter(path, chunk_size=self.chunk_size)
+        writer._chunks = open(os.path.join(path, 'chunks-{}.z'.format(generation)), 'wb')
+        writer._index = open(tmp_index, 'w')
+        writer._record({'chunks': 'chunks-{}.z'.format(generation), 'version': LogWriter.version})
+        boundaries = [(step['offset'], step) for step in reader.steps] + [(reader.size, None)]
+        start = 0
+        for offset, step in boundaries:
+            for chunk_start in range(start, offset, self.chunk_size):
+                chunk_end = min(chunk_start + self.chunk_size, offset)
+                writer._buffer += reader.read(chunk_start, chunk_end)
+                # written when the last of its output was
+                writer._flush(reader.chunks[bisect.bisect_right(reader.offsets, chunk_end - 1) - 1].get('time'))
+            if step is not None:
+                writer._record({'step': step['step'], 'offset': offset, 'time': step['time']})
+            start = offset
+        writer._record({'end': reader.size, 'time': reader.ended_at})
+        writer._chunks.close()
+        writer._index.close()
+        os.replace(tmp_index, os.path.join(path, 'index.jsonl'))
+        os.unlink(os.path.join(path, reader.chunks_name))
+        logger.debug('compacted %s from %d chunks', path, len(reader.chunks))
+        return True
+
+    def enforce_budget(self) -> None:
+        """
+        removes whole builds, oldest first, that are past `retention_days` or while the store is
+        over `max_bytes`. Builds written to in the last `active_sec` are left alone.
+        """
+        if not os.path.isdir(self.root):
+            return
+        builds = []
+        total = 0
+        for build_id in os.listdir(self.root):
+            build_path = os.path.join(self.root, build_id)
+            size, last_write = 0, 0
+            for directory, _, files in os.walk(build_path):
+                for name in files:
+                    stat = os.stat(os.path.join(directory, name))
+                    size += stat.st_size
+                    last_write = max(last_write, stat.st_mtime)
+            total += size
+            builds.append((last_write, size, build_path))
+
+        now = time.time()
+        for last_write, size, build_path in sorted(builds):
+            if last_write > now - self.active_sec:
+                break
+            if total <= self.max_bytes and last_write >= now - self.retention_days * 24 * 60 * 60:
+                break
+            logger.info('removing build logs %s', build_path)
+            shutil.rmtree(build_path, ignore_errors=True)
+            total -= size
+        logger.debug('build log store at %s is %d bytes', self.root, total)
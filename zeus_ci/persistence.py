@@ -1,4 +1,6 @@
-from sqlalchemy import Column, Integer, String, JSON, Enum, create_engine, ForeignKey, Boolean
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Column, Integer, String, JSON, Enum, create_engine, ForeignKey, Boolean, Float, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, backref, Session
 from sqlalchemy.orm.attributes import flag_modified
@@ -9,6 +11,9 @@ from zeus_ci import config, Status, logger
 
 Base = declarative_base()
 
+# github lists at most this many commits in a push payload
+payload_commit_limit = 20
+
 
 class Build(Base):
     __tablename__ = 'builds'
@@ -19,9 +24,60 @@ class Build(Base):
     commit = Column(String(50), nullable=False)
     json = Column(JSON(50000))
     status = Column(Enum(Status), nullable=False)
+    owner = Column(String(100))  # the coordinator that claimed the build
+    # epoch seconds, the owner renews it while the build runs. A double, on MySQL a plain FLOAT is
+    # single precision and off by minutes
+    lease_expires = Column(Float(precision=53))
 
     repo = relationship('Repo', backref=backref('builds'))
 
+    def checkout_target(self):
+        """
+        returns the ref to build and the ZEUS_TAG / ZEUS_BRANCH env vars describing it, the ref is
+        None for pushes that aren't to a branch or tag
+        """
+        if self.ref.startswith('refs/tags/'):
+            return self.ref.replace('refs/', '', 1), [
+                'ZEUS_TAG={}'.format(self.ref.replace('refs/tags/', '')),
+                'ZEUS_BRANCH={}'.format(self.json['base_ref'].replace('refs/heads/', ''))]
+        if self.ref.startswith('refs/heads/'):
+            return self.json['after'], ['ZEUS_TAG=""', 'ZEUS_BRANCH={}'.format(self.ref.replace('refs/heads/', ''))]
+        return None, []
+
+    def changed_files(self) -> Optional[List[str]]:
+        """
+        the files the push added, modified or removed according to its payload, None when the payload
+        can't say (no commits listed, eg. tags, or possibly truncated)
+        """
+        commits = (self.json or {}).get('commits')
+        if not commits or len(commits) >= payload_commit_limit:
+            return None
+        return sorted({path for commit in commits for key in ('added', 'modified', 'removed')
+                       for path in commit.get(key) or []})
+
+    def push_base(self) -> Optional[str]:
+        """
+        the commit the pushed ref pointed to before the push, None for new refs
+        """
+        before = (self.json or {}).get('before')
+        return before if before and before.strip('0') else None
+
+    def changes_since_tested(self, session: Session) -> Tuple[Optional[List[str]], Optional[str]]:
+        """
+        what `run_when: paths:` is matched against: (changed files, base commit to diff against when
+        they aren't known). The base is the commit of the ref's last build that ran to completion, so
+        pushes whose builds were cancelled (eg. superseded) or errored are built along with this one.
+        (None, None) when the ref was never built, then nothing is filtered out
+        """
+        tested = session.query(Build.commit).filter(
+            Build.repo_name == self.repo_name, Build.ref == self.ref, Build.id < self.id,
+            Build.status.in_([Status.passed, Status.failed])).order_by(Build.id.desc()).first()
+        if tested is None:
+            return None, None
+        if tested.commit == self.push_base():
+            return self.changed_files(), tested.commit
+        return None, tested.commit
+
     def __repr__(self):
         return '%s(id: %s, repo: %s, ref: %s, commit %s, status: %s)' % (
             self.__class__.__name__, self.id, self.repo, self.ref, self.commit, self.status.name)
@@ -97,6 +153,49 @@ class Database:
         self.get_session = sessionmaker(bind=self.engine)
         for obj in (Build, Repo, User):
             obj.__table__.create(bind=self.engine, checkfirst=True)
+            self._add_missing_columns(obj.__table__)
+            self._add_missing_enum_values(obj.__table__)
+
+    def _add_missing_columns(self, table) -> None:
+        """
+        creating a table is skipped when it exists, so columns added to a model since are added here
+        """
+        existing = {column['name'] for column in inspect(self.engine).get_columns(table.name)}
+        with self.engine.begin() as connection:
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                logger.info('adding column %s.%s', table.name, column.name)
+                connection.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table.name, column.name, column.type.compile(dialect=self.engine.dialect))))
+
+    def _add_missing_enum_values(self, table) -> None:
+        """
+        mysql and postgres fix a native enum's values when its column is created, so values added to
+        an Enum since (eg. Status.cancelled) are added here
+        """
+        dialect = self.engine.dialect.name
+        if dialect not in ('mysql', 'postgresql'):
+            return
+        existing = {column['name']: column['type'] for column in inspect(self.engine).get_columns(table.name)}
+        for column in table.columns:
+            if not isinstance(column.type, Enum) or column.name not in existing:
+                continue
+            missing = [value for value in column.type.enums if value not in getattr(existing[column.name], 'enums', ())]
+            if not missing:
+                continue
+            logger.info('adding %s to %s.%s', ', '.join(missing), table.name, column.name)
+            if dialect == 'postgresql':
+                # ALTER TYPE ... ADD VALUE can't run in a transaction before postgres 12
+                with self.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+                    for value in missing:
+                        connection.execute(text("ALTER TYPE {} ADD VALUE IF NOT EXISTS '{}'".format(
+                            column.type.name, value)))
+            else:
+                with self.engine.begin() as connection:
+                    connection.execute(text('ALTER TABLE {} MODIFY COLUMN {} {}{}'.format(
+                        table.name, column.name, column.type.compile(dialect=self.engine.dialect),
+                        '' if column.nullable else ' NOT NULL')))
 
     def __call__(self, *args, **kwargs):
         return self.get_session()
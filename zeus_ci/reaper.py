@@ -0,0 +1,221 @@
+import json
+import os
+import re
+import shutil
+import socket
+import threading
+import time
+from typing import Dict, List, Optional
+
+import rpyc
+
+from zeus_ci import logger, config, Status
+from zeus_ci.executors import DockerExecutor, get_executor
+from zeus_ci.workspace import WorkspaceStore
+
+# labels on the containers stages run in, a claimed pool container keeps its pool labels so only
+# its owner record says whose it is
+build_label = 'zeus-ci.build'
+owner_label = 'zeus-ci.owner'
+username_label = 'zeus-ci.username'
+started_label = 'zeus-ci.started'
+
+# runner._export_checkout names a build's checkout checkout-<build id>-<random>
+checkout_re = re.compile(r'checkout-(\d+)-')
+
+
+def owner() -> str:
+    """
+    <host>:<pid> of this process, what containers and allocations it holds are recorded against
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def owner_alive(owner: str) -> Optional[bool]:
+    """
+    returns whether the process is still running, None if it isn't one of this host's
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit():
+        return None
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def container_labels(build_id, username: str) -> Dict[str, str]:
+    return {build_label: str(build_id), owner_label: owner(), username_label: username,
+            started_label: str(time.time())}
+
+
+class OwnerRecords:
+    """
+    a file per container a stage on this host holds (or is waiting on an allocation for),
+    <state_dir>/<container name>.json, removed once it's stopped. Whatever a process that died
+    left behind is how the reaper finds its containers, workspaces and allocations
+    """
+    def __init__(self, state_dir: str = None):
+        self.state_dir = state_dir or config.runner.get('reaper', {}).get('state_dir', '/tmp/zeus-ci/owners')
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.state_dir, '{}.json'.format(name))
+
+    def record(self, name: str, build_id, username: str, exec_uuid: str) -> None:
+        os.makedirs(self.state_dir, exist_ok=True)
+        tmp_path = '{}.tmp'.format(self._path(name))
+        with open(tmp_path, 'w') as f:
+            json.dump({'name': name, 'build_id': str(build_id), 'username': username, 'exec_uuid': str(exec_uuid),
+                       'owner': owner(), 'started': time.time()}, f)
+        os.replace(tmp_path, self._path(name))
+
+    def remove(self, name: str) -> None:
+        try:
+            os.unlink(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def all(self) -> List[dict]:
+        records = []
+        if not os.path.isdir(self.state_dir):
+            return records
+        for entry in os.listdir(self.state_dir):
+            if not entry.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.state_dir, entry)) as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # removed since, or being replaced
+        return records
+
+
+class OrphanReaper:
+    """
+    removes what stages left behind when the process running them died, or their build is no
+    longer running (it timed out, or was reclaimed by another coordinator): their containers,
+    workspace manifests and checkouts. Then tells the resource allocator which of this host's
+    allocations are still held, so those of reaped containers are freed.
+
+    without a database (eg. on a build agent) only the owning process being gone counts
+    """
+    def __init__(self, database=None, workspace_dir: str = '/tmp/zeus-ci', records: OwnerRecords = None,
+                 grace_sec: float = None, interval_sec: float = None):
+        reaper_config = config.runner.get('reaper', {})
+        self.enabled = reaper_config.get('enabled', True)
+        self.database = database
+        self.workspace_dir = workspace_dir
+        self.records = records or OwnerRecords()
+        # what was just started may not have its build marked running, or its container yet
+        self.grace_sec = grace_sec if grace_sec is not None else reaper_config.get('grace_sec', 120)
+        self.interval_sec = interval_sec or reaper_config.get('interval_sec', 60)
+
+    def _live_builds(self, build_ids) -> Optional[set]:
+        """
+        returns the ids (as str) of `build_ids` that are starting or running, None without a database
+        """
+        if self.database is None:
+            return None
+        from zeus_ci.persistence import Build
+        ids = {int(build_id) for build_id in build_ids if str(build_id).isdigit()}
+        if not ids:
+            return set()
+        with self.database.get_session() as session:
+            return {str(build_id) for build_id, in session.query(Build.id).filter(
+                Build.id.in_(ids), Build.status.in_([Status.starting, Status.running]))}
+
+    def _orphaned(self, owner: str, build_id, started: float, live_builds: Optional[set]) -> bool:
+        if time.time() - started < self.grace_sec:
+            return False
+        if owner_alive(owner) is False:
+            return True
+        return live_builds is not None and str(build_id).isdigit() and str(build_id) not in live_builds
+
+    def reap(self, executor: DockerExecutor = None) -> Dict[str, int]:
+        """
+        one pass over this host's owner records, labelled containers and checkouts
+        returns how many of each were reaped
+        """
+        as_of = time.time()
+        own_executor = executor is None
+        executor = executor or get_executor()
+        reaped = {'containers': 0, 'checkouts': 0, 'allocations': 0}
+        try:
+            records = self.records.all()
+            containers = executor.list_containers(build_label)
+            checkouts = [entry for entry in os.listdir(self.workspace_dir) if checkout_re.match(entry)] \
+                if os.path.isdir(self.workspace_dir) else []
+            live_builds = self._live_builds({record['build_id'] for record in records} |
+                                            {container['labels'].get(build_label) for container in containers} |
+                                            {checkout_re.match(entry).group(1) for entry in checkouts})
+            workspace = WorkspaceStore(self.workspace_dir)
+
+            held = []
+            for record in records:
+                if not self._orphaned(record['owner'], record['build_id'], record['started'], live_builds):
+                    held.append(record['name'])
+                    continue
+                logger.info('reaping container %s of build %s, left behind by %s', record['name'],
+                            record['build_id'], record['owner'])
+                executor.remove(record['name'])
+                workspace.discard(record['exec_uuid'])
+                self.records.remove(record['name'])
+                reaped['containers'] += 1
+
+            recorded = {record['name'] for record in records}
+            for container in containers:
+                labels = container['labels']
+                if container['name'] in recorded:
+                    continue
+                if not self._orphaned(labels.get(owner_label), labels.get(build_label),
+                                      float(labels.get(started_label, 0)), live_builds):
+                    held.append(container['name'])
+                    continue
+                logger.info('reaping container %s of build %s, it has no owner record', container['name'],
+                            labels.get(build_label))
+                executor.remove(container['name'])
+                reaped['containers'] += 1
+
+            for entry in checkouts:
+                path = os.path.join(self.workspace_dir, entry)
+                try:
+                    modified = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue
+                if live_builds is None or checkout_re.match(entry).group(1) in live_builds or \
+                        as_of - modified < self.grace_sec:
+                    continue
+                logger.info('reaping checkout %s', entry)
+                shutil.rmtree(path, ignore_errors=True)
+                reaped['checkouts'] += 1
+
+            reaped['allocations'] = self._reconcile(held, as_of)
+        finally:
+            if own_executor:
+                executor.close()
+        return reaped
+
+    def _reconcile(self, held: List[str], as_of: float) -> int:
+        allocator = rpyc.connect(config.resource_allocator.get('address', 'localhost'),
+                                 config.resource_allocator.get('port', 18861))
+        try:
+            return allocator.root.reconcile(socket.gethostname(), tuple(held), as_of)
+        finally:
+            allocator.close()
+
+    def run(self, stopping: threading.Event) -> None:
+        """
+        reaps every `interval_sec` until `stopping` is set
+        """
+        while True:
+            try:
+                reaped = self.reap()
+                if any(reaped.values()):
+                    logger.info('reaped %s', ', '.join('{} {}'.format(count, kind) for kind, count in reaped.items()))
+            except Exception:
+                logger.error('reaping orphans failed', exc_info=True)
+            if stopping.wait(self.interval_sec):
+                return
@@ -1,3 +1,4 @@
+import time
 from multiprocessing import Manager
 from threading import RLock
 
@@ -5,6 +6,7 @@ import rpyc
 from rpyc import ThreadedServer
 
 from zeus_ci import config, logger
+from zeus_ci.agent_registry import AgentRegistry
 from zeus_ci.persistence import Database, User
 
 
@@ -16,8 +18,10 @@ class BuildThreadRegisterService(rpyc.Service):
                                  protocol_args=config.database.get('args'))
         self.manager = Manager()
         self.containers_allocated = self.manager.dict()  # {username: int(num_containers)}
+        self.holders = {}  # {container name: (username, host, allocated at)}, for reconcile
+        self.agents = AgentRegistry()
 
-    def exposed_request_container(self, username):
+    def exposed_request_container(self, username, holder=None, host=None):
         logger.debug('request for container recieved for: %s', username)
         with self.database.get_session() as session:
             user = session.query(User).filter_by(username=username).one()
@@ -35,13 +39,20 @@ class BuildThreadRegisterService(rpyc.Service):
                     logger.debug('allocating container for: %s', username)
                     with self.write_lock:
                         self.containers_allocated[user.username] += 1
+                        if holder is not None:
+                            self.holders[holder] = (user.username, host, time.time())
                     return True
 
-    def exposed_return_container(self, username):
+    def exposed_return_container(self, username, holder=None):
         logger.debug('container return request recieved for: %s', username)
         with self.database.get_session() as session:
             user = session.query(User).filter_by(username=username).one()
 
+            with self.write_lock:
+                if holder is not None and self.holders.pop(holder, None) is None:
+                    logger.debug('%s was already reconciled away', holder)
+                    return
+
             if self.containers_allocated[user.username] <= 0:
                 with self.write_lock:
                     self.containers_allocated[user.username] = 0
@@ -50,6 +61,37 @@ class BuildThreadRegisterService(rpyc.Service):
                     self.containers_allocated[user.username] -= 1
             logger.debug('container return request processed for: %s', user.username)
 
+    def exposed_reconcile(self, host, held, as_of):
+        """
+        frees the allocations of `host` made before `as_of` whose containers aren't in `held`, the
+        reaper there found their owner gone
+        returns how many were freed
+        """
+        held = set(held)
+        with self.write_lock:
+            stale = [holder for holder, (_, holder_host, allocated_at) in self.holders.items()
+                     if holder_host == host and allocated_at < as_of and holder not in held]
+            for holder in stale:
+                username = self.holders.pop(holder)[0]
+                logger.info('freeing the allocation of %s for %s, its container is gone', holder, username)
+                self.containers_allocated[username] = max(self.containers_allocated.get(username, 0) - 1, 0)
+        return len(stale)
+
+    def exposed_register_agent(self, name, address, port, slots, running, images, mirrors):
+        self.agents.register(name, address, port, slots, running, images, mirrors)
+
+    def exposed_unregister_agent(self, name):
+        self.agents.unregister(name)
+
+    def exposed_place_stage(self, image, mirror, pinned=None):
+        return self.agents.place(image, mirror, pinned)
+
+    def exposed_release_stage(self, name):
+        self.agents.release(name)
+
+    def exposed_agents(self):
+        return self.agents.agents()
+
 
 def main():
     btr = ThreadedServer(BuildThreadRegisterService(), port=config.resource_allocator.get('port', 18861))
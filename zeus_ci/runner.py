@@ -1,19 +1,42 @@
+import asyncio
+import collections
+import contextvars
+import functools
+import heapq
+import json
 import os
+import queue
 import re
-import subprocess
+import shlex
+import shutil
+import socket
 import sys
+import tempfile
+import threading
 import time
-import urllib.request
-import urllib.error
-from multiprocessing.pool import ThreadPool, ApplyResult
-from subprocess import PIPE
-from typing import Dict, List
+from concurrent.futures import Executor
+from multiprocessing.pool import ThreadPool
+from typing import Callable, Dict, List
 
 import rpyc
-import yaml
 import uuid
 
 from zeus_ci import logger, config, Status
+from zeus_ci.agent_registry import AgentPlacer, connect
+from zeus_ci.build_plan import ExecutionPlan, WorkflowPlan, load_build_plan, ref_names
+from zeus_ci.executors import (DockerExecutor, ProcessOutput, TailBuffer, STDOUT, STDERR, get_executor,
+                               _exec)
+from zeus_ci.container_pool import ContainerPool
+from zeus_ci.dependency_cache import DependencyCache
+from zeus_ci.durations import DurationStore
+from zeus_ci.git_mirror import GitMirror
+from zeus_ci.job_results import ResultStore, result_key, uses_workspace
+from zeus_ci.log_store import LogStore, LogWriter
+from zeus_ci.reaper import OwnerRecords, container_labels
+from zeus_ci import test_splitting
+from zeus_ci.test_splitting import TimingStore
+from zeus_ci.tracing import tracer
+from zeus_ci.workspace import WorkspaceStore
 
 
 class Stateful:
@@ -25,38 +48,38 @@ class Stateful:
         self.state = Status.created
 
 
-class ProcessOutput:
+class StageLog:
     """
-    Represents output from a process
-
-    Evaluates to True if process returncode == 0, False otherwise
+    streams a stage's output into the log store as it is produced, only a bounded tail is kept in
+    memory for error summaries. Instances are used directly as an executor output sink.
     """
-    def __init__(self, stdout: bytes, stderr: bytes, returncode: int):
-        self.stdout = stdout.decode()
-        self.stderr = stderr.decode()
-        self.returncode = returncode
+    def __init__(self, path: str, tail_bytes: int = 64 * 1024):
+        self.path = path
+        self.tail = TailBuffer(tail_bytes)
+        self._writer = LogWriter(path)
 
-    def __nonzero__(self):
-        return self.__bool__()
+    def open(self) -> 'StageLog':
+        self._writer.open()
+        return self
 
-    def __bool__(self):
-        if self.returncode == 0:
-            return True
-        return False
+    def __call__(self, stream: int, data: bytes) -> None:
+        self._writer.write(data)
+        self.tail.write(stream, data)
 
-    @property
-    def output(self):
-        return f'==stdout==\n{self.stdout}\n\n\n==stderr==\n{self.stderr}\n'
+    def write_line(self, line: str) -> None:
+        self._writer.write('{}\n'.format(line).encode())
 
-    def __repr__(self):
-        return f'{self.__class__.__name__}(returncode={self.returncode})'
+    def begin_step(self, name: str) -> None:
+        self._writer.begin_step(name)
+        self.write_line('==== {} ===='.format(name))
 
+    def summary(self, lines: int = 20) -> str:
+        tail = (self.tail.getvalue(STDOUT) + self.tail.getvalue(STDERR)).decode(errors='replace')
+        return '\n'.join(tail.splitlines()[-lines:])
 
-def _exec(cmd: list) -> ProcessOutput:
-    proc = subprocess.Popen(cmd, stderr=PIPE, stdout=PIPE)
-    stdout, stderr = proc.communicate()
-    process_output = ProcessOutput(stdout, stderr, proc.returncode)
-    return process_output
+    def close(self) -> None:
+        self._writer.close()
+        LogStore().compact(self.path)
 
 
 class DockerContainer:
@@ -69,7 +92,13 @@ class DockerContainer:
                  clone_url: str,
                  working_directory: str = None,
                  env_vars: List[str] = None,
-                 ref: str = None):
+                 ref: str = None,
+                 executor: DockerExecutor = None,
+                 log: StageLog = None,
+                 checkout_dir: str = None,
+                 container_pool: ContainerPool = None,
+                 build_id=None,
+                 cancelled: Callable[[], bool] = None):
 
         self._start_time = time.time()
         self._duration = None
@@ -80,19 +109,35 @@ class DockerContainer:
         self.image = str(image)
         self._working_directory = working_directory
         self.exec_uuid = exec_uuid
+        self.build_id = build_id
+        self.cancelled = cancelled or (lambda: False)
+        self.allocated = False
         self.name = '{}-{}'.format(str(name), self.exec_uuid)
         self.stage_name = str(name)
         self.env_vars = env_vars or []
+        self.job_name = None
         for env_var in self.env_vars:
             if env_var.startswith('ZEUS_USERNAME='):
                 self.username = env_var.split('ZEUS_USERNAME=')[-1]
+            elif env_var.startswith('ZEUS_JOB='):
+                self.job_name = env_var.split('ZEUS_JOB=', 1)[-1]
         self.ref = ref
 
         self.resource_allocator = rpyc.connect(config.resource_allocator.get('address', 'localhost'),
                                                config.resource_allocator.get('port', 18861))
 
-        self.env_vars.append('ZEUS_JOB={}'.format(self.stage_name))
+        if self.job_name is None:  # a Stage sets the job, which differs from the name for parallel jobs
+            self.job_name = self.stage_name
+            self.env_vars.append('ZEUS_JOB={}'.format(self.job_name))
         self.w_dir = None
+        self.executor = executor or get_executor()
+        self.log = log
+        self.checkout_dir = checkout_dir
+        self.container_pool = container_pool or ContainerPool()
+        self.workspace = WorkspaceStore(self.workspace_dir)
+        self.dependency_cache = DependencyCache()
+        self.cache_scope = DependencyCache.scope(clone_url)
+        self.owner_records = OwnerRecords()
 
     def __enter__(self):
         self.start()
@@ -100,58 +145,192 @@ class DockerContainer:
 
     def start(self) -> ProcessOutput:
         logger.debug('waiting for free docker container allocation')
-
-        while True:
-            if self.resource_allocator.root.request_container(self.username):
-                break
-            time.sleep(1)
+        # recorded first, so the reaper frees the allocation if we die anywhere from here on
+        self.owner_records.record(self.name, self.build_id, self.username, self.exec_uuid)
+
+        with tracer.span('allocator wait', username=self.username) as span:
+            while True:
+                if self.cancelled():
+                    # nothing is claimed or started, the stage sees it's cancelled before any step
+                    logger.info('%s cancelled while waiting for a container allocation', self.name)
+                    span.outcome = 'cancelled'
+                    return ProcessOutput(b'', b'cancelled', 1)
+                if self.resource_allocator.root.request_container(self.username, self.name, socket.gethostname()):
+                    self.allocated = True
+                    break
+                time.sleep(1)
 
         logger.debug('got "good to go" from resource allocator')
 
-        info = _exec(['docker', 'run', '--detach', '-ti', '--name', self.name, self.image])
+        with tracer.span('start container', image=self.image) as span:
+            if self.container_pool.claim(self.image, self.name, self.executor):
+                span.set(pooled=True)
+                info = ProcessOutput(self.name.encode(), b'', 0)
+            else:
+                info = self.executor.run_container(self.name, self.image,
+                                                   labels=container_labels(self.build_id, self.username))
+                span.outcome = 'ok' if info else 'failed'
         if self._working_directory and self._working_directory.startswith('~'):
-            tilda = self.exec('echo $HOME').stdout.strip('\n')
-            working_directory = self._working_directory.replace('~', tilda)
-            self.exec('mkdir {}'.format(working_directory))
-            self.w_dir = working_directory
+            # let the containers shell expand ~ so creating and resolving the directory is one exec
+            working_directory = self.exec('mkdir -p {0} && cd {0} && pwd'.format(self._working_directory))
+            self.w_dir = working_directory.stdout.strip('\n')
         return info
 
-    def exec(self, command: str) -> ProcessOutput:
-        cmd = ['docker', 'exec']
-        if self.w_dir is not None:
-            cmd.extend(['-w', self.w_dir])
-        for env in self.env_vars:
-            cmd.extend(['-e', env])
-        cmd.append(self.name)
-        cmd.extend(['sh', '-c', command])
-        out = _exec(cmd)
+    def exec(self, command: str, sink=None, stdin=None) -> ProcessOutput:
+        return self.executor.exec(self.name, command, env=self.env_vars, workdir=self.w_dir, sink=sink,
+                                  stdin=stdin)
+
+    def copy_checkout(self) -> ProcessOutput:
+        """
+        streams the build's checkout (exported from the host mirror) into the working directory
+        """
+        archive = GitMirror.archive(self.checkout_dir)
+        try:
+            out = self.exec('tar -x -f -', sink=self.log, stdin=archive.stdout)
+        finally:
+            archive.stdout.close()
+        if archive.wait() != 0:
+            logger.error('archiving checkout %s failed', self.checkout_dir)
+            return ProcessOutput(b'', b'', archive.returncode)
         return out
 
-    def persist_to_tmp(self, root: str, paths: str) -> bool:
-        files = self.exec('cd {} && echo `pwd`/`ls -d {}`'.format(root, paths)).stdout.splitlines()
-        for file in files:
-            if not self._copy_file_to_workspace(file):
-                return False
-        return True
+    def persist_to_tmp(self, root: str, paths) -> ProcessOutput:
+        """
+        streams `paths` (relative to `root`) out of the container as one tar, straight into the
+        workspace store
+        """
+        if isinstance(paths, str):
+            paths = [paths]
+        ingested = []
+        read_fd, write_fd = os.pipe()
+        reader, writer = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
 
-    def _copy_file_to_workspace(self, src: str) -> bool:
-        info = _exec(['docker', 'cp',
-                      '{}:{}'.format(self.name, src),
-                      '{}/{}'.format(self.workspace_dir, self.exec_uuid)])
-        if info.returncode == 0:
-            return True
-        logger.error('persist to workspace failed: %s', info)
-
-    def copy_workspace_to_container(self, dest: str) -> bool:
-        self.exec('mkdir -p {}'.format(dest))
-        current_workspace_path = '{}/{}'.format(self.workspace_dir, self.exec_uuid)
-        for file in os.listdir(current_workspace_path):
-            file_path = os.path.join(self.workspace_dir, self.exec_uuid, file)
-            info = _exec(['docker', 'cp', file_path, '{}:{}'.format(self.name, dest)])
-            if not info:
-                logger.error('attach workspace failed: %s', info)
-                return False
-        return True
+        def ingest():
+            try:
+                ingested.append(self.workspace.ingest(self.exec_uuid, reader))
+            except Exception as e:
+                logger.error('persist to workspace failed: %s', e)
+            finally:
+                reader.close()
+
+        def sink(stream, data):
+            if stream != STDOUT:
+                self.log(stream, data)
+            elif not writer.closed:
+                try:
+                    writer.write(data)
+                except BrokenPipeError:
+                    writer.close()  # ingest gave up, the error has been logged there
+
+        ingest_thread = threading.Thread(target=ingest, daemon=True)
+        ingest_thread.start()
+        try:
+            out = self.exec('cd {} && tar -c -f - {}'.format(root or '.', ' '.join(paths)), sink=sink)
+        finally:
+            try:
+                writer.close()
+            except BrokenPipeError:
+                pass
+            ingest_thread.join()
+
+        if out and not ingested:
+            return ProcessOutput(b'', b'', 1)
+        return out
+
+    def copy_workspace_to_container(self, dest: str) -> ProcessOutput:
+        """
+        streams the workflow's workspace from the store into `dest` as one tar
+        """
+        archive = self.workspace.open_archive(self.exec_uuid)
+        try:
+            out = self.exec('mkdir -p {0} && tar -x -f - -C {0}'.format(dest), sink=self.log, stdin=archive)
+        finally:
+            archive.close()
+        if not out:
+            logger.error('attach workspace failed: %s', out)
+        return out
+
+    def save_cache(self, key: str, paths: List[str]) -> ProcessOutput:
+        """
+        streams `paths` out of the container as one tar into the dependency cache under `key`,
+        saving an existing key is skipped, as are paths that don't exist
+        """
+        if not self.dependency_cache.enabled:
+            self.log.write_line('dependency cache disabled, skipping save of {}'.format(key))
+            return ProcessOutput(b'', b'', 0)
+        if self.dependency_cache.exists(self.cache_scope, key):
+            self.log.write_line('cache {} exists, skipping save'.format(key))
+            return ProcessOutput(b'', b'', 0)
+
+        # expanded by the container's shell, so ~ and globs work
+        found = self.exec('for p in {}; do [ -e "$p" ] && printf "%s\\n" "$p"; done; true'.format(' '.join(paths)))
+        existing = found.stdout.splitlines() if found else []
+        if not existing:
+            self.log.write_line('none of {} exist, skipping save of {}'.format(', '.join(paths), key))
+            return ProcessOutput(b'', b'', 0)
+
+        tmp_path, writer = self.dependency_cache.writer(self.cache_scope)
+
+        def sink(stream, data):
+            if stream == STDOUT:
+                writer.write(data)
+            else:
+                self.log(stream, data)
+
+        try:
+            # -P keeps absolute paths (eg. ~/.cache/pip) absolute so restore puts them back in place
+            out = self.exec('tar -c -P -f - {}'.format(' '.join(shlex.quote(path) for path in existing)), sink=sink)
+        finally:
+            writer.close()
+        if not out:
+            self.dependency_cache.discard(tmp_path)
+            return out
+        if self.dependency_cache.commit(self.cache_scope, key, tmp_path):
+            self.log.write_line('saved cache {}'.format(key))
+        return out
+
+    def restore_cache(self, keys: List[str]) -> ProcessOutput:
+        """
+        streams the first cache entry matching `keys` into the container, a miss is not an error
+        """
+        if not self.dependency_cache.enabled:
+            return ProcessOutput(b'', b'', 0)
+        key, archive = self.dependency_cache.open(self.cache_scope, keys)
+        if archive is None:
+            self.log.write_line('no cache found for {}'.format(', '.join(keys)))
+            return ProcessOutput(b'', b'', 0)
+
+        self.log.write_line('restoring cache {}'.format(key))
+        try:
+            out = self.exec('tar -x -P -f -', sink=self.log, stdin=archive)
+        finally:
+            archive.close()
+        if not out:
+            logger.error('restoring cache %s failed: %s', key, out)
+        return out
+
+    def store_test_results(self, path: str) -> ProcessOutput:
+        """
+        streams the junit reports under `path` out of the container and records their timings
+        against this job, missing reports are logged rather than failing the stage
+        """
+        with tempfile.TemporaryFile() as archive:
+            def sink(stream, data):
+                if stream == STDOUT:
+                    archive.write(data)
+                else:
+                    self.log(stream, data)
+
+            out = self.exec('tar -c -f - -C {} .'.format(path), sink=sink)
+            if not out:
+                self.log.write_line('no test results found at {}'.format(path))
+                return ProcessOutput(b'', b'', 0)
+            archive.seek(0)
+            timings = test_splitting.junit_timings(archive)
+
+        TimingStore().update(self.cache_scope, self.job_name, timings)
+        self.log.write_line('recorded timings of {} test files'.format(len(timings)))
+        return out
 
     @property
     def duration(self) -> float:
@@ -162,12 +341,32 @@ class DockerContainer:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.stop()
 
+    def kill(self) -> ProcessOutput:
+        """
+        removes the container from under whatever is running in it, called from another thread to
+        cancel the stage, so it uses its own executor. The allocation is returned by `stop` as usual
+        once the stage notices
+        """
+        executor = get_executor()
+        try:
+            return executor.remove(self.name)
+        finally:
+            executor.close()
+
     def _stop(self) -> ProcessOutput:
-        self.resource_allocator.root.return_container(self.username)
-        return _exec(['docker', 'rm', '-f', self.name])
+        if not self.allocated:
+            self.executor.close()
+            self.owner_records.remove(self.name)
+            return ProcessOutput(b'', b'', 0)
+        self.resource_allocator.root.return_container(self.username, self.name)
+        info = self.executor.remove(self.name)
+        self.executor.close()
+        self.owner_records.remove(self.name)
+        return info
 
     def stop(self) -> ProcessOutput:
-        info = self._stop()
+        with tracer.span('stop container'):
+            info = self._stop()
         self._duration = time.time() - self._start_time
         return info
 
@@ -179,82 +378,201 @@ class Stage(Stateful):
                  clone_url: str,
                  spec: Dict[str, dict],
                  env_vars: List[str] = None,
-                 requires: str = None,
+                 requires: List[str] = None,
                  ref: str = None,
-                 run_condition: dict = None):
+                 log_dir: str = None,
+                 checkout_dir: str = None,
+                 job_name: str = None,
+                 node_index: int = None,
+                 node_total: int = None):
 
         super().__init__()
 
         self.name = name
+        self.job_name = job_name or name
+        self.node_index = node_index
+        self.node_total = node_total
         self.requires = requires
-        self.stderr = ''
-        self.stdout = ''
+        self.log = StageLog(os.path.join(log_dir or Workflow.build_log_location, self.name))
         self.ref = ref
-        self.tag = None
-        self.branch = None
 
         if not env_vars:
             env_vars = []
+        self.build_env_vars = list(env_vars)
         self.env_vars = list(env_vars)
-        self.env_vars.append('ZEUS_JOB={}'.format(self.name))
-        for env_var in self.env_vars:
-            if env_var.startswith('ZEUS_TAG='):
-                self.tag = env_var.split('ZEUS_TAG=', 1)[-1]
-            elif env_var.startswith('ZEUS_BRANCH='):
-                self.branch = env_var.split('ZEUS_BRANCH=', 1)[-1]
-
-        self.run_condition = run_condition or {}
+        self.env_vars.append('ZEUS_JOB={}'.format(self.job_name))
+        if self.node_total is not None:
+            self.env_vars.extend(['ZEUS_NODE_INDEX={}'.format(self.node_index),
+                                  'ZEUS_NODE_TOTAL={}'.format(self.node_total),
+                                  'ZEUS_SPLIT_TESTS={}/split-tests'.format(test_splitting.tools_dir),
+                                  'ZEUS_TIMINGS_FILE={}/timings'.format(test_splitting.tools_dir)])
+
+        self.trace_parent = None
+        self.duration = None
+        self.cancelled = False
+        self.timed_out = None  # the step that ran past runner.step_timeout_sec
+        self.step_timeout = config.runner.get('step_timeout_sec')
+        self.docker = None
+        self.reused_from = None  # the result of an identical job this stage was reported from
+        self.agent = None  # (name, address, port) of the build agent it runs on, None to run it here
+        self.build_id = None
 
         self.exec_uuid = exec_uuid
         self.clone_url = clone_url
+        self.checkout_dir = checkout_dir
         self.spec = spec
         self.working_directory = spec.get('working_directory')
 
+    @property
+    def stdout(self) -> str:
+        return self.log.tail.getvalue(STDOUT).decode(errors='replace')
+
+    @property
+    def stderr(self) -> str:
+        return self.log.tail.getvalue(STDERR).decode(errors='replace')
+
+    @property
+    def remote_id(self) -> str:
+        return '{}/{}'.format(self.exec_uuid, self.name)
+
+    def remote_request(self) -> str:
+        """
+        what a build agent needs to run the stage, see AgentService.exposed_run_stage
+        """
+        return json.dumps({'name': self.name, 'exec_uuid': self.exec_uuid, 'clone_url': self.clone_url,
+                           'spec': self.spec, 'env_vars': self.build_env_vars, 'ref': self.ref,
+                           'job_name': self.job_name, 'node_index': self.node_index,
+                           'node_total': self.node_total, 'build_id': self.build_id}, default=str)
+
+    def cancel(self) -> None:
+        """
+        stops the stage, killing its container if it has one yet
+        """
+        self.cancelled = True
+        agent = self.agent
+        if agent is not None:
+            logger.info('cancelling %s on agent %s', self.name, agent[0])
+            try:
+                with connect(*agent[1:]) as connection:
+                    connection.root.cancel_stage(self.remote_id)
+            except Exception as e:
+                logger.error('cancelling %s on agent %s failed: %s', self.name, agent[0], e)
+            return
+        docker = self.docker
+        if docker is not None:
+            logger.info('cancelling %s, removing container %s', self.name, docker.name)
+            docker.kill()
+
     def run(self) -> None:
+        with tracer.span('stage: {}'.format(self.name), parent=self.trace_parent) as span:
+            self.log.open()
+            start = time.time()
+            try:
+                return self._run()
+            finally:
+                self.duration = time.time() - start
+                self.log.close()
+                span.outcome = self.state.name
+
+    def _run(self) -> None:
 
         logger.debug(f'_run_stage() called for {self.name}')
+        if self.agent is not None:
+            return self._run_remote()
         with DockerContainer(self.name, self.spec.get('docker')[0].get('image'), self.exec_uuid,
-                             self.clone_url, self.working_directory, self.env_vars, ref=self.ref) as docker:
-
-            self.steps = [Step.factory(docker, step) for step in self.spec.get('steps')]
-            skip = False
-            if self.run_condition.get('branch'):
-                if not re.search(self.run_condition['branch'], self.branch):
-                    logger.debug('skipping %s because %s doesnt match condition %s',
-                                 self.name, self.branch, self.run_condition['branch'])
-                    self.state = Status.skipped
-                    skip = True
-            if self.run_condition.get('tag'):
-                if not re.search(self.run_condition['tag'], self.tag):
-                    logger.debug('skipping %s because %s doesnt match condition %s',
-                                 self.name, self.tag, self.run_condition['tag'])
-                    self.state = Status.skipped
-                    skip = True
-
-            if not skip:
-                self.state = Status.running
-                try:
-                    logger.info('---- Running Job: %s ----', self.name)
-                    logger.debug('exec_uuid: %s, env_vars: %s', self.exec_uuid, self.env_vars)
-                    for step in self.steps:
-                        logger.info('Executing Step: %s', step)
-                        output = step.run()
-
-                        # TODO: log step names - currently they dont know their own name
-                        self.stdout += output.stdout
-                        self.stderr += output.stderr
-                        if not output:
-                            logger.error(f'Job Failed[{self.name}]')
-                            self.state = Status.failed
-                            return self.state
-
-                    logger.info('Job (%s) Passed in %.2f seconds', self.name, docker.duration)
-                except Exception as e:
-                    self.state = Status.failed
-                    raise e
-                self.state = Status.passed
+                             self.clone_url, self.working_directory, self.env_vars, ref=self.ref,
+                             log=self.log, checkout_dir=self.checkout_dir, build_id=self.build_id,
+                             cancelled=lambda: self.cancelled) as docker:
+            # set before checking, so a cancel either sees the container or is seen here
+            self.docker = docker
+            try:
+                return self._run_steps(docker)
+            finally:
+                self.docker = None
+
+    def _run_remote(self) -> Status:
+        """
+        runs the stage on its build agent, which streams the output into our log as it goes
+        """
+        if self.cancelled:
+            self.state = Status.cancelled
+            return self.state
+        with tracer.span('agent: {}'.format(self.agent[0])), connect(*self.agent[1:]) as connection:
+            state, _ = connection.root.run_stage(self.remote_request(), self.log)
+        self.state = Status[state]
+        return self.state
+
+    def _run_steps(self, docker: DockerContainer) -> Status:
+        if self.cancelled:
+            self.state = Status.cancelled
             return self.state
 
+        self.steps = [Step.factory(docker, step) for step in self.spec.get('steps')]
+
+        if self.node_total is not None:
+            timings = TimingStore().get(docker.cache_scope, self.job_name)
+            out = docker.exec('mkdir -p {0} && tar -x -f - -C {0}'.format(test_splitting.tools_dir),
+                              sink=self.log, stdin=test_splitting.tools_archive(timings))
+            if not out:
+                logger.error('installing the test split helper for %s failed', self.name)
+
+        self.state = Status.running
+        try:
+            logger.info('---- Running Job: %s ----', self.name)
+            logger.debug('exec_uuid: %s, env_vars: %s', self.exec_uuid, self.env_vars)
+            for step in self.steps:
+                if self.cancelled:
+                    self.state = Status.cancelled
+                    return self.state
+                logger.info('Executing Step: %s', step)
+                self.log.begin_step(str(step))
+                with tracer.span('step: {}'.format(step.name or 'run')) as span:
+                    output = self._run_step(docker, step)
+                    span.outcome = 'ok' if output else 'failed'
+
+                if not output and self.timed_out:
+                    logger.error('Job (%s) timed out after %ss in step %s', self.name, self.step_timeout, step)
+                    self.log.write_line('timed out after {}s'.format(self.step_timeout))
+                    self.state = Status.failed
+                    return self.state
+                if not output and self.cancelled:
+                    logger.info('Job (%s) cancelled', self.name)
+                    self.state = Status.cancelled
+                    return self.state
+                if not output:
+                    logger.error('Job Failed[%s]:\n%s', self.name, self.log.summary())
+                    self.state = Status.failed
+                    return self.state
+
+            logger.info('Job (%s) Passed in %.2f seconds', self.name, docker.duration)
+        except Exception as e:
+            self.state = Status.cancelled if self.cancelled else Status.failed
+            raise e
+        self.state = Status.passed
+        return self.state
+
+
+    def _run_step(self, docker: DockerContainer, step: 'Step') -> ProcessOutput:
+        """
+        runs `step`, removing the container from under it if it runs past the step timeout
+        """
+        if not self.step_timeout:
+            return step.run()
+
+        def time_out():
+            self.timed_out = str(step)
+            logger.info('%s: %s ran past %ss, removing container %s', self.name, step, self.step_timeout,
+                        docker.name)
+            docker.kill()
+
+        timer = threading.Timer(self.step_timeout, time_out)
+        timer.daemon = True
+        timer.start()
+        try:
+            return step.run()
+        finally:
+            timer.cancel()
+
 
 class Step:
     name = 'step'
@@ -276,6 +594,12 @@ class Step:
             return PersistStep(docker, step.get('persist_to_workspace'))
         elif step.get('attach_workspace'):
             return AttachStep(docker, step.get('attach_workspace'))
+        elif step.get('save_cache'):
+            return SaveCacheStep(docker, step.get('save_cache'))
+        elif step.get('restore_cache'):
+            return RestoreCacheStep(docker, step.get('restore_cache'))
+        elif step.get('store_test_results'):
+            return StoreTestResultsStep(docker, step.get('store_test_results'))
         else:
             raise NotImplementedError()
 
@@ -289,7 +613,7 @@ class PersistStep(Step):
         self.root = spec.get('root')
         self.paths = spec.get('paths')
 
-    def run(self) -> bool:
+    def run(self) -> ProcessOutput:
         out = self.docker.persist_to_tmp(self.root, self.paths)
         return out
 
@@ -302,7 +626,7 @@ class AttachStep(Step):
     def init(self, spec: dict) -> None:
         self.at = spec.get('at')
 
-    def run(self) -> bool:
+    def run(self) -> ProcessOutput:
         out = self.docker.copy_workspace_to_container(self.at)
         return out
 
@@ -310,16 +634,117 @@ class AttachStep(Step):
         return 'attach_workspace: {}'.format(self.at)
 
 
+class CacheKeyError(Exception):
+    pass
+
+
+class CacheStep(Step):
+    """
+    renders CircleCI style cache key templates, eg. `deps-{{ arch }}-{{ checksum "setup.py" }}`
+
+    {{ checksum "<file>" }}    sha256 of a file in the container's working directory
+    {{ .Branch }}              ZEUS_BRANCH
+    {{ .Revision }}            the commit being built
+    {{ .Environment.<VAR> }}   a build environment variable
+    {{ arch }}                 the container's os and architecture
+    {{ epoch }}                seconds since the epoch
+    """
+    template_re = re.compile(r'{{\s*(.*?)\s*}}')
+
+    def render_key(self, template: str) -> str:
+        return self.template_re.sub(lambda match: self._render_term(match.group(1)), template)
+
+    def _environment(self) -> Dict[str, str]:
+        return dict(env_var.split('=', 1) for env_var in self.docker.env_vars if '=' in env_var)
+
+    def _container_output(self, command: str) -> str:
+        out = self.docker.exec(command)
+        if not out:
+            raise CacheKeyError('`{}` failed: {}'.format(command, out.stderr.strip()))
+        return out.stdout.strip()
+
+    def _render_term(self, term: str) -> str:
+        if term.startswith('checksum'):
+            path = term[len('checksum'):].strip().strip('"\'')
+            return self._container_output('sha256sum {}'.format(path)).split()[0]
+        if term == '.Branch':
+            return self._environment().get('ZEUS_BRANCH', '')
+        if term == '.Revision':
+            return self._container_output('git rev-parse HEAD')
+        if term.startswith('.Environment.'):
+            return self._environment().get(term[len('.Environment.'):], '')
+        if term == 'arch':
+            return self._container_output('uname -sm').lower().replace(' ', '-')
+        if term == 'epoch':
+            return str(int(time.time()))
+        raise CacheKeyError('unknown cache key template {{{{ {} }}}}'.format(term))
+
+
+class SaveCacheStep(CacheStep):
+    name = 'save_cache'
+    def init(self, spec: dict) -> None:
+        self.key = spec.get('key')
+        self.paths = spec.get('paths') or []
+
+    def run(self) -> ProcessOutput:
+        try:
+            key = self.render_key(self.key)
+        except CacheKeyError as e:
+            self.docker.log.write_line('rendering cache key failed: {}'.format(e))
+            return ProcessOutput(b'', str(e).encode(), 1)
+        return self.docker.save_cache(key, self.paths)
+
+    def __str__(self):
+        return 'save_cache: key({}) paths({})'.format(self.key, self.paths)
+
+
+class RestoreCacheStep(CacheStep):
+    name = 'restore_cache'
+    def init(self, spec: dict) -> None:
+        self.keys = spec.get('keys') or [spec.get('key')]
+
+    def run(self) -> ProcessOutput:
+        try:
+            keys = [self.render_key(key) for key in self.keys]
+        except CacheKeyError as e:
+            self.docker.log.write_line('rendering cache key failed: {}'.format(e))
+            return ProcessOutput(b'', str(e).encode(), 1)
+        return self.docker.restore_cache(keys)
+
+    def __str__(self):
+        return 'restore_cache: keys({})'.format(self.keys)
+
+
+class StoreTestResultsStep(Step):
+    """
+    records per test file timings from the junit reports under `path`, to balance the shards of
+    jobs with `parallelism` in later builds
+    """
+    name = 'store_test_results'
+    def init(self, spec: dict) -> None:
+        self.path = spec.get('path')
+
+    def run(self) -> ProcessOutput:
+        return self.docker.store_test_results(self.path)
+
+    def __str__(self):
+        return 'store_test_results: {}'.format(self.path)
+
+
 class CheckoutStep(Step):
     name = 'checkout'
     def run(self) -> ProcessOutput:
-        out = self.docker.exec(f'git clone {self.docker.clone_url} .')
+        if self.docker.checkout_dir:
+            logger.debug(f'copying checkout of {self.docker.ref} from mirror')
+            return self.docker.copy_checkout()
+
+        out = self.docker.exec(f'git clone {self.docker.clone_url} .', sink=self.docker.log)
 
         if not self.docker.ref:  # if we arent building a tag/commit, just return
             logger.debug(f'git clone {self.docker.clone_url}')
             return out
 
-        out = self.docker.exec(f'git checkout {self.docker.ref}')
+        out = self.docker.exec(f'git checkout {self.docker.ref}', sink=self.docker.log)
         logger.debug(f'git checkout {self.docker.ref}')
         return out
 
@@ -333,7 +758,7 @@ class RunStep(Step):
         self.command = spec.get('command')
 
     def run(self) -> ProcessOutput:
-        out = self.docker.exec(self.command)
+        out = self.docker.exec(self.command, sink=self.docker.log)
         return out
 
     def __str__(self):
@@ -356,14 +781,23 @@ def _setup() -> None:
 
 
 class Workflow(Stateful):
+    build_log_location = LogStore().root
+
     def __init__(self, name: int,
                  build_id: int,
-                 stages: Dict[str, dict],
-                 spec: Dict[str, dict],
+                 plan: WorkflowPlan,
                  clone_url: str,
                  num_threads: int,
                  env_vars: List[str] = None,
-                 ref: str = None):
+                 ref: str = None,
+                 checkout_dir: str = None,
+                 skipped: Dict[str, str] = None,
+                 commit: str = None):
+        """
+        :param skipped: {stage name: reason} of the stages the ExecutionPlan has ruled out, resolved
+                        from the ZEUS_BRANCH and ZEUS_TAG of `env_vars` when not given
+        :param commit: sha of the commit being built, results of jobs are only reused when it's known
+        """
 
         super().__init__()
 
@@ -372,123 +806,391 @@ class Workflow(Stateful):
         self.num_threads = num_threads
         self.name = name
         self.ref = ref
-        os.mkdir('{}/{}'.format(DockerContainer.workspace_dir, self.exec_uuid))
+        self.fail_fast = plan.fail_fast
+        self.cancelled = None  # why, once the workflow has been cancelled
+        self.workspace = WorkspaceStore(DockerContainer.workspace_dir)
+        self.log_dir = '{}/{}/{}'.format(self.build_log_location, self.build_id, self.name)
+        self.trace_parent = None
+        self.scope = DependencyCache.scope(clone_url)
+        self.durations = DurationStore()
+        self.results = ResultStore()
+        self.clone_url = clone_url
+        self.agents = AgentPlacer()
+        # stages handing files to each other through the workspace all run on the first stage's agent
+        self.pin_agent = any(uses_workspace(stage_plan.job) for stage_plan in plan.stages)
+        self._pinned = None  # (name, address, port) of that agent, () for this host
+        self._pin_lock = threading.Lock()
 
         self.stages = {}
-        for stage in spec['stages']:
-
-            try:
-                stage_name = list(stage.keys())[0]
-                requires = stage[stage_name].get('requires')
-                run_condition = stage[stage_name].get('run_when')
-            except AttributeError:
-                stage_name = stage
-                requires = None
-                run_condition = None
-
+        for stage_plan in plan.stages:
             self._add_stage(
-                Stage(stage_name,
+                Stage(stage_plan.name,
                       self.exec_uuid,
                       clone_url,
-                      stages.get(stage_name),
-                      requires=requires,
+                      stage_plan.job,
+                      requires=stage_plan.requires,
                       env_vars=env_vars,
                       ref=self.ref,
-                      run_condition=run_condition))
+                      log_dir=self.log_dir,
+                      checkout_dir=checkout_dir,
+                      job_name=stage_plan.job_name,
+                      node_index=stage_plan.node_index,
+                      node_total=stage_plan.node_total))
+        for stage in self.stages.values():
+            stage.build_id = self.build_id
 
         self._populate_requires()
 
+        # stages that share files through the workspace always run, what they'd persist isn't kept
+        self._result_keys = {}
+        if commit and self.results.enabled:
+            self._result_keys = {stage_plan.name: result_key(commit, stage_plan.job, env_vars or [],
+                                                             stage_plan.run_condition, stage_plan.node_index,
+                                                             stage_plan.node_total)
+                                 for stage_plan in plan.stages if not uses_workspace(stage_plan.job)}
+
+        if skipped is None:
+            skipped = plan.resolve(*ref_names(env_vars))
+        for stage_name, reason in skipped.items():
+            logger.info('%s: skipping %s, %s', self.name, stage_name, reason)
+            self.stages[stage_name].state = Status.skipped
+        self._estimate_critical_paths()
+
     def _populate_requires(self) -> None:
+        """
+        resolves `requires` names to Stage objects and builds the reverse (dependents) graph, the
+        BuildPlan has already checked the names exist and there are no cycles
+        """
+        self._dependents = {stage.name: [] for stage in self.stages.values()}
         for stage in self.stages.values():
-            if stage.requires and all(type(r) == str for r in stage.requires):
-                stage.requires = [self.stages[r] for r in stage.requires]
+            stage.requires = [self.stages[required] for required in stage.requires or []]
+            for required in stage.requires:
+                self._dependents[required.name].append(stage)
+
+    def _add_stage(self, stage: Stage) -> None:
+        self.stages[stage.name] = stage
 
-    def runnable_stages(self) -> List[Stage]:
-        runnable_stages = []
-        if not any(s.state in (Status.created, Status.starting, Status.running) for s in self.stages.values()):
-            raise StopIteration
+    def _estimate_critical_paths(self) -> None:
+        """
+        estimates, from the recorded durations of the repo's jobs, how long the longest chain of
+        stages starting at each stage takes. Ready stages are started longest chain first so the
+        workflow's critical path isn't left waiting behind short stages when threads are scarce.
+        jobs that haven't run before are estimated at the mean of those that have (or 1s each, so
+        with no history at all the longest chain of stages goes first)
+        """
+        known = self.durations.estimates(self.scope)
+        default = sum(known.values()) / len(known) if known else 1.0
+        self._estimate = {name: 0 if stage.state == Status.skipped else known.get(stage.job_name, default)
+                          for name, stage in self.stages.items()}
+        self._critical_path = {}
+        pending = [stage for stage in self.stages.values() if not self._dependents[stage.name]]
+        remaining = {name: len(dependents) for name, dependents in self._dependents.items()}
+        # walks the DAG from the stages nothing depends on back to the roots
+        while pending:
+            stage = pending.pop()
+            self._critical_path[stage.name] = self._estimate[stage.name] + max(
+                (self._critical_path[dependent.name] for dependent in self._dependents[stage.name]), default=0)
+            for required in stage.requires:
+                remaining[required.name] -= 1
+                if not remaining[required.name]:
+                    pending.append(required)
+        self._order = {name: index for index, name in enumerate(self.stages)}
+        logger.debug('%s: critical path estimates %s', self.name,
+                     ', '.join('{} {:.1f}s'.format(name, seconds) for name, seconds in
+                               sorted(self._critical_path.items(), key=lambda item: -item[1])))
+
+    def _record_durations(self) -> None:
+        """
+        records how long each job that passed took, the slowest shard for jobs with `parallelism`
+        """
+        durations = {}
         for stage in self.stages.values():
-            if stage.state == Status.created:
-                if stage.requires:
-                    if all(r.state == Status.passed for r in stage.requires):
-                        runnable_stages.append(stage)
-                    elif any(r.state in (Status.failed, Status.skipped) for r in stage.requires):
-                        logger.info('skipping %s', stage.name)
-                        stage.state = Status.skipped
-                else:
-                    runnable_stages.append(stage)
+            if stage.state == Status.passed and stage.duration is not None and stage.reused_from is None:
+                durations[stage.job_name] = max(durations.get(stage.job_name, 0), stage.duration)
+        try:
+            self.durations.record(self.scope, durations)
+        except OSError as e:
+            logger.error('%s: could not record stage durations: %s', self.name, e)
 
-        return runnable_stages
+    def _initial_stages(self) -> List[Stage]:
+        self._unmet = {stage.name: len(stage.requires) for stage in self.stages.values()}
+        return [stage for stage in self.stages.values() if not stage.requires and stage.state == Status.created]
 
-    def _add_stage(self, stage: Stage) -> None:
-        self.stages[stage.name] = stage
+    def _stage_finished(self, stage: Stage) -> List[Stage]:
+        """
+        updates dependency counts for a stage that has stopped running
+        returns the stages that became runnable because of it
+        """
+        if stage.state != Status.passed:
+            self._skip_dependents(stage)
+            return []
+
+        runnable = []
+        for dependent in self._dependents[stage.name]:
+            self._unmet[dependent.name] -= 1
+            if not self._unmet[dependent.name] and dependent.state == Status.created:
+                runnable.append(dependent)
+        return runnable
+
+    def _skip_dependents(self, stage: Stage) -> None:
+        state = Status.cancelled if self.cancelled else Status.skipped
+        pending = list(self._dependents[stage.name])
+        while pending:
+            dependent = pending.pop()
+            if dependent.state == Status.created:
+                logger.info('%s %s', 'cancelling' if self.cancelled else 'skipping', dependent.name)
+                dependent.state = state
+                pending.extend(self._dependents[dependent.name])
+
+    def _reuse_result(self, stage: Stage) -> bool:
+        """
+        reports `stage` as passed, pointing its log at the original, if an identical job has passed
+        before
+        """
+        key = self._result_keys.get(stage.name)
+        result = self.results.get(self.scope, key) if key else None
+        if not result:
+            return False
+        logger.info('%s: %s is identical to %s of build %s, which passed, reusing its result', self.name,
+                    stage.name, result['stage'], result['build_id'])
+        stage.reused_from = result
+        stage.log.open()
+        stage.log.write_line('identical to {}/{} of build {}, which passed in {:.1f}s, its result was reused'.format(
+            result['workflow'], result['stage'], result['build_id'], result['duration']))
+        stage.log.write_line('logs: {}'.format(result['log']))
+        stage.log.close()
+        stage.state = Status.passed
+        return True
 
-    def run(self) -> None:
+    def _record_result(self, stage: Stage) -> None:
+        key = self._result_keys.get(stage.name)
+        if key and stage.state == Status.passed and stage.reused_from is None:
+            self.results.put(self.scope, key, {'build_id': self.build_id, 'workflow': self.name, 'stage': stage.name,
+                                               'log': stage.log.path, 'duration': stage.duration})
+
+    def cancel(self, reason: str) -> None:
+        """
+        stops the workflow: stages that are running or waiting for a thread are cancelled, and
+        nothing else is started. Safe to call from another thread
+        """
+        if self.cancelled:
+            return
+        self.cancelled = reason
+        logger.info('%s: cancelling, %s', self.name, reason)
+        for stage in list(self.stages.values()):
+            if stage.state in (Status.starting, Status.running):
+                stage.cancel()
+
+    def run(self, pool: ThreadPool = None) -> None:
+        """
+        :param pool: ThreadPool shared with other workflows of the same build, a private pool of
+                     `num_threads` is used when not given
+        """
+        with tracer.span('workflow: {}'.format(self.name), parent=self.trace_parent) as span:
+            status = self._run(pool)
+            span.outcome = status.name
+        return status
+
+    def _run(self, pool: ThreadPool) -> Status:
         logger.debug(f'Workflow.run() for {self.build_id}/{self.name}')
         self.state = Status.running
-        pool = ThreadPool(self.num_threads)
-        pool_results: list[ApplyResult] = []
+        own_pool = pool is None
+        if own_pool:
+            pool = ThreadPool(self.num_threads)
+        finished = queue.Queue()
+        # stages whose requirements are met, longest estimated critical path first. Only as many
+        # as there are threads are handed to the pool at once, so the order they start in is ours
+        ready = []
+        in_flight = 0
+
+        def on_error(stage, e):
+            self._stage_raised(stage, e)
+            finished.put(stage)
+
+        def submit():
+            if self._cancel_ready(ready):
+                return 0
+            started = 0
+            while ready and in_flight + started < self.num_threads:
+                stage = self.stages[heapq.heappop(ready)[2]]
+                started += 1
+                if self._reuse_result(stage):
+                    finished.put(stage)
+                    continue
+                self._starting(stage, len(ready))
+                pool.apply_async(self._run_stage, (stage, ), callback=finished.put,
+                                 error_callback=lambda e, stage=stage: on_error(stage, e))
+            return started
+
+        self._release(ready, self._initial_stages())
+        in_flight += submit()
+        while in_flight:
+            stage = finished.get()
+            in_flight -= 1
+            self._stage_done(stage, ready)
+            in_flight += submit()
+
+        if own_pool:
+            pool.close()
+            pool.join()
+        return self._finish()
+
+    async def run_async(self, slots: asyncio.Semaphore, executor: Executor) -> Status:
+        """
+        Workflow.run for the asyncio coordinator, the DAG is driven from the event loop and only
+        running stages take a thread of `executor`
+        :param slots: bounds the running stages of the whole build, like the shared pool does
+        """
+        with tracer.span('workflow: {}'.format(self.name), parent=self.trace_parent) as span:
+            status = await self._run_async(slots, executor)
+            span.outcome = status.name
+        return status
+
+    async def _run_async(self, slots: asyncio.Semaphore, executor: Executor) -> Status:
+        logger.debug(f'Workflow.run_async() for {self.build_id}/{self.name}')
+        self.state = Status.running
+        finished = collections.deque()
+        ready = []
+        running = {}  # task: Stage
+
+        async def run_stage(stage):
+            async with slots:
+                return await _in_executor(executor, self._run_stage, stage)
+
+        def submit():
+            if self._cancel_ready(ready):
+                return
+            while ready and len(running) + len(finished) < self.num_threads:
+                stage = self.stages[heapq.heappop(ready)[2]]
+                if self._reuse_result(stage):
+                    finished.append(stage)
+                    continue
+                self._starting(stage, len(ready))
+                running[asyncio.ensure_future(run_stage(stage))] = stage
+
+        self._release(ready, self._initial_stages())
+        submit()
+        while running or finished:
+            if not finished:
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage = running.pop(task)
+                    if task.exception() is not None:
+                        self._stage_raised(stage, task.exception())
+                    finished.append(stage)
+            self._stage_done(finished.popleft(), ready)
+            submit()
+        return await _in_executor(executor, self._finish)
+
+    def _release(self, ready: list, stages: List[Stage]) -> None:
+        for stage in stages:
+            heapq.heappush(ready, (-self._critical_path[stage.name], self._order[stage.name], stage.name))
+
+    def _cancel_ready(self, ready: list) -> bool:
+        """
+        cancels the stages waiting to start once the workflow has been cancelled
+        """
+        if not self.cancelled:
+            return False
+        for _, _, stage_name in ready:
+            stage = self.stages[stage_name]
+            stage.state = Status.cancelled
+            self._skip_dependents(stage)
+        ready.clear()
+        return True
 
-        while True:
+    def _starting(self, stage: Stage, waiting: int) -> None:
+        logger.info('%s: starting %s (estimated %.1fs, critical path %.1fs, %d waiting)', self.name,
+                    stage.name, self._estimate[stage.name], self._critical_path[stage.name], waiting)
+        logger.debug(f'adding stage: {stage.name} to workflow {self.name}:{self.exec_uuid}')
+        stage.state = Status.starting
+        stage.trace_parent = tracer.current()
+
+    def _stage_raised(self, stage: Stage, e: BaseException) -> None:
+        logger.error('%s: stage %s raised %s', self.name, stage.name, e, exc_info=e)
+        if stage.state not in (Status.failed, Status.skipped, Status.cancelled):
+            stage.state = Status.error
+
+    def _stage_done(self, stage: Stage, ready: list) -> None:
+        if self.fail_fast and stage.state in (Status.failed, Status.error):
+            self.cancel('fail_fast, {} {}'.format(stage.name, stage.state.name))
+        self._record_result(stage)
+        self._release(ready, self._stage_finished(stage))
+
+    def _finish(self) -> Status:
+        """
+        cleans up after the last stage, returns the workflow's Status
+        """
+        self.workspace.discard(self.exec_uuid)
+        self.workspace.evict()
+        if self._pinned:
             try:
-                stages = self.runnable_stages()
-                if stages:
-                    for stage in stages:
-                        logger.debug(f'adding stage: {stage.name} to workflow {self.name}:{self.exec_uuid}')
-                        stage.state = Status.starting
-                        pool_results.append(pool.apply_async(self._run_stage, (stage, )))
-                time.sleep(1)
-            except StopIteration:
-                break
-        pool.close()
-        pool.join()
-        results = [r.get() for r in pool_results]
-        for r in results:
-            self._log_to_file(r)
+                with connect(*self._pinned[1:]) as connection:
+                    connection.root.discard_workspace(self.exec_uuid)
+            except Exception as e:
+                logger.error('%s: discarding the workspace on agent %s failed: %s', self.name, self._pinned[0], e)
+        self.agents.close()
+        self._record_durations()
 
         logger.info(self.status_string)
 
-        for status in (Status.error, Status.failed):
-            if any(map(lambda r: r.state == status, results)):
+        for status in (Status.error, Status.failed, Status.cancelled):
+            if any(map(lambda s: s.state == status, self.stages.values())):
                 return status
 
         return Status.passed
 
-    def _log_to_file(self, stage):
-        build_log_location = '/etc/zeus-ci/builds'
-        try:
-            logger.debug(f'creating log location at: {build_log_location}')
-            os.mkdir(build_log_location)
-        except FileExistsError:
-            logger.debug('folder already exists, skipping')
-            pass
-
-        this_build_log_location = f'{build_log_location}/{self.build_id}'
-        try:
-            logger.debug(f'creating build directory at: {this_build_log_location}')
-            os.mkdir(this_build_log_location)
-        except FileExistsError:
-            logger.debug(f'folder already exists, skipping')
-            pass
-
-        with open(f'{this_build_log_location}/{self.name}', 'a') as logfile:
-            logfile.write(f'STDOUT:\n{stage.stdout}\n\nSTDERR:\n{stage.stderr}\n\n')
-
-    @staticmethod
-    def _run_stage(stage: Stage) -> Stage:
+    def _place(self, stage: Stage):
+        """
+        waits for a build agent to run `stage` on, returns None to run it on this host
+        """
+        image = stage.spec.get('docker')[0].get('image')
+
+        def cancelled():
+            return stage.cancelled
+
+        if not self.pin_agent:
+            return self.agents.place(image, self.clone_url, cancelled=cancelled)
+        with self._pin_lock:
+            if self._pinned is None:
+                placement = self.agents.place(image, self.clone_url, cancelled=cancelled)
+                if stage.cancelled:
+                    return placement
+                self._pinned = placement or ()
+                logger.info('%s: running on %s, its stages share a workspace', self.name,
+                            'agent {}'.format(self._pinned[0]) if self._pinned else 'this host')
+                return placement
+        if not self._pinned:
+            return None
+        return self.agents.place(image, self.clone_url, pinned=self._pinned[0], cancelled=cancelled)
+
+    def _run_stage(self, stage: Stage) -> Stage:
         """
         runs the Stage passed in
         returns True if Stage passed, or False if it  fails
         """
-        stage.state = Status.running
-        stage.run()
+        if stage.cancelled:  # cancelled while waiting for a thread
+            stage.state = Status.cancelled
+            return stage
+        if self.agents.enabled:
+            with tracer.span('agent placement', stage=stage.name):
+                stage.agent = self._place(stage)
+        try:
+            if stage.cancelled:  # cancelled while waiting for an agent
+                stage.state = Status.cancelled
+                return stage
+            stage.state = Status.running
+            stage.run()
+        finally:
+            if stage.agent is not None:
+                self.agents.release(stage.agent[0])
         return stage
 
     @property
     def status_string(self) -> str:
 
         statuses = []
-        for state in (Status.failed, Status.passed, Status.skipped):
+        for state in (Status.error, Status.failed, Status.cancelled, Status.passed, Status.skipped):
             stages = set(filter(lambda s: s.state == state, self.stages.values()))
             if stages:
                 statuses.append(f'{len(stages)} {state.name} [{", ".join(s.name for s in stages)}]')
@@ -500,7 +1202,16 @@ def main(repo_slab: str,
          build_id: int,
          env_vars: List[str] = None,
          threads: int = 1,
-         ref=None) -> bool:
+         ref=None,
+         cancel: threading.Event = None,
+         changed_files: List[str] = None,
+         base: str = None) -> bool:
+    """
+    :param cancel: set (from another thread) to cancel the build, any running stages are stopped
+    :param changed_files: the files changed since the ref was last tested, for `run_when: paths:`
+    :param base: the commit the ref was last tested at, the changed files are diffed from it in the
+                 mirror when `changed_files` isn't known
+    """
 
     # TODO: im not sure if this logic is even used
     if not any([repo_slab, env_vars, threads, ref]):
@@ -512,35 +1223,201 @@ def main(repo_slab: str,
                 logger.error('not in the root directory of a git repository, exiting')
                 sys.exit(1)
 
+    prepared = _prepare_build(repo_slab, build_id, env_vars, ref, changed_files, base, cancel)
+    if isinstance(prepared, Status):
+        return prepared
+    execution, clone_url, commit, checkout_dir = prepared
+    try:
+        return _run_workflows(build_id, execution, clone_url, threads, env_vars, ref, checkout_dir, cancel, commit)
+    finally:
+        _clean_up_build(checkout_dir)
+
+
+async def main_async(repo_slab: str,
+                     build_id: int,
+                     env_vars: List[str],
+                     threads: int = 1,
+                     ref=None,
+                     cancel: asyncio.Event = None,
+                     changed_files: List[str] = None,
+                     base: str = None,
+                     executor: Executor = None) -> Status:
+    """
+    runner.main for the asyncio coordinator, run on its event loop. Preparing the build (mirror,
+    plan, checkout) and cleaning up after it run in the loop's default executor
+    :param executor: the threads running stages, shared by every build of the coordinator
+    """
+    prepared = await _in_executor(None, _prepare_build, repo_slab, build_id, env_vars, ref, changed_files, base,
+                                  cancel)
+    if isinstance(prepared, Status):
+        return prepared
+    execution, clone_url, commit, checkout_dir = prepared
+    try:
+        return await _run_workflows_async(build_id, execution, clone_url, threads, env_vars, ref, checkout_dir,
+                                          cancel, commit, executor)
+    finally:
+        await _in_executor(None, _clean_up_build, checkout_dir)
+
+
+def _prepare_build(repo_slab: str, build_id: int, env_vars: List[str], ref: str, changed_files: List[str],
+                   base: str, cancel=None):
+    """
+    updates the mirror, loads the build plan and exports the checkout
+    returns (execution plan, clone url, commit, checkout dir), or the build's Status if it can't run
+    """
     _setup()
 
     clone_url = 'https://github.com/{}.git'.format(repo_slab)
-    _config = _download_repo_build_config(repo_slab, ref)
-    if not config:
-        return False
-
-    try:
-        _config['workflows'].pop('version')
-    except KeyError:
-        pass
+    mirror = GitMirror()
+    with tracer.span('update git mirror', enabled=mirror.enabled):
+        mirrored = mirror.enabled and mirror.update(clone_url)
+
+    with tracer.span('load build plan') as span:
+        plan = load_build_plan(repo_slab, ref, mirror.path(clone_url) if mirrored else None)
+        span.outcome = 'ok' if plan else 'failed'
+    if not plan:
+        return Status.error
+
+    if mirrored:
+        commit = mirror.commit(clone_url, ref)
+    else:
+        commit = ref if re.fullmatch(r'[0-9a-f]{40}', ref or '') else None
+    if changed_files is None and base and commit and mirrored:
+        changed_files = mirror.changed_files(clone_url, base, commit)
+
+    execution = plan.resolve(*ref_names(env_vars), changed_files)
+    logger.info('execution plan for build %s:\n%s', build_id, execution.describe())
 
     env_vars.append('ZEUS_USERNAME={}'.format(repo_slab.split('/')[0]))
 
-    workflows = {name: Workflow(name, build_id, _config['jobs'], spec, clone_url, threads, env_vars=env_vars, ref=ref)
-                 for name, spec in _config['workflows'].items()}
+    if cancel is not None and cancel.is_set():
+        return Status.cancelled
+
+    with tracer.span('export checkout'):
+        checkout_dir = _export_checkout(mirror, clone_url, ref, build_id, plan.full_history) if mirrored else None
+    return execution, clone_url, commit, checkout_dir
+
+
+def _clean_up_build(checkout_dir: str) -> None:
+    if checkout_dir:
+        shutil.rmtree(checkout_dir, ignore_errors=True)
+    LogStore(Workflow.build_log_location).enforce_budget()
+    ResultStore().evict()
+
+
+def _in_executor(executor: Executor, fn, *args) -> asyncio.Future:
+    """
+    runs `fn` in `executor` with the caller's context, so spans it starts nest under the caller's
+    """
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(executor, functools.partial(context.run, fn, *args))
+
+
+def _export_checkout(mirror: GitMirror, clone_url: str, ref: str, build_id=None, full_history: bool = False) -> str:
+    """
+    exports `ref` from the host's (freshly updated) mirror once for the whole build
+    returns the checkout directory, or None if stages should clone from the remote themselves
+    """
+    # named after the build, so the reaper can tell when it's been left behind
+    prefix = 'checkout-{}-'.format(build_id) if str(build_id).isdigit() else 'checkout-'
+    checkout_dir = tempfile.mkdtemp(dir=DockerContainer.workspace_dir, prefix=prefix)
+    if mirror.export(clone_url, ref or 'HEAD', checkout_dir, full_history):
+        return checkout_dir
+    shutil.rmtree(checkout_dir, ignore_errors=True)
+
+
+def _cancel_workflows(cancel: threading.Event, done: threading.Event, workflows: List[Workflow]) -> None:
+    """
+    cancels `workflows` if `cancel` is set before the build is `done`
+    """
+    while not done.is_set():
+        if cancel.wait(0.5):
+            for workflow in workflows:
+                workflow.cancel('build cancelled')
+            return
+
+
+def _workflows(build_id: int, execution: ExecutionPlan, clone_url: str, threads: int, env_vars: List[str],
+               ref: str, checkout_dir: str, commit: str) -> Dict[str, Workflow]:
+    workflows = {name: Workflow(name, build_id, workflow_plan, clone_url, threads, env_vars=env_vars, ref=ref,
+                                checkout_dir=checkout_dir, skipped=execution.skipped[name], commit=commit)
+                 for name, workflow_plan in execution.plan.workflows.items()}
+    for workflow in workflows.values():
+        workflow.trace_parent = tracer.current()
+    return workflows
+
+
+def _build_status(results: List[Status]) -> Status:
+    for status in (Status.error, Status.failed, Status.cancelled):
+        if any(map(lambda r: r == status, results)):
+            return status
+
+    return Status.passed
+
+
+def _run_workflows(build_id: int, execution: ExecutionPlan, clone_url: str, threads: int, env_vars: List[str],
+                   ref: str, checkout_dir: str, cancel: threading.Event = None, commit: str = None) -> Status:
+    workflows = _workflows(build_id, execution, clone_url, threads, env_vars, ref, checkout_dir, commit)
+
+    # every workflow drives its own DAG from a lightweight thread, while the stages of all of them
+    # share the one `threads` sized pool so the build as a whole stays within its budget
+    stage_pool = ThreadPool(threads)
+    workflow_pool = ThreadPool(len(workflows) or 1)
+    running = {workflow_name: workflow_pool.apply_async(workflow.run, (stage_pool, ))
+               for workflow_name, workflow in workflows.items()}
+    done = threading.Event()
+    if cancel is not None:
+        threading.Thread(target=_cancel_workflows, args=(cancel, done, list(workflows.values())),
+                         name='cancel-watch', daemon=True).start()
 
     results = []
-    for workflow_name, workflow in workflows.items():
+    for workflow_name, result in running.items():
         try:
-            results.append(workflow.run())
+            results.append(result.get())
         except Exception as e:
             logger.error('%s: %s', workflow_name, e)
 
-    for status in (Status.error, Status.failed):
-        if any(map(lambda r: r == status, results)):
-            return status
+    workflow_pool.close()
+    stage_pool.close()
+    workflow_pool.join()
+    stage_pool.join()
+    done.set()
 
-    return Status.passed
+    return _build_status(results)
+
+
+async def _cancel_workflows_async(cancel: asyncio.Event, workflows: List[Workflow]) -> None:
+    await cancel.wait()
+    for workflow in workflows:
+        # stopping a running stage talks to docker (or an agent)
+        await _in_executor(None, workflow.cancel, 'build cancelled')
+
+
+async def _run_workflows_async(build_id: int, execution: ExecutionPlan, clone_url: str, threads: int,
+                               env_vars: List[str], ref: str, checkout_dir: str, cancel: asyncio.Event = None,
+                               commit: str = None, executor: Executor = None) -> Status:
+    workflows = await _in_executor(None, _workflows, build_id, execution, clone_url, threads, env_vars, ref,
+                                   checkout_dir, commit)
+
+    # the semaphore does what the shared stage pool does for runner.main, at most `threads` stages
+    # of the build run at once
+    slots = asyncio.Semaphore(threads)
+    watcher = asyncio.ensure_future(_cancel_workflows_async(cancel, list(workflows.values()))) \
+        if cancel is not None else None
+    try:
+        outcomes = await asyncio.gather(*(workflow.run_async(slots, executor) for workflow in workflows.values()),
+                                        return_exceptions=True)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+    results = []
+    for workflow_name, outcome in zip(workflows, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error('%s: %s', workflow_name, outcome)
+        else:
+            results.append(outcome)
+    return _build_status(results)
 
 
 def repo_slab_of_cwd():
@@ -555,24 +1432,9 @@ def repo_slab_of_cwd():
             return remote_url.split(' ')[0]
 
 
-def _download_repo_build_config(repo_slab, ref) -> dict:
+def build_config_images(repo_slab: str, ref: str) -> set:
     """
-    last commit to master:
-    https://raw.githubusercontent.com/chestm007/Zeus-CI/master/.zeusci/config.yml
-
-    specific commit:
-    https://raw.githubusercontent.com/chestm007/Zeus-CI/142eb4bdbbc54371cbcc4a0000bd8eeea997d1f2/.zeusci/config.yml
-
-    specific tag:
-    https://raw.githubusercontent.com/chestm007/Zeus-CI/test-tag/.zeusci/config.yml
+    returns the docker images used by the jobs in the build config of `repo_slab` at `ref`
     """
-    url_format = 'https://raw.githubusercontent.com/{repo_slab}/{ref}/.zeusci/config.yml'
-    try:
-        response = urllib.request.urlopen(url_format.format(repo_slab=repo_slab, ref=ref.split('/')[-1]))
-    except urllib.error.HTTPError:
-        logger.error('couldnt fetch build config')
-        return {}
-
-    if response.status == 200:
-        _config = yaml.load(response, yaml.Loader)
-        return _config
+    plan = load_build_plan(repo_slab, ref)
+    return plan.images if plan else set()
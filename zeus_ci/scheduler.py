@@ -0,0 +1,164 @@
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Dict, Optional, Tuple
+
+from zeus_ci import logger, config
+
+# strictly in this order, builds of a class only run when no earlier class has one ready
+priority_classes = ('release', 'default', 'topic')
+
+
+def priority_class(ref: str, payload: dict) -> str:
+    """
+    tags are releases, pushes to the repo's default branch come next and every other branch last
+    """
+    if ref.startswith('refs/tags/'):
+        return 'release'
+    default_branch = ((payload or {}).get('repository') or {}).get('default_branch') or 'master'
+    if ref == 'refs/heads/{}'.format(default_branch):
+        return 'default'
+    return 'topic'
+
+
+def stats_dir() -> str:
+    return (config.build_coordinator or {}).get('queue_stats_dir', '/tmp/zeus-ci/queue')
+
+
+def coordinator_stats(directory: str = None) -> Dict[str, dict]:
+    """
+    {coordinator: the stats it last wrote} of every running coordinator
+    """
+    directory = directory or stats_dir()
+    stats = {}
+    if not os.path.isdir(directory):
+        return stats
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                stats[name[:-len('.json')]] = json.load(f)
+        except (OSError, ValueError):
+            pass
+    return stats
+
+
+class _QueuedBuild:
+    __slots__ = ('build_id', 'flow', 'username', 'priority', 'start', 'finish', 'queued_at')
+
+    def __init__(self, build_id: int, flow: str, username: str, priority: str, start: float, finish: float):
+        self.build_id = build_id
+        self.flow = flow
+        self.username = username
+        self.priority = priority
+        self.start = start
+        self.finish = finish
+        self.queued_at = time.time()
+
+
+class BuildScheduler:
+    """
+    decides which queued build a free build process takes next.
+
+    priority classes are strict. Within a class builds are weighted fair queued by repo (a flow per
+    user/repo): each build gets a virtual finish time one 1/weight step after the later of its
+    flow's previous build and the current virtual time, and the earliest finish goes first, so a
+    repo with 50 pushes queued takes turns with one that has a single push rather than going ahead
+    of it. Users are never given more builds at once than their container_limit could run
+    (container_limit / runner_threads, at least one).
+    """
+    def __init__(self, weights: Dict[str, float] = None, runner_threads: int = 1):
+        self.weights = weights or {}  # by repo slab or username, 1 when not given
+        self.runner_threads = runner_threads
+        self._queued: Dict[int, _QueuedBuild] = {}
+        self._running: Dict[int, str] = {}  # build id: username
+        self._flow_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+        self._limits: Dict[str, int] = {}
+        self._dispatched = {priority: 0 for priority in priority_classes}
+        self._waits = {priority: deque(maxlen=200) for priority in priority_classes}
+
+    def __contains__(self, build_id: int) -> bool:
+        return build_id in self._queued or build_id in self._running
+
+    def add(self, build_id: int, repo_name: str, username: str, priority: str, container_limit: int) -> None:
+        weight = self.weights.get(repo_name, self.weights.get(username, 1))
+        start = max(self._virtual_time, self._flow_finish.get(repo_name, 0))
+        finish = start + 1 / weight
+        self._flow_finish[repo_name] = finish
+        self._limits[username] = max(1, math.ceil((container_limit or 1) / self.runner_threads))
+        self._queued[build_id] = _QueuedBuild(build_id, repo_name, username, priority, start, finish)
+
+    def remove(self, build_id: int) -> None:
+        """
+        forgets a build that was queued or running, eg. it was cancelled or has finished
+        """
+        self._queued.pop(build_id, None)
+        self._running.pop(build_id, None)
+
+    @property
+    def queued(self) -> set:
+        return set(self._queued)
+
+    @property
+    def running(self) -> set:
+        return set(self._running)
+
+    def next(self) -> Optional[Tuple[int, float]]:
+        """
+        returns the build to run next and when it was queued, and counts it as running, None if
+        nothing is ready
+        """
+        running_per_user = {}
+        for username in self._running.values():
+            running_per_user[username] = running_per_user.get(username, 0) + 1
+        eligible = [queued for queued in self._queued.values()
+                    if running_per_user.get(queued.username, 0) < self._limits.get(queued.username, 1)]
+        if not eligible:
+            return None
+        chosen = min(eligible, key=lambda queued: (priority_classes.index(queued.priority), queued.finish,
+                                                   queued.build_id))
+        del self._queued[chosen.build_id]
+        self._running[chosen.build_id] = chosen.username
+        self._virtual_time = max(self._virtual_time, chosen.start)
+        wait = time.time() - chosen.queued_at
+        self._dispatched[chosen.priority] += 1
+        self._waits[chosen.priority].append(wait)
+        logger.debug('scheduling build %s (%s, %s) after %.1fs queued', chosen.build_id, chosen.flow,
+                     chosen.priority, wait)
+        return chosen.build_id, chosen.queued_at
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        {priority class: {'depth', 'oldest_wait_sec', 'dispatched', 'mean_wait_sec', 'p95_wait_sec'}},
+        wait times are of the last 200 builds dispatched from the class
+        """
+        now = time.time()
+        stats = {}
+        for priority in priority_classes:
+            queued = [queued for queued in self._queued.values() if queued.priority == priority]
+            waits = sorted(self._waits[priority])
+            stats[priority] = {
+                'depth': len(queued),
+                'oldest_wait_sec': round(max((now - q.queued_at for q in queued), default=0), 3),
+                'dispatched': self._dispatched[priority],
+                'mean_wait_sec': round(sum(waits) / len(waits), 3) if waits else None,
+                'p95_wait_sec': round(waits[min(int(len(waits) * 0.95), len(waits) - 1)], 3) if waits else None,
+            }
+        return stats
+
+    def write_stats(self, path: str) -> None:
+        """
+        publishes `stats` for `zeus-cli queue stats`
+        """
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '{}.tmp'.format(path)
+            with open(tmp_path, 'w') as f:
+                json.dump(dict(self.stats(), updated=time.time(), running=len(self._running)), f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error('could not write queue stats: %s', e)
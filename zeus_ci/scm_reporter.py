@@ -1,7 +1,10 @@
+import os
+import threading
+import time
 from collections import namedtuple
 from enum import Enum
 
-from zeus_ci import logger
+from zeus_ci import logger, config
 from zeus_ci.persistence import Build
 
 TokenAuth = namedtuple('TokenAuth', ('access_token', ))
@@ -19,23 +22,159 @@ class Github:
         GithubStatus.success: "Build succeeded!"
     }  # TODO: consider scm agnostic global map
 
-    def __init__(self, auth: namedtuple):
+    def __init__(self, auth: namedtuple, api_url: str = None):
         from github import Github as PyGithub
-        self.client = PyGithub(*auth)
+        # retrying is up to the caller, pygithub's own retries would sleep through rate limits
+        if isinstance(auth, EnterpriseAuth):
+            self.client = PyGithub(auth.token, base_url=auth.base_url, retry=None)
+        elif api_url:
+            self.client = PyGithub(*auth, base_url=api_url, retry=None)
+        else:
+            self.client = PyGithub(*auth, retry=None)
+
+    def create_status(self, repo_name: str, sha: str, status: GithubStatus, description: str = None) -> None:
+        """
+        one request: a lazy repo isn't fetched, and the status is posted to its statuses url rather
+        than through a Commit, which some pygithub versions GET first
+        """
+        repo = self.client.get_repo(repo_name, lazy=True)
+        logger.info(f'updating commit status: {status.name}, {repo_name}')
+        repo._requester.requestJsonAndCheck(
+            'POST', '{}/statuses/{}'.format(repo.url, sha),
+            input={'state': status.name, 'description': description or self.status_descriptions[status]})
 
     def update_status(self, build: Build, status: GithubStatus):
-        repo = self.client.get_repo(build.repo.name)
-        logger.debug(f'loading data for build {build} to repo {repo}')
-        if not repo:
-            raise FileNotFoundError  # TODO: make this something better
+        self.create_status(build.repo.name, build.commit, status)
+
+
+class _StatusUpdate:
+    __slots__ = ('token', 'repo_name', 'sha', 'status', 'description', 'attempts', 'due')
+
+    def __init__(self, token: str, repo_name: str, sha: str, status: GithubStatus, description: str = None):
+        self.token = token
+        self.repo_name = repo_name
+        self.sha = sha
+        self.status = status
+        self.description = description
+        self.attempts = 0
+        self.due = time.time()
+
+
+class StatusReporter:
+    """
+    sends commit statuses from a background thread, so neither a build nor a webhook response waits
+    on github. An update for a commit replaces any of its updates that haven't been sent yet, so
+    only its latest state goes out, and failed sends are retried with exponential backoff (unless a
+    newer update for the commit has arrived in the meantime)
+    """
+    # not worth retrying, the token, repo or commit is wrong
+    permanent_errors = (401, 404, 422)
+
+    def __init__(self, api_url: str = None, max_attempts: int = None, backoff_sec: float = None,
+                 max_backoff_sec: float = None):
+        reporter_config = config.status_reporter or {}
+        self.api_url = api_url or reporter_config.get('api_url')
+        self.max_attempts = max_attempts or reporter_config.get('max_attempts', 8)
+        self.backoff_sec = backoff_sec or reporter_config.get('backoff_sec', 1)
+        self.max_backoff_sec = max_backoff_sec or reporter_config.get('max_backoff_sec', 300)
+        self._condition = threading.Condition()
+        self._pending = {}  # (repo name, sha): _StatusUpdate
+        self._sending = None
+        self._clients = {}  # token: Github
+        self._thread = None
+        self.sent = 0
+        self.merged = 0
+        self.failed = 0
+
+    def report(self, build: Build, status: GithubStatus, description: str = None) -> None:
+        """
+        queues `status` for the build's commit, returns straight away
+        :param description: in place of the status's usual one
+        """
+        update = _StatusUpdate(build.repo.user.token, build.repo.name, build.commit, status, description)
+        with self._condition:
+            key = (update.repo_name, update.sha)
+            if key in self._pending:
+                logger.debug('%s %s: %s replaces unsent %s', update.repo_name, update.sha, status.name,
+                             self._pending[key].status.name)
+                self.merged += 1
+            self._pending[key] = update
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='status-reporter', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        waits for every queued update to be sent (or given up on)
+        returns False if some were still queued after `timeout`
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._pending or self._sending:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def _next(self) -> _StatusUpdate:
+        with self._condition:
+            while True:
+                update = min(self._pending.values(), key=lambda pending: pending.due, default=None)
+                delay = None if update is None else update.due - time.time()
+                if delay is not None and delay <= 0:
+                    del self._pending[(update.repo_name, update.sha)]
+                    self._sending = update
+                    return update
+                self._condition.wait(delay)
+
+    def _client(self, token: str) -> Github:
+        if token not in self._clients:
+            self._clients[token] = Github(TokenAuth(token), self.api_url)
+        return self._clients[token]
+
+    def _run(self) -> None:
+        while True:
+            update = self._next()
+            try:
+                self._client(update.token).create_status(update.repo_name, update.sha, update.status,
+                                                         update.description)
+            except Exception as e:
+                self._failed(update, e)
+            else:
+                self.sent += 1
+            with self._condition:
+                self._sending = None
+                self._condition.notify_all()
+
+    def _failed(self, update: _StatusUpdate, e: Exception) -> None:
+        update.attempts += 1
+        with self._condition:
+            key = (update.repo_name, update.sha)
+            if key in self._pending:
+                return  # superseded while it was being sent
+            if update.attempts >= self.max_attempts or getattr(e, 'status', None) in self.permanent_errors:
+                logger.error('giving up on setting %s %s to %s after %d attempts: %s', update.repo_name,
+                             update.sha, update.status.name, update.attempts, e)
+                self.failed += 1
+                return
+            delay = min(self.backoff_sec * 2 ** (update.attempts - 1), self.max_backoff_sec)
+            logger.info('setting %s %s to %s failed (%s), retrying in %.1fs', update.repo_name, update.sha,
+                        update.status.name, e, delay)
+            update.due = time.time() + delay
+            self._pending[key] = update
+
 
-        commit = repo.get_commit(sha=build.commit)
-        logger.debug(f'Applies to commit: {commit}')
-        if not commit:
-            raise AttributeError  # TODO: come on man, these are getting ridiculous
+_reporter = None
+_reporter_pid = None
 
-        logger.info(f'updating commit status: {status.name}, {repo.name}')
 
-        commit.create_status(
-            state=status.name,
-        )
+def status_reporter() -> StatusReporter:
+    """
+    the process's StatusReporter, a process forked from one that had a reporter gets its own
+    """
+    global _reporter, _reporter_pid
+    if _reporter is None or _reporter_pid != os.getpid():
+        _reporter, _reporter_pid = StatusReporter(), os.getpid()
+    return _reporter
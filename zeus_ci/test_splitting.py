@@ -0,0 +1,148 @@
+import fcntl
+import io
+import json
+import os
+import re
+import tarfile
+import time
+import xml.etree.ElementTree as ElementTree
+from contextlib import contextmanager
+from typing import BinaryIO, Dict
+
+from zeus_ci import logger, config
+
+# where the helper and the job's timings are put inside the container
+tools_dir = '/tmp/zeus-ci'
+
+# splits test files into ZEUS_NODE_TOTAL balanced shards and prints those of ZEUS_NODE_INDEX.
+# files are weighted by their recorded timing, files without one get the mean of the known
+# timings, and with no timings at all files are weighted by size (or equally, for names that
+# aren't files). Shards are filled heaviest file first into the lightest shard.
+SPLIT_TESTS = r'''#!/bin/sh
+# usage: $ZEUS_SPLIT_TESTS [file ...]    (file names are read from stdin when none are given)
+timings="${ZEUS_TIMINGS_FILE:-/tmp/zeus-ci/timings}"
+tab="$(printf '\t')"
+{ if [ $# -gt 0 ]; then printf '%s\n' "$@"; else cat; fi; } | while IFS= read -r file; do
+    size=0
+    [ -f "$file" ] && size=$(wc -c < "$file")
+    printf '%s\t%s\n' "$size" "$file"
+done | awk -F '\t' -v timings="$timings" '
+BEGIN {
+    while ((getline line < timings) > 0) {
+        split(line, parts, "\t"); known[parts[1]] = parts[2]; sum += parts[2]; count++
+    }
+}
+{ size[$2] = $1; files[NR] = $2 }
+END {
+    mean = count ? sum / count : 0
+    for (i = 1; i <= NR; i++) {
+        file = files[i]
+        weight = (file in known) ? known[file] : (count ? mean : (size[file] > 0 ? size[file] : 1))
+        printf "%s\t%s\n", weight, file
+    }
+}' | sort -t "$tab" -k1,1gr -k2,2 | awk -F '\t' -v node="${ZEUS_NODE_INDEX:-0}" -v total="${ZEUS_NODE_TOTAL:-1}" '
+{
+    lightest = 0
+    for (shard = 1; shard < total; shard++) if (load[shard] < load[lightest]) lightest = shard
+    load[lightest] += $1
+    if (lightest == node) print $2
+}'
+'''
+
+
+class TimingStore:
+    """
+    per repo and job test file timings, recorded by store_test_results and used to balance the
+    shards of jobs with `parallelism`
+
+    <dir>/<repo scope>/<job>.json  {file: seconds}
+    """
+    def __init__(self, root: str = None):
+        self.root = root or config.runner.get('test_timings', {}).get('dir', '/var/cache/zeus-ci/timings')
+
+    def _path(self, scope: str, job: str) -> str:
+        return os.path.join(self.root, scope, '{}.json'.format(re.sub(r'[^A-Za-z0-9._-]+', '_', job)))
+
+    @contextmanager
+    def _lock(self, scope: str):
+        os.makedirs(os.path.join(self.root, scope), exist_ok=True)
+        with open(os.path.join(self.root, scope, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get(self, scope: str, job: str) -> Dict[str, float]:
+        try:
+            with open(self._path(scope, job)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def update(self, scope: str, job: str, timings: Dict[str, float]) -> None:
+        """
+        merges `timings` into those stored, each shard only reports the files it ran
+        """
+        if not timings:
+            return
+        with self._lock(scope):
+            stored = self.get(scope, job)
+            stored.update(timings)
+            tmp_path = '{}.tmp'.format(self._path(scope, job))
+            with open(tmp_path, 'w') as f:
+                json.dump(stored, f)
+            os.replace(tmp_path, self._path(scope, job))
+
+
+def _testcase_file(testcase: ElementTree.Element) -> str:
+    """
+    the test file a junit testcase came from, its `file` attribute when the reporter sets one,
+    otherwise guessed from the classname (eg. tests.test_runner.TestStage -> tests/test_runner.py)
+    """
+    if testcase.get('file'):
+        return os.path.normpath(testcase.get('file'))
+    modules = [part for part in testcase.get('classname', '').split('.') if part]
+    while len(modules) > 1 and modules[-1][:1].isupper():
+        modules.pop()
+    return '{}.py'.format('/'.join(modules)) if modules else None
+
+
+def junit_timings(archive: BinaryIO) -> Dict[str, float]:
+    """
+    sums the testcase times of every junit xml report in the tar `archive` per test file
+    """
+    timings = {}
+    with tarfile.open(fileobj=archive, mode='r|') as reports:
+        for member in reports:
+            if not member.isfile() or not member.name.endswith('.xml'):
+                continue
+            try:
+                for _, element in ElementTree.iterparse(reports.extractfile(member)):
+                    if element.tag != 'testcase':
+                        continue
+                    test_file = _testcase_file(element)
+                    if test_file:
+                        timings[test_file] = timings.get(test_file, 0) + float(element.get('time') or 0)
+                    element.clear()
+            except (ElementTree.ParseError, ValueError) as e:
+                logger.error('skipping unreadable test report %s: %s', member.name, e)
+    return {test_file: round(seconds, 3) for test_file, seconds in timings.items()}
+
+
+def tools_archive(timings: Dict[str, float]) -> BinaryIO:
+    """
+    a tar of the split helper and `timings`, to be extracted into `tools_dir` in the container
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as archive:
+        for name, data, mode in (
+                ('split-tests', SPLIT_TESTS.encode(), 0o755),
+                ('timings', ''.join('{}\t{}\n'.format(f, s) for f, s in sorted(timings.items())).encode(), 0o644)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(data))
+    buffer.seek(0)
+    return buffer
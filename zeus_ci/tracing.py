@@ -0,0 +1,169 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from zeus_ci import logger, config
+
+
+class Span:
+    """
+    a timed phase of a build. `outcome` is 'ok' unless the span exits with an exception, callers
+    can set it (and any other args) from inside the span
+    """
+    __slots__ = ('name', 'args', 'outcome', 'start', 'parent')
+
+    def __init__(self, name: str, args: dict, parent: 'Span' = None):
+        self.name = name
+        self.args = args
+        self.outcome = 'ok'
+        self.parent = parent
+        self.start = time.time()
+
+    def set(self, **args) -> None:
+        self.args.update(args)
+
+
+class _NullSpan:
+    """
+    handed out when tracing is disabled, so instrumented code costs one attribute lookup and a
+    no-op context manager
+    """
+    name = None
+    outcome = None
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def set(self, **args) -> None:
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class _TraceFile:
+    __slots__ = ('path', 'file', 'named_threads')
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'w')
+        self.file.write('[')
+        self.named_threads = set()
+
+
+class Tracer:
+    """
+    records nested spans to a Chrome trace file (the JSON array format, open in chrome://tracing or
+    https://ui.perfetto.dev). Each build gets its own file, <dir>/build-<id>-<pid>.json, opened
+    with `trace`. Spans nest per thread and per asyncio task; spans started in another thread (eg.
+    stages run by a pool) pass their `parent` explicitly, which is recorded in the span's args.
+
+    a trace collects the spans of the context (thread or asyncio task) that opened it, so builds
+    run side by side by one process each get theirs. Spans of threads that don't carry a context
+    over go to the first trace the process opened.
+
+    events are appended as they finish, so a trace of a build that crashed is still readable.
+    """
+    def __init__(self):
+        tracing_config = config.tracing or {}
+        self.enabled = tracing_config.get('enabled', False)
+        self.dir = tracing_config.get('dir', '/var/log/zeus-ci/traces')
+        self._lock = threading.Lock()
+        self._stack = contextvars.ContextVar('spans', default=())
+        self._trace = contextvars.ContextVar('trace', default=None)
+        self._default = None  # the first trace opened, for threads without one
+        self._pid = os.getpid()
+
+    @contextmanager
+    def trace(self, name: str):
+        """
+        directs the spans of this context to a new trace file `<name>-<pid>.json` for the duration
+        """
+        if not self.enabled:
+            yield
+            return
+        os.makedirs(self.dir, exist_ok=True)
+        trace = _TraceFile(os.path.join(self.dir, '{}-{}.json'.format(name, os.getpid())))
+        token = self._trace.set(trace)
+        with self._lock:
+            self._pid = os.getpid()
+            default = self._default is None
+            if default:
+                self._default = trace
+        try:
+            yield
+        finally:
+            self._trace.reset(token)
+            with self._lock:
+                if default:
+                    self._default = None
+                trace.file.write('\n]\n')
+                trace.file.close()
+                trace.file = None
+            logger.debug('wrote trace %s', trace.path)
+
+    def current(self) -> Span:
+        stack = self._stack.get()
+        return stack[-1] if stack else None
+
+    def span(self, name: str, parent: Span = None, **args):
+        if not self.enabled:
+            return _null_span
+        return self._span(name, parent, args)
+
+    @contextmanager
+    def _span(self, name: str, parent: Span, args: dict):
+        stack = self._stack.get()
+        span = Span(name, args, parent or (stack[-1] if stack else None))
+        token = self._stack.set(stack + (span, ))
+        try:
+            yield span
+        except BaseException as e:
+            span.outcome = 'error'
+            span.set(error=repr(e))
+            raise
+        finally:
+            self._stack.reset(token)
+            self._emit(span, time.time())
+
+    def record(self, name: str, start: float, end: float, parent: Span = None, **args) -> None:
+        """
+        records a span that has already happened, eg. the time a build spent queued
+        """
+        if not self.enabled:
+            return
+        span = Span(name, args, parent or self.current())
+        span.start = start
+        self._emit(span, end)
+
+    def _emit(self, span: Span, end: float) -> None:
+        args = dict(span.args, outcome=span.outcome)
+        if span.parent is not None:
+            args['parent'] = span.parent.name
+        tid = threading.get_ident()
+        event = {'name': span.name, 'ph': 'X', 'ts': int(span.start * 1e6), 'dur': int((end - span.start) * 1e6),
+                 'pid': self._pid, 'tid': tid, 'args': args}
+        with self._lock:
+            trace = self._trace.get() or self._default
+            if trace is None or trace.file is None:
+                return
+            if tid not in trace.named_threads:
+                trace.named_threads.add(tid)
+                self._write(trace, {'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                                    'args': {'name': threading.current_thread().name}})
+            self._write(trace, event)
+
+    @staticmethod
+    def _write(trace: _TraceFile, event: dict) -> None:
+        # events are comma separated as they are written, so the file is valid json once closed
+        trace.file.write('{}\n{}'.format('' if trace.file.tell() <= 1 else ',', json.dumps(event, default=str)))
+
+
+tracer = Tracer()
@@ -0,0 +1,212 @@
+import fcntl
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Dict
+
+from zeus_ci import logger, config
+from zeus_ci.executors import CHUNK_SIZE
+
+
+class WorkspaceStore:
+    """
+    content addressed storage behind persist_to_workspace / attach_workspace.
+
+    each workflow run (exec_uuid) has a manifest mapping workspace paths to file metadata, file
+    contents live once in `blobs/` keyed by their sha256, so the same file persisted by several
+    stages, workflows or builds is only stored once. Archives are streamed in and out as a single
+    tar, nothing is staged on disk as a tree.
+
+    <root>/blobs/<sha256[:2]>/<sha256>
+    <root>/manifests/<exec_uuid>.json
+
+    ingesting and archiving hold a shared flock on the store, eviction an exclusive one, as the
+    store is shared by every build process on the host.
+    """
+    _manifest_lock = threading.Lock()
+
+    def __init__(self, root: str, max_bytes: int = None, manifest_ttl: float = None):
+        workspace_config = config.runner.get('workspace', {})
+        self.root = root
+        self.max_bytes = max_bytes or workspace_config.get('max_bytes', 10 * 1024 ** 3)
+        self.manifest_ttl = manifest_ttl or workspace_config.get('manifest_ttl_sec', 24 * 60 * 60)
+        self.blob_dir = os.path.join(root, 'blobs')
+        self.manifest_dir = os.path.join(root, 'manifests')
+
+    @contextmanager
+    def _lock(self, shared: bool = True):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'store.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    def _manifest_path(self, exec_uuid: str) -> str:
+        return os.path.join(self.manifest_dir, '{}.json'.format(exec_uuid))
+
+    def _read_manifest(self, exec_uuid: str) -> Dict[str, dict]:
+        try:
+            with open(self._manifest_path(exec_uuid)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _store_blob(self, fileobj: BinaryIO) -> (str, int):
+        os.makedirs(self.blob_dir, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.blob_dir, prefix='.ingest-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+            blob_path = self._blob_path(digest.hexdigest())
+            if os.path.exists(blob_path):
+                os.utime(blob_path)  # already stored, just mark it as recently used
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return digest.hexdigest(), size
+
+    def ingest(self, exec_uuid: str, fileobj: BinaryIO) -> int:
+        """
+        reads a tar stream from `fileobj` into the store, merging its entries into the manifest of
+        `exec_uuid` (later persists win for the same path)
+        returns the number of entries ingested
+        """
+        entries = {}
+        with self._lock():
+            with tarfile.open(fileobj=fileobj, mode='r|') as archive:
+                for member in archive:
+                    entry = {'mode': member.mode, 'mtime': member.mtime}
+                    if member.isfile():
+                        entry['type'] = 'file'
+                        entry['sha256'], entry['size'] = self._store_blob(archive.extractfile(member))
+                    elif member.isdir():
+                        entry['type'] = 'dir'
+                    elif member.issym():
+                        entry['type'] = 'symlink'
+                        entry['linkname'] = member.linkname
+                    else:
+                        logger.debug('not persisting %s, unsupported file type', member.name)
+                        continue
+                    entries[os.path.normpath(member.name)] = entry
+            # tar pads its output past the end of archive marker, drain it so the writer never blocks
+            for _ in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                pass
+
+            with self._manifest_lock:
+                manifest = self._read_manifest(exec_uuid)
+                manifest.update(entries)
+                os.makedirs(self.manifest_dir, exist_ok=True)
+                tmp_path = '{}.tmp'.format(self._manifest_path(exec_uuid))
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(tmp_path, self._manifest_path(exec_uuid))
+        return len(entries)
+
+    def write_archive(self, exec_uuid: str, fileobj: BinaryIO) -> int:
+        """
+        writes the workspace of `exec_uuid` to `fileobj` as a tar stream, straight from the blobs
+        returns the number of entries written
+        """
+        with self._lock():
+            manifest = self._read_manifest(exec_uuid)
+            with tarfile.open(fileobj=fileobj, mode='w|') as archive:
+                # sorted so directories come before their contents
+                for name, entry in sorted(manifest.items()):
+                    info = tarfile.TarInfo(name)
+                    info.mode = entry['mode']
+                    info.mtime = entry['mtime']
+                    if entry['type'] == 'dir':
+                        info.type = tarfile.DIRTYPE
+                        archive.addfile(info)
+                    elif entry['type'] == 'symlink':
+                        info.type = tarfile.SYMTYPE
+                        info.linkname = entry['linkname']
+                        archive.addfile(info)
+                    else:
+                        blob_path = self._blob_path(entry['sha256'])
+                        info.size = entry['size']
+                        with open(blob_path, 'rb') as blob:
+                            archive.addfile(info, blob)
+                        os.utime(blob_path)
+        return len(manifest)
+
+    def open_archive(self, exec_uuid: str) -> BinaryIO:
+        """
+        returns a pipe that the workspace of `exec_uuid` is streamed into as a tar from a
+        background thread
+        """
+        read_fd, write_fd = os.pipe()
+
+        def write():
+            try:
+                with os.fdopen(write_fd, 'wb') as writer:
+                    self.write_archive(exec_uuid, writer)
+            except BrokenPipeError:
+                logger.error('reader of workspace %s went away', exec_uuid)
+
+        threading.Thread(target=write, daemon=True).start()
+        return os.fdopen(read_fd, 'rb')
+
+    def discard(self, exec_uuid: str) -> None:
+        """
+        drops the manifest of a finished workflow, its blobs stay around for reuse until evicted
+        """
+        try:
+            os.unlink(self._manifest_path(exec_uuid))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        """
+        drops manifests older than `manifest_ttl` (left behind by builds that never finished), then
+        removes the least recently used unreferenced blobs until the store fits in `max_bytes`
+        """
+        with self._lock(shared=False):
+            referenced = set()
+            oldest = time.time() - self.manifest_ttl
+            if os.path.isdir(self.manifest_dir):
+                for name in os.listdir(self.manifest_dir):
+                    path = os.path.join(self.manifest_dir, name)
+                    if os.stat(path).st_mtime < oldest:
+                        logger.info('removing stale workspace manifest %s', path)
+                        os.unlink(path)
+                        continue
+                    with open(path) as f:
+                        referenced.update(e['sha256'] for e in json.load(f).values() if e['type'] == 'file')
+
+            blobs = []
+            total = 0
+            for directory, _, files in os.walk(self.blob_dir):
+                for name in files:
+                    stat = os.stat(os.path.join(directory, name))
+                    total += stat.st_size
+                    blobs.append((stat.st_mtime, stat.st_size, name, os.path.join(directory, name)))
+
+            for _, size, name, path in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                if name in referenced:
+                    continue
+                os.unlink(path)
+                total -= size
+            logger.debug('workspace store at %s is %d bytes', self.root, total)